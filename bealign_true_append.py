@@ -4,17 +4,28 @@ True Append for bealign
 '''
 
 # imports
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from os import remove, stat
 from os.path import isfile
-from pysam import AlignmentFile
+from pysam import AlignedSegment, AlignmentFile, AlignmentHeader
 from subprocess import run
 from sys import argv, stderr, stdin, stdout
+from time import perf_counter
+from true_append_cache import aligner_namespace, AlignmentCache, DEFAULT_CACHE_SIZE
+from true_append_fasta import iter_fasta, load_fasta
+from true_append_index import build_index, load_index, write_index, DEFAULT_INDEX_SUFFIX
+from true_append_io import open_file
+from true_append_metrics import add_metrics_args, metrics_from_args
+from true_append_state import StateStore
 import argparse
 
 # constants
 BEALIGN_TRUE_APPEND_VERSION = '0.0.1'
 DEFAULT_BEALIGN_PATH = 'bealign'
 DEFAULT_BEALIGN_ARGS = ''
+QNAME_INDEX_SUFFIX = '.qnidx'
+QNAME_INDEX_HEADER = '#bam_qname_index\tv2' # followed by the size and mtime (ns) of the indexed BAM
 STDIO = {'stderr':stderr, 'stdin':stdin, 'stdout':stdout}
 
 # return the current time as a string
@@ -25,65 +36,49 @@ def get_time():
 def print_log(s='', end='\n'):
     print("[%s] %s" % (get_time(), s), file=stderr, end=end); stderr.flush()
 
-# open file and return file object
-def open_file(fn, mode='r', text=True):
-    if fn in STDIO:
-        return STDIO[fn]
-    elif fn.lower().endswith('.gz'):
-        if mode == 'a':
-            raise NotImplementedError("Cannot append to gzip file")
-        if text:
-            mode += 't'
-        return gopen(fn, mode)
-    else:
-        return open(fn, mode)
-
 # parse user args
 def parse_args():
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('-of', '--old_fasta_file', required=True, type=str, help="Input: Old sequences (FASTA)")
-    parser.add_argument('-ob', '--old_bam_file', required=True, type=str, help="Input: Old aligned sequences (BAM)")
+    parser.add_argument('-of', '--old_fasta_file', required=False, type=str, default=None, help="Input: Old sequences (FASTA)")
+    parser.add_argument('-oi', '--old_index_file', required=False, type=str, default=None, help="Input: Old sequence digest index (instead of --old_fasta_file)")
+    parser.add_argument('--output_index_file', required=False, type=str, default=None, help="Output: Sequence digest index (default: output BAM file + '%s')" % DEFAULT_INDEX_SUFFIX)
+    parser.add_argument('-ob', '--old_bam_file', required=False, type=str, default=None, help="Input: Old aligned sequences (BAM)")
     parser.add_argument('--bealign_args', required=False, type=str, default=DEFAULT_BEALIGN_ARGS, help="Optional bealign arguments")
     parser.add_argument('--bealign_path', required=False, type=str, default=DEFAULT_BEALIGN_PATH, help="Path to the bealign executable")
+    parser.add_argument('-j', '--jobs', required=False, type=int, default=1, help="Number of parallel bealign processes (new/updated sequences are split into balanced chunks)")
+    parser.add_argument('--cache', required=False, type=str, default=None, help="Alignment cache (SQLite) to reuse alignments of previously seen sequences")
+    parser.add_argument('--cache_size', required=False, type=int, default=DEFAULT_CACHE_SIZE, help="Maximum number of alignments in the cache")
+    parser.add_argument('-t', '--threads', required=False, type=int, default=1, help="Number of BGZF compression/decompression threads used when merging BAMs")
+    parser.add_argument('--qname_index', action='store_true', help="Skip deleted/replaced old reads via the old BAM's query name index (<old BAM>%s, if it exists and matches the old BAM), and record one for the output BAM while merging (the output BAM is then compressed in a single thread)" % QNAME_INDEX_SUFFIX)
+    parser.add_argument('--state_db', required=False, type=str, default=None, help="Run state store (SQLite) holding the previous run (instead of --old_* files; output BAM then only holds new/updated alignments)")
+    add_metrics_args(parser)
     parser.add_argument('fasta_file', type=str, help="Input: User sequences (FASTA)")
     parser.add_argument('bam_file', type=str, help="Output: Aligned sequences (BAM)")
     args = parser.parse_args()
-    for fn in [args.fasta_file, args.old_fasta_file, args.old_bam_file]:
-        if not isfile(fn) and not fn.startswith('/dev/fd'):
+    if args.jobs < 1:
+        raise ValueError("Number of jobs must be positive: %s" % args.jobs)
+    if args.threads < 1:
+        raise ValueError("Number of threads must be positive: %s" % args.threads)
+    if args.state_db is None:
+        if (args.old_fasta_file is None) == (args.old_index_file is None):
+            raise ValueError("Must specify exactly one of --old_fasta_file or --old_index_file")
+        if args.old_bam_file is None:
+            raise ValueError("Must specify --old_bam_file (or --state_db)")
+    if args.output_index_file is None:
+        args.output_index_file = '%s%s' % (args.bam_file, DEFAULT_INDEX_SUFFIX)
+    for fn in [args.fasta_file, args.old_fasta_file, args.old_index_file, args.old_bam_file]:
+        if fn is not None and not isfile(fn) and not fn.startswith('/dev/fd'):
             raise ValueError("File not found: %s" % fn)
-    for fn in [args.bam_file]:
+    for fn in [args.bam_file, args.output_index_file]:
         if fn.lower().endswith('.gz'):
             raise ValueError("Cannot directly write to gzip output file")
         if isfile(fn):
             raise ValueError("File exists: %s" % fn)
     return args
 
-# load FASTA
-def load_fasta(fn):
-    infile = open_file(fn); seqs = dict(); name = None; seq = ''
-    for line in infile:
-        l = line.strip()
-        if len(l) == 0:
-            continue
-        if l[0] == '>':
-            if name is not None:
-                if len(seq) == 0:
-                    raise ValueError("Malformed FASTA: %s" % fn)
-                seqs[name] = seq
-            name = l[1:]
-            if name in seqs:
-                raise ValueError("Duplicate sequence ID (%s): %s" % (name, fn))
-            seq = ''
-        else:
-            seq += l
-    if name is None or len(seq) == 0:
-        raise ValueError("Malformed FASTA: %s" % fn)
-    seqs[name] = seq; infile.close()
-    return seqs
-
 # determine dataset deltas
-# Argument: `seqs_new` = `dict` where keys are user-uploaded sequence IDs and values are sequences
-# Argument: `seqs_old` = `dict` where keys are existing sequence IDs and values are sequences
+# Argument: `seqs_new` = `dict` where keys are user-uploaded sequence IDs and values are sequences (or digest index entries)
+# Argument: `seqs_old` = `dict` where keys are existing sequence IDs and values are sequences (or digest index entries)
 # Return: `to_add` = `set` containing IDs in `seqs_new` that need to be added to `seqs_old`
 # Return: `to_replace` = `set` containing IDs in `seqs_old` whose sequences need to be updated with those in `seqs_new`
 # Return: `to_delete` = `set` containing IDs in `seqs_old` that need to be deleted
@@ -101,51 +96,262 @@ def determine_deltas(seqs_new, seqs_old):
             to_add.add(ID)
     return to_add, to_replace, to_delete, to_keep
 
+# split IDs into (at most) `num_chunks` contiguous chunks with roughly equal total sequence length
+# Argument: `IDs` = `list` of sequence IDs (in output order)
+# Argument: `seqs` = `dict` where keys are sequence IDs and values are sequences
+# Return: `list` of non-empty `list`s of IDs (concatenating them gives back `IDs`)
+def split_balanced(IDs, seqs, num_chunks):
+    total = sum(len(seqs[k]) for k in IDs); chunks = [list()]; done = 0
+    for k in IDs:
+        if len(chunks) < num_chunks and len(chunks[-1]) != 0 and done >= total * len(chunks) / num_chunks:
+            chunks.append(list())
+        chunks[-1].append(k); done += len(seqs[k])
+    return chunks
+
+# run a single bealign command (in a worker thread: bealign itself runs as a subprocess, so threads suffice)
+# Return: exit code and runtime (seconds) of bealign
+def run_bealign_command(bealign_command, log_fn):
+    with open_file(log_fn, 'w') as log_f:
+        start = perf_counter(); exit_code = run(bealign_command, stderr=log_f).returncode
+        return exit_code, perf_counter() - start
+
 # run bealign on all new and updated sequences
-def run_bealign(seqs_new, new_updated_fasta_fn, to_add, to_replace, out_bam_fn, bealign_path=DEFAULT_BEALIGN_PATH, bealign_args=DEFAULT_BEALIGN_ARGS):
-    new_updated_fasta_file = open_file(new_updated_fasta_fn, 'w')
-    for k, v in seqs_new.items():
+# Argument: `jobs` = number of parallel bealign processes (each aligns one balanced chunk of the new/updated sequences)
+# Argument: `metrics` = `Metrics` to record each bealign run in (or `None`)
+# Return: `list` of output BAM filenames (one per chunk, in the same order as the sequences in `seqs_new`)
+def run_bealign(seqs_new, new_updated_fasta_fn, to_add, to_replace, out_bam_fn, bealign_path=DEFAULT_BEALIGN_PATH, bealign_args=DEFAULT_BEALIGN_ARGS, jobs=1, metrics=None):
+    IDs = [k for k in seqs_new if (k in to_add) or (k in to_replace)]
+    if jobs == 1:
+        chunk_fns = [(new_updated_fasta_fn, out_bam_fn)]; chunks = [IDs]
+    else:
+        chunks = split_balanced(IDs, seqs_new, jobs)
+        fasta_prefix = new_updated_fasta_fn.rsplit('.', 1)[0]; bam_prefix = out_bam_fn.rsplit('.', 1)[0]
+        chunk_fns = [('%s.part%d.fasta' % (fasta_prefix, i), '%s.part%d.bam' % (bam_prefix, i)) for i in range(len(chunks))]
+    commands = list()
+    for chunk, (fasta_fn, bam_fn) in zip(chunks, chunk_fns):
+        with open_file(fasta_fn, 'w') as fasta_file:
+            for k in chunk:
+                fasta_file.write('>%s\n%s\n' % (k, seqs_new[k]))
+        commands.append([bealign_path] + [v.strip() for v in bealign_args.split()] + [fasta_fn, bam_fn])
+    log_fns = ['%s.bealign.log' % fasta_fn for fasta_fn, bam_fn in chunk_fns]
+    for bealign_command in commands:
+        print_log("Running bealign: %s" % ' '.join(bealign_command))
+    if len(commands) == 1:
+        results = [run_bealign_command(commands[0], log_fns[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=len(commands)) as executor:
+            results = list(executor.map(run_bealign_command, commands, log_fns))
+    for bealign_command, (exit_code, runtime) in zip(commands, results):
+        if metrics is not None:
+            metrics.subprocess(bealign_command, exit_code, runtime)
+        if exit_code != 0:
+            raise RuntimeError("bealign failed (exit code %d): %s" % (exit_code, ' '.join(bealign_command)))
+    return [bam_fn for fasta_fn, bam_fn in chunk_fns]
+
+# run bealign on all new and updated sequences using an alignment cache
+# Cached alignments are reused (under the new IDs), and every distinct uncached sequence is aligned only once
+# Return: `list` of output BAM filenames (bealign chunk outputs, then a BAM of reads reconstructed from the cache)
+def run_bealign_cached(seqs_new, new_updated_fasta_fn, to_add, to_replace, out_bam_fn, cache, bealign_path=DEFAULT_BEALIGN_PATH, bealign_args=DEFAULT_BEALIGN_ARGS, jobs=1, metrics=None):
+    seq2IDs = dict()
+    for k in seqs_new:
         if (k in to_add) or (k in to_replace):
-            new_updated_fasta_file.write('>%s\n%s\n' % (k, v))
-    bealign_command = [bealign_path] + [v.strip() for v in bealign_args.split()] + [new_updated_fasta_fn, out_bam_fn]
-    log_f = open_file('%s.bealign.log' % new_updated_fasta_fn, 'w')
-    print_log("Running bealign: %s" % ' '.join(bealign_command))
-    run(bealign_command, stderr=log_f); log_f.close()
+            if seqs_new[k] in seq2IDs:
+                seq2IDs[seqs_new[k]].append(k)
+            else:
+                seq2IDs[seqs_new[k]] = [k]
+    to_align = set(); reuse = list() # reuse = (IDs, SAM records) tuples
+    for seq, IDs in seq2IDs.items():
+        sam = cache.get(seq)
+        if sam is None:
+            to_align.add(IDs[0])
+        else:
+            reuse.append((IDs, sam))
+    bam_fns = list(); header_text = cache.get_meta('header')
+    if len(to_align) != 0 or len(reuse) == 0:
+        bam_fns = run_bealign(seqs_new, new_updated_fasta_fn, to_align, set(), out_bam_fn, bealign_path=bealign_path, bealign_args=bealign_args, jobs=jobs, metrics=metrics)
+        aligned = dict()
+        for bam_fn in bam_fns:
+            bam_file = AlignmentFile(bam_fn, 'rb'); header_text = str(bam_file.header)
+            for read in bam_file.fetch(until_eof=True):
+                if read.query_name in aligned:
+                    aligned[read.query_name].append(read.to_string())
+                else:
+                    aligned[read.query_name] = [read.to_string()]
+            bam_file.close()
+        cache.put_meta('header', header_text)
+        for name, reads in aligned.items():
+            if name not in to_align:
+                raise ValueError("bealign output read doesn't match an input sequence ID: %s" % name)
+            sam = '\n'.join(reads); cache.put(seqs_new[name], sam)
+            if len(seq2IDs[seqs_new[name]]) != 1:
+                reuse.append((seq2IDs[seqs_new[name]][1:], sam))
+    if len(reuse) != 0:
+        cached_bam_fn = '%s.cached.bam' % out_bam_fn.rsplit('.', 1)[0]; header = AlignmentHeader.from_text(header_text)
+        cached_bam_file = AlignmentFile(cached_bam_fn, 'wb', header=header)
+        for IDs, sam in reuse:
+            for k in IDs:
+                for line in sam.split('\n'):
+                    read = AlignedSegment.fromstring(line, header); read.query_name = k
+                    cached_bam_file.write(read)
+        cached_bam_file.close(); bam_fns.append(cached_bam_fn)
+    return bam_fns
+
+# size and modification time of a BAM (stored in its query name index, so a stale index is detected)
+def bam_stamp(bam_fn):
+    st = stat(bam_fn)
+    return '%d\t%d' % (st.st_size, st.st_mtime_ns)
+
+# load a query name index written by `write_qname_index`
+# Argument: `fn` = filename of the query name index
+# Argument: `bam_fn` = filename of the indexed BAM
+# Return: `list` of (query name, virtual offset) tuples in file order, or `None` if the index doesn't match `bam_fn` (e.g. the BAM was rewritten since)
+def load_qname_index(fn, bam_fn):
+    infile = open_file(fn); index = list()
+    header = infile.readline().rstrip('\n')
+    if not header.startswith(QNAME_INDEX_HEADER.split('\t')[0]):
+        raise ValueError("Invalid query name index: %s" % fn)
+    if header != '%s\t%s' % (QNAME_INDEX_HEADER, bam_stamp(bam_fn)):
+        infile.close(); return None
+    for line in infile:
+        name, offset = line.rstrip('\n').rsplit('\t', 1)
+        index.append((name, int(offset)))
+    infile.close()
+    return index
+
+# write a query name index
+# Argument: `fn` = filename of the query name index
+# Argument: `index` = `list` of (query name, virtual offset) tuples in file order (see `merge_bams`)
+# Argument: `bam_fn` = filename of the indexed BAM (must be complete)
+def write_qname_index(fn, index, bam_fn):
+    with open_file(fn, 'w') as outfile:
+        outfile.write('%s\t%s\n' % (QNAME_INDEX_HEADER, bam_stamp(bam_fn)))
+        for name, offset in index:
+            outfile.write('%s\t%d\n' % (name, offset))
 
 # merge old and new/updated BAMs
-def merge_bams(old_bam_fn, new_updated_bam_fn, out_bam_fn, to_keep):
-    old_bam_file = AlignmentFile(old_bam_fn, 'rb')
-    new_updated_bam_file = AlignmentFile(new_updated_bam_fn, 'rb')
-    out_bam_file = AlignmentFile(out_bam_fn, 'wb', template=new_updated_bam_file)
-    for read in new_updated_bam_file.fetch(until_eof=True):
+# Argument: `new_updated_bam_fns` = `list` of new/updated BAM filenames (chunk outputs are concatenated in order)
+# Argument: `threads` = number of BGZF compression/decompression threads
+# Argument: `old_qname_index` = query name index of the old BAM (see `load_qname_index`): if given, only runs of kept reads are decoded
+# Argument: `qname_index` = `True` to record the query name index of the output BAM as its reads are written (the output is then compressed in a single thread, so write offsets are exact)
+# Return: query name index of the output BAM (`list` of (query name, virtual offset) tuples), or `None` if `qname_index` is `False`
+def merge_bams(old_bam_fn, new_updated_bam_fns, out_bam_fn, to_keep, threads=1, old_qname_index=None, qname_index=False):
+    old_bam_file = None if old_bam_fn is None else AlignmentFile(old_bam_fn, 'rb', threads=threads)
+    new_updated_bam_files = [AlignmentFile(fn, 'rb', threads=threads) for fn in new_updated_bam_fns]
+    out_bam_file = AlignmentFile(out_bam_fn, 'wb', template=new_updated_bam_files[0], threads=1 if qname_index else threads)
+    out_index = list() if qname_index else None
+    def write(read):
+        if qname_index:
+            out_index.append((read.query_name, out_bam_file.tell()))
         out_bam_file.write(read)
-    for read in old_bam_file.fetch(until_eof=True):
-        if read.query_name.strip() in to_keep:
-            out_bam_file.write(read)
+    for new_updated_bam_file in new_updated_bam_files:
+        for read in new_updated_bam_file.fetch(until_eof=True):
+            write(read)
+        new_updated_bam_file.close()
+    if old_bam_file is None:
+        pass
+    elif old_qname_index is None:
+        for read in old_bam_file.fetch(until_eof=True):
+            if read.query_name in to_keep:
+                write(read)
+    else:
+        i = 0
+        while i < len(old_qname_index):
+            if old_qname_index[i][0] not in to_keep:
+                i += 1; continue
+            run_start = i
+            while i < len(old_qname_index) and old_qname_index[i][0] in to_keep:
+                i += 1
+            old_bam_file.seek(old_qname_index[run_start][1])
+            for _ in range(i - run_start):
+                write(next(old_bam_file))
+    if old_bam_file is not None:
+        old_bam_file.close()
+    out_bam_file.close()
+    return out_index
+
+# store new/updated alignments in the run state store (as SAM records, replacing those of deleted IDs)
+# Argument: `state` = `StateStore` of bealign
+# Argument: `bam_fns` = filenames of the new/updated BAMs
+# Argument: `to_delete` = `set` containing IDs that were deleted
+def update_bealign_state(state, bam_fns, to_delete):
+    state.delete_records('sam', to_delete); aligned = dict()
+    for bam_fn in bam_fns:
+        bam_file = AlignmentFile(bam_fn, 'rb'); state.put_meta('header\tsam', str(bam_file.header))
+        for read in bam_file.fetch(until_eof=True):
+            aligned[read.query_name] = aligned.get(read.query_name, '') + read.to_string() + '\n'
+        bam_file.close()
+    state.put_records('sam', aligned.items())
 
 # main program
 def main():
     print_log("Running bealign True Append v%s" % BEALIGN_TRUE_APPEND_VERSION)
     args = parse_args()
     print_log("Command: %s" % ' '.join(argv))
-    print_log("Loading user FASTA: %s" % args.fasta_file)
-    seqs_new = load_fasta(args.fasta_file)
-    print_log("- Num Sequences: %s" % len(seqs_new))
-    print_log("Parsing old FASTA: %s" % args.old_fasta_file)
-    seqs_old = load_fasta(args.old_fasta_file)
-    print_log("- Num Sequences: %s" % (len(seqs_old)))
-    print_log("Determining deltas between user table and old table...")
-    to_add, to_replace, to_delete, to_keep = determine_deltas(seqs_new, seqs_old)
-    print_log("- Add: %s" % len(to_add))
-    print_log("- Replace: %s" % len(to_replace))
-    print_log("- Delete: %s" % len(to_delete))
-    print_log("- Do nothing: %s" % (len(to_keep)))
+    metrics = metrics_from_args(args, 'bealign')
+    with metrics.phase('parse_user') as counts:
+        print_log("Loading user FASTA: %s" % args.fasta_file)
+        seqs_new = load_fasta(args.fasta_file, packed=True)
+        print_log("- Num Sequences: %s" % len(seqs_new))
+        print_log("Indexing user sequences...")
+        index_new = build_index(seqs_new); counts['sequences'] = len(seqs_new)
+    state = None
+    with metrics.phase('parse_old') as counts:
+        if args.state_db is not None:
+            print_log("Loading old sequence index from state store: %s" % args.state_db)
+            state = StateStore(args.state_db, 'bealign'); index_old = state.load_index()
+        elif args.old_index_file is None:
+            print_log("Parsing old FASTA: %s" % args.old_fasta_file)
+            index_old = build_index(iter_fasta(args.old_fasta_file))
+        else:
+            print_log("Loading old sequence index: %s" % args.old_index_file)
+            index_old = load_index(args.old_index_file)
+        print_log("- Num Sequences: %s" % (len(index_old))); counts['sequences'] = len(index_old)
+    with metrics.phase('delta') as counts:
+        print_log("Determining deltas between user table and old table...")
+        to_add, to_replace, to_delete, to_keep = determine_deltas(index_new, index_old)
+        print_log("- Add: %s" % len(to_add))
+        print_log("- Replace: %s" % len(to_replace))
+        print_log("- Delete: %s" % len(to_delete))
+        print_log("- Do nothing: %s" % (len(to_keep)))
+        counts.update({'add': len(to_add), 'replace': len(to_replace), 'delete': len(to_delete), 'keep': len(to_keep)})
     new_updated_fasta_fn = '%s.new_updated.fasta' % '.'.join(args.fasta_file.split('.')[:-1])
     new_updated_bam_fn = '%s.new_updated.bam' % '.'.join(args.fasta_file.split('.')[:-1])
-    print_log("Aligning new and updated sequences and writing output to: %s" % new_updated_bam_fn)
-    run_bealign(seqs_new, new_updated_fasta_fn, to_add, to_replace, new_updated_bam_fn, bealign_path=args.bealign_path, bealign_args=args.bealign_args)
-    print_log("Merging old and new/updated alignments into: %s" % args.bam_file)
-    merge_bams(args.old_bam_file, new_updated_bam_fn, args.bam_file, to_keep)
+    with metrics.phase('external') as counts:
+        print_log("Aligning new and updated sequences and writing output to: %s" % new_updated_bam_fn)
+        if args.cache is None:
+            new_updated_bam_fns = run_bealign(seqs_new, new_updated_fasta_fn, to_add, to_replace, new_updated_bam_fn, bealign_path=args.bealign_path, bealign_args=args.bealign_args, jobs=args.jobs, metrics=metrics)
+        else:
+            cache = AlignmentCache(args.cache, aligner_namespace('bealign', args.bealign_path, args.bealign_args), max_entries=args.cache_size)
+            new_updated_bam_fns = run_bealign_cached(seqs_new, new_updated_fasta_fn, to_add, to_replace, new_updated_bam_fn, cache, bealign_path=args.bealign_path, bealign_args=args.bealign_args, jobs=args.jobs, metrics=metrics)
+            print_log("- Cache hits: %d" % cache.hits); counts['cache_hits'] = cache.hits
+            cache.close()
+        counts['sequences'] = len(to_add) + len(to_replace)
+    if state is not None:
+        with metrics.phase('update_state'):
+            print_log("Updating state store: %s" % args.state_db)
+            update_bealign_state(state, new_updated_bam_fns, to_delete)
+            state.update_index(index_new, to_add | to_replace, to_delete); state.close()
+    with metrics.phase('merge') as counts:
+        old_qname_index = None; old_qname_index_fn = '%s%s' % (args.old_bam_file, QNAME_INDEX_SUFFIX)
+        if args.qname_index and args.old_bam_file is not None and isfile(old_qname_index_fn):
+            print_log("Loading old BAM query name index: %s" % old_qname_index_fn)
+            old_qname_index = load_qname_index(old_qname_index_fn, args.old_bam_file)
+            if old_qname_index is None:
+                print_log("- Query name index doesn't match the old BAM (ignoring it)")
+        print_log("Merging %s alignments into: %s" % ('new/updated' if args.old_bam_file is None else 'old and new/updated', args.bam_file))
+        out_qname_index = merge_bams(args.old_bam_file, new_updated_bam_fns, args.bam_file, to_keep, threads=args.threads, old_qname_index=old_qname_index, qname_index=args.qname_index)
+        counts['kept_sequences'] = 0 if args.old_bam_file is None else len(to_keep)
+    with metrics.phase('write_index') as counts:
+        out_qname_index_fn = '%s%s' % (args.bam_file, QNAME_INDEX_SUFFIX)
+        if args.qname_index:
+            print_log("Writing output BAM query name index: %s" % out_qname_index_fn)
+            write_qname_index(out_qname_index_fn, out_qname_index, args.bam_file)
+        elif isfile(out_qname_index_fn): # left over from an earlier output BAM
+            print_log("Removing stale output BAM query name index: %s" % out_qname_index_fn)
+            remove(out_qname_index_fn)
+        print_log("Writing sequence index: %s" % args.output_index_file)
+        write_index(args.output_index_file, index_new); counts['sequences'] = len(index_new)
+    metrics.close()
 
 # run main program
 if __name__ == "__main__":
@@ -5,10 +5,21 @@ True Append for cawlign
 
 # imports
 from datetime import datetime
-from gzip import open as gopen
+from os import remove
 from os.path import isfile
-from subprocess import run
+from shutil import copyfileobj
+from subprocess import PIPE, Popen
 from sys import argv, stderr, stdin, stdout
+from tempfile import NamedTemporaryFile
+from threading import Lock, Thread
+from time import perf_counter
+from true_append_cache import aligner_namespace, AlignmentCache, DEFAULT_CACHE_SIZE
+from true_append_fasta import iter_fasta, load_fasta
+from true_append_index import build_index, load_index, write_index, DEFAULT_INDEX_SUFFIX
+from true_append_io import has_fileno, is_gzip_fn, open_file
+from true_append_metrics import add_metrics_args, metrics_from_args
+from true_append_staging import append_part, new_part, BackgroundTask
+from true_append_state import StateStore
 import argparse
 
 # constants
@@ -25,65 +36,45 @@ def get_time():
 def print_log(s='', end='\n'):
     print("[%s] %s" % (get_time(), s), file=stderr, end=end); stderr.flush()
 
-# open file and return file object
-def open_file(fn, mode='r', text=True):
-    if fn in STDIO:
-        return STDIO[fn]
-    elif fn.lower().endswith('.gz'):
-        if mode == 'a':
-            raise NotImplementedError("Cannot append to gzip file")
-        if text:
-            mode += 't'
-        return gopen(fn, mode)
-    else:
-        return open(fn, mode)
-
 # parse user args
 def parse_args():
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('-of', '--old_unaligned_file', required=True, type=str, help="Input: Old unaligned sequences (FASTA)")
-    parser.add_argument('-oa', '--old_aligned_file', required=True, type=str, help="Input: Old aligned sequences (FASTA)")
+    parser.add_argument('-of', '--old_unaligned_file', required=False, type=str, default=None, help="Input: Old unaligned sequences (FASTA)")
+    parser.add_argument('-oi', '--old_index_file', required=False, type=str, default=None, help="Input: Old unaligned sequence digest index (instead of --old_unaligned_file)")
+    parser.add_argument('-oa', '--old_aligned_file', required=False, type=str, default=None, help="Input: Old aligned sequences (FASTA)")
     parser.add_argument('-o', '--output_aligned_file', required=False, type=str, default='stdout', help="Output: Aligned sequences (FASTA)")
+    parser.add_argument('--output_index_file', required=False, type=str, default=None, help="Output: Unaligned sequence digest index (default: output aligned file + '%s')" % DEFAULT_INDEX_SUFFIX)
     parser.add_argument('--cawlign_args', required=False, type=str, default=DEFAULT_CAWLIGN_ARGS, help="Optional cawlign arguments")
     parser.add_argument('--cawlign_path', required=False, type=str, default=DEFAULT_CAWLIGN_PATH, help="Path to the cawlign executable")
+    parser.add_argument('-w', '--workers', required=False, type=int, default=1, help="Number of concurrent cawlign processes")
+    parser.add_argument('--cache', required=False, type=str, default=None, help="Alignment cache (SQLite) to reuse alignments of previously seen sequences")
+    parser.add_argument('--cache_size', required=False, type=int, default=DEFAULT_CACHE_SIZE, help="Maximum number of alignments in the cache")
+    parser.add_argument('--state_db', required=False, type=str, default=None, help="Run state store (SQLite) holding the previous run (instead of --old_* files; output then only holds new/updated alignments)")
+    add_metrics_args(parser)
     parser.add_argument('fasta_file', nargs='?', type=str, default='stdin', help="Input: User unaligned sequences (FASTA)")
     args = parser.parse_args()
-    for fn in [args.old_unaligned_file, args.old_aligned_file, args.fasta_file]:
-        if not isfile(fn) and fn not in STDIO and not fn.startswith('/dev/fd'):
+    if args.workers < 1:
+        raise ValueError("Number of workers must be positive: %s" % args.workers)
+    if args.state_db is None:
+        if (args.old_unaligned_file is None) == (args.old_index_file is None):
+            raise ValueError("Must specify exactly one of --old_unaligned_file or --old_index_file")
+        if args.old_aligned_file is None:
+            raise ValueError("Must specify --old_aligned_file (or --state_db)")
+    if args.output_index_file is None and args.output_aligned_file not in STDIO:
+        args.output_index_file = '%s%s' % (args.output_aligned_file, DEFAULT_INDEX_SUFFIX)
+    for fn in [args.old_unaligned_file, args.old_index_file, args.old_aligned_file, args.fasta_file]:
+        if fn is not None and not isfile(fn) and fn not in STDIO and not fn.startswith('/dev/fd'):
             raise ValueError("File not found: %s" % fn)
-    for fn in [args.output_aligned_file]:
-        if fn.lower().endswith('.gz'):
-            raise ValueError("Cannot directly write to gzip output file. To gzip the output, specify 'stdout' as the output file, and then pipe to gzip.")
+    for fn in [args.output_aligned_file, args.output_index_file]:
+        if fn is None:
+            continue
         if isfile(fn):
             raise ValueError("File exists: %s" % fn)
     return args
 
-# load FASTA
-def load_fasta(fn):
-    infile = open_file(fn); seqs = dict(); name = None; seq = ''
-    for line in infile:
-        l = line.strip()
-        if len(l) == 0:
-            continue
-        if l[0] == '>':
-            if name is not None:
-                if len(seq) == 0:
-                    raise ValueError("Malformed FASTA: %s" % fn)
-                seqs[name] = seq
-            name = l[1:]
-            if name in seqs:
-                raise ValueError("Duplicate sequence ID (%s): %s" % (name, fn))
-            seq = ''
-        else:
-            seq += l
-    if name is None or len(seq) == 0:
-        raise ValueError("Malformed FASTA: %s" % fn)
-    seqs[name] = seq; infile.close()
-    return seqs
-
 # determine dataset deltas
-# Argument: `seqs_new` = `dict` where keys are user-uploaded sequence IDs and values are sequences
-# Argument: `seqs_old` = `dict` where keys are existing sequence IDs and values are sequences
+# Argument: `seqs_new` = `dict` where keys are user-uploaded sequence IDs and values are sequences (or digest index entries)
+# Argument: `seqs_old` = `dict` where keys are existing sequence IDs and values are sequences (or digest index entries)
 # Return: `to_add` = `set` containing IDs in `seqs_new` that need to be added to `seqs_old`
 # Return: `to_replace` = `set` containing IDs in `seqs_old` whose sequences need to be updated with those in `seqs_new`
 # Return: `to_delete` = `set` containing IDs in `seqs_old` that need to be deleted
@@ -102,43 +93,203 @@ def determine_deltas(seqs_new, seqs_old):
     return to_add, to_replace, to_delete, to_keep
 
 # copy alignments from unchanged sequences
-def copy_unchanged_alignments(to_keep, aln_old, out_aln_file):
-    for k in to_keep:
-        out_aln_file.write('>%s\n%s\n' % (k, aln_old[k]))
+# The old alignment is streamed (one record in memory at a time), so kept records are written in their old order
+# Argument: `to_keep` = `set` containing IDs to keep from the old alignment
+# Argument: `old_aln_fn` = filename of the old aligned FASTA
+# Return: number of alignments copied
+def copy_unchanged_alignments(to_keep, old_aln_fn, out_aln_file):
+    copied = set()
+    for k, aln in iter_fasta(old_aln_fn):
+        if k in to_keep:
+            if k in copied:
+                raise ValueError("Duplicate sequence ID (%s): %s" % (k, old_aln_fn))
+            out_aln_file.write('>%s\n%s\n' % (k, aln)); copied.add(k)
     out_aln_file.flush()
+    if len(copied) != len(to_keep):
+        raise ValueError("%d unchanged sequence(s) missing from old alignment (e.g. %s): %s" % (len(to_keep) - len(copied), next(iter(to_keep - copied)), old_aln_fn))
+    return len(copied)
+
+# stream FASTA records into the standard input of a cawlign process
+def feed_cawlign(proc, seqs_new, IDs):
+    try:
+        for k in IDs:
+            proc.stdin.write(('>%s\n%s\n' % (k, seqs_new[k])).encode())
+        proc.stdin.close()
+    except BrokenPipeError: # cawlign exited early (reported via its exit code)
+        pass
+
+# copy whole FASTA records from the standard output of a cawlign process into the output file
+def drain_cawlign(proc, out_aln_file, lock):
+    record = list()
+    for line in proc.stdout:
+        if line.startswith(b'>') and len(record) != 0:
+            with lock:
+                out_aln_file.write(b''.join(record).decode())
+            record = list()
+        record.append(line)
+    if len(record) != 0:
+        with lock:
+            out_aln_file.write(b''.join(record).decode())
 
 # run cawlign on all new and updated sequences
-def run_cawlign(seqs_new, to_add, to_replace, out_aln_file, cawlign_path=DEFAULT_CAWLIGN_PATH, cawlign_args=DEFAULT_CAWLIGN_ARGS):
-    new_fasta_data = ''.join('>%s\n%s\n' % (k,seqs_new[k]) for k in (to_add | to_replace)).encode('utf-8')
+# Records are streamed into cawlign's standard input (no in-memory copy of the whole FASTA); with `workers` > 1,
+# they are dealt round-robin across concurrent cawlign processes whose outputs are interleaved record by record
+# (outputs are also written record by record if `out_aln_file` isn't a real file, e.g. a pipeline stream or a gzip file)
+# Argument: `metrics` = `Metrics` to record each cawlign run in (or `None`)
+def run_cawlign(seqs_new, to_add, to_replace, out_aln_file, cawlign_path=DEFAULT_CAWLIGN_PATH, cawlign_args=DEFAULT_CAWLIGN_ARGS, workers=1, metrics=None):
+    IDs = [k for k in seqs_new if (k in to_add) or (k in to_replace)]
     cawlign_command = [cawlign_path] + [v.strip() for v in cawlign_args.split()]
-    run(cawlign_command, input=new_fasta_data, stdout=out_aln_file)
+    out_aln_file.flush(); start = perf_counter()
+    if workers == 1 and has_fileno(out_aln_file):
+        proc = Popen(cawlign_command, stdin=PIPE, stdout=out_aln_file)
+        feed_cawlign(proc, seqs_new, IDs); procs = [proc]
+    else:
+        procs = [Popen(cawlign_command, stdin=PIPE, stdout=PIPE) for _ in range(workers)]; lock = Lock(); threads = list()
+        for i, proc in enumerate(procs):
+            threads.append(Thread(target=feed_cawlign, args=(proc, seqs_new, IDs[i::workers])))
+            threads.append(Thread(target=drain_cawlign, args=(proc, out_aln_file, lock)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    for proc in procs:
+        proc.wait()
+        if metrics is not None:
+            metrics.subprocess(cawlign_command, proc.returncode, perf_counter() - start)
+        if proc.returncode != 0:
+            raise RuntimeError("cawlign failed (exit code %d): %s" % (proc.returncode, ' '.join(cawlign_command)))
     out_aln_file.flush()
 
+# align new and updated sequences using an alignment cache
+# Cached alignments are reused (under the new IDs), and every distinct uncached sequence is aligned only once
+# Return: number of sequences actually aligned by cawlign
+def run_cawlign_cached(seqs_new, to_add, to_replace, out_aln_file, cache, cawlign_path=DEFAULT_CAWLIGN_PATH, cawlign_args=DEFAULT_CAWLIGN_ARGS, workers=1, metrics=None):
+    seq2IDs = dict()
+    for k in seqs_new:
+        if (k in to_add) or (k in to_replace):
+            if seqs_new[k] in seq2IDs:
+                seq2IDs[seqs_new[k]].append(k)
+            else:
+                seq2IDs[seqs_new[k]] = [k]
+    to_align = set()
+    for seq, IDs in seq2IDs.items():
+        aln = cache.get(seq)
+        if aln is None:
+            to_align.add(IDs[0])
+        else:
+            for k in IDs:
+                out_aln_file.write('>%s\n%s\n' % (k, aln))
+    if len(to_align) != 0:
+        tmp_aln_file = NamedTemporaryFile(mode='w', suffix='.aln', delete=False)
+        try:
+            with tmp_aln_file:
+                run_cawlign(seqs_new, to_align, set(), tmp_aln_file, cawlign_path=cawlign_path, cawlign_args=cawlign_args, workers=workers, metrics=metrics)
+            for name, aln in iter_fasta(tmp_aln_file.name):
+                if name not in to_align:
+                    raise ValueError("cawlign output record doesn't match an input sequence ID: %s" % name)
+                cache.put(seqs_new[name], aln)
+                for k in seq2IDs[seqs_new[name]]:
+                    out_aln_file.write('>%s\n%s\n' % (k, aln))
+        finally:
+            remove(tmp_aln_file.name)
+    out_aln_file.flush()
+    return len(to_align)
+
+# align new and updated sequences (using the alignment cache if one was specified)
+def align_new_updated(args, seqs_new, to_add, to_replace, out_aln_file, metrics=None):
+    if args.cache is None:
+        run_cawlign(seqs_new, to_add, to_replace, out_aln_file, cawlign_path=args.cawlign_path, cawlign_args=args.cawlign_args, workers=args.workers, metrics=metrics)
+    else:
+        cache = AlignmentCache(args.cache, aligner_namespace('cawlign', args.cawlign_path, args.cawlign_args), max_entries=args.cache_size)
+        num_aligned = run_cawlign_cached(seqs_new, to_add, to_replace, out_aln_file, cache, cawlign_path=args.cawlign_path, cawlign_args=args.cawlign_args, workers=args.workers, metrics=metrics)
+        print_log("- Aligned %d sequence(s) (%d cache hit(s))" % (num_aligned, cache.hits))
+        cache.close()
+
 # main program
 def main():
     print_log("Running cawlign True Append v%s" % CAWLIGN_TRUE_APPEND_VERSION)
     args = parse_args()
     print_log("Command: %s" % ' '.join(argv))
-    print_log("Loading user FASTA: %s" % args.fasta_file)
-    seqs_new = load_fasta(args.fasta_file)
-    print_log("- Num Sequences: %s" % len(seqs_new))
-    print_log("Parsing old FASTA: %s" % args.old_unaligned_file)
-    seqs_old = load_fasta(args.old_unaligned_file)
-    print_log("- Num Sequences: %s" % (len(seqs_old)))
-    print_log("Determining deltas between user table and old table...")
-    to_add, to_replace, to_delete, to_keep = determine_deltas(seqs_new, seqs_old)
-    print_log("- Add: %s" % len(to_add))
-    print_log("- Replace: %s" % len(to_replace))
-    print_log("- Delete: %s" % len(to_delete))
-    print_log("- Do nothing: %s" % (len(to_keep)))
-    print_log("Loading unchanged alignments from file: %s" % args.old_aligned_file)
-    aln_old = load_fasta(args.old_aligned_file)
-    print_log("Creating output alignment file: %s" % args.output_aligned_file)
-    with open_file(args.output_aligned_file, 'w') as out_aln_file:
-        print_log("Aligning new and updated sequences...")
-        run_cawlign(seqs_new, to_add, to_replace, out_aln_file, cawlign_path=args.cawlign_path, cawlign_args=args.cawlign_args)
-        print_log("Copying unchanged alignments...")
-        copy_unchanged_alignments(to_keep, aln_old, out_aln_file)
+    metrics = metrics_from_args(args, 'cawlign')
+    with metrics.phase('parse_user') as counts:
+        print_log("Loading user FASTA: %s" % args.fasta_file)
+        seqs_new = load_fasta(args.fasta_file, packed=True)
+        print_log("- Num Sequences: %s" % len(seqs_new))
+        print_log("Indexing user sequences...")
+        index_new = build_index(seqs_new); counts['sequences'] = len(seqs_new)
+    state = None
+    with metrics.phase('parse_old') as counts:
+        if args.state_db is not None:
+            print_log("Loading old sequence index from state store: %s" % args.state_db)
+            state = StateStore(args.state_db, 'cawlign'); index_old = state.load_index()
+        elif args.old_index_file is None:
+            print_log("Parsing old FASTA: %s" % args.old_unaligned_file)
+            index_old = build_index(iter_fasta(args.old_unaligned_file))
+        else:
+            print_log("Loading old sequence index: %s" % args.old_index_file)
+            index_old = load_index(args.old_index_file)
+        print_log("- Num Sequences: %s" % (len(index_old))); counts['sequences'] = len(index_old)
+    with metrics.phase('delta') as counts:
+        print_log("Determining deltas between user table and old table...")
+        to_add, to_replace, to_delete, to_keep = determine_deltas(index_new, index_old)
+        print_log("- Add: %s" % len(to_add))
+        print_log("- Replace: %s" % len(to_replace))
+        print_log("- Delete: %s" % len(to_delete))
+        print_log("- Do nothing: %s" % (len(to_keep)))
+        counts.update({'add': len(to_add), 'replace': len(to_replace), 'delete': len(to_delete), 'keep': len(to_keep)})
+    if state is not None:
+        with metrics.phase('external') as counts:
+            with NamedTemporaryFile(mode='w', suffix='.aln', delete=False) as tmp_aln_file:
+                print_log("Aligning new and updated sequences...")
+                align_new_updated(args, seqs_new, to_add, to_replace, tmp_aln_file, metrics=metrics)
+            counts['sequences'] = len(to_add) + len(to_replace)
+        with metrics.phase('copy') as counts:
+            print_log("Writing new and updated alignments to: %s" % args.output_aligned_file)
+            records = list()
+            with open_file(args.output_aligned_file, 'w') as out_aln_file:
+                if len(to_add) + len(to_replace) != 0: # (an empty alignment isn't a valid FASTA)
+                    for name, aln in iter_fasta(tmp_aln_file.name):
+                        records.append((name, '>%s\n%s\n' % (name, aln))); out_aln_file.write(records[-1][1])
+            remove(tmp_aln_file.name); counts['alignments'] = len(records)
+        with metrics.phase('update_state'):
+            print_log("Updating state store: %s" % args.state_db)
+            state.delete_records('fasta', to_delete); state.put_records('fasta', records)
+            state.update_index(index_new, to_add | to_replace, to_delete); state.close()
+    else:
+        # copy unchanged alignments into a staging part while cawlign runs (spliced into the output in the kernel if it's a plain file)
+        splice = args.output_aligned_file not in STDIO and not is_gzip_fn(args.output_aligned_file)
+        part_fn = new_part(args.output_aligned_file if splice else None)
+        def copy_part():
+            with metrics.phase('copy') as counts, open(part_fn, 'w') as part_file:
+                counts['alignments'] = copy_unchanged_alignments(to_keep, args.old_aligned_file, part_file)
+        try:
+            print_log("Creating output alignment file: %s" % args.output_aligned_file)
+            with open_file(args.output_aligned_file, 'w') as out_aln_file:
+                print_log("Copying unchanged alignments from %s to staging part: %s" % (args.old_aligned_file, part_fn))
+                copier = BackgroundTask(copy_part); copier.start()
+                try:
+                    with metrics.phase('external') as counts:
+                        print_log("Aligning new and updated sequences...")
+                        align_new_updated(args, seqs_new, to_add, to_replace, out_aln_file, metrics=metrics)
+                        counts['sequences'] = len(to_add) + len(to_replace)
+                finally:
+                    copier.join()
+                copier.wait()
+                if not splice:
+                    with metrics.phase('append_part'), open(part_fn) as part_file:
+                        print_log("Appending unchanged alignments...")
+                        copyfileobj(part_file, out_aln_file)
+            if splice:
+                with metrics.phase('append_part'):
+                    print_log("Appending unchanged alignments...")
+                    append_part(part_fn, args.output_aligned_file)
+        finally:
+            remove(part_fn)
+    if args.output_index_file is not None:
+        with metrics.phase('write_index') as counts:
+            print_log("Writing sequence index: %s" % args.output_index_file)
+            write_index(args.output_index_file, index_new); counts['sequences'] = len(index_new)
+    metrics.close()
 
 # run main program
 if __name__ == "__main__":
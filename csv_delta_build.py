@@ -4,35 +4,26 @@ Build a data structure to store what CSV entries are in the existing dataset
 '''
 
 # imports
-from gzip import open as gopen
+from csv_delta_digest import chunk_ranges, hash_chunk, new_structure, DigestSet, CHUNKS_PER_PROCESS, DIGEST_SET_SUFFIX
+from multiprocessing import get_context
 from os.path import isfile
-from niemabf import HashSet
 from sys import argv, stderr, stdin, stdout
+from true_append_io import open_file
 import argparse
 
 # constants
 HASH_FUNC = 'sha512_str'
 STDIO = {'stderr':stderr, 'stdin':stdin, 'stdout':stdout}
 
-# open file and return file object
-def open_file(fn, mode='r', text=True):
-    if fn in STDIO:
-        return STDIO[fn]
-    elif fn.lower().endswith('.gz'):
-        if mode == 'a':
-            raise NotImplementedError("Cannot append to gzip file")
-        if text:
-            mode += 't'
-        return gopen(fn, mode)
-    else:
-        return open(fn, mode)
-
 # parse user args
 def parse_args():
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-i', '--input_csv', required=False, type=str, default='stdin', help="Input Dataset (CSV)")
-    parser.add_argument('-o', '--output_structure', required=True, type=str, help="Output Structure (PKL)")
+    parser.add_argument('-o', '--output_structure', required=True, type=str, help="Output Structure (PKL, or %s for a compact digest set)" % DIGEST_SET_SUFFIX)
+    parser.add_argument('-p', '--processes', required=False, type=int, default=1, help="Number of processes for hashing (%s structure and plain input file only)" % DIGEST_SET_SUFFIX)
     args = parser.parse_args()
+    if args.processes < 1:
+        raise ValueError("Number of processes must be positive: %s" % args.processes)
     if not isfile(args.input_csv) and args.input_csv not in STDIO and not args.input_csv.startswith('/dev/fd'):
         raise ValueError("File not found: %s" % args.input_csv)
     if isfile(args.output_structure):
@@ -41,19 +32,34 @@ def parse_args():
 
 # build the data structure from a CSV
 # Argument: `csv_file` = file stream of the input CSV file
+# Argument: `output_fn` = filename the structure will be dumped to (its extension determines the structure type)
 # Return: `output_structure` = data structure representing the CSV entries from `csv_file`
-def build_data_structure(csv_file, hash_func=HASH_FUNC):
-    output_structure = HashSet()
+def build_data_structure(csv_file, output_fn, hash_func=HASH_FUNC):
+    output_structure = new_structure(output_fn, hash_func=hash_func)
     for line in csv_file:
         if 'ehars_uid' not in line: # skip header row
             output_structure.insert(line.strip())
     return output_structure
 
+# build the data structure from a CSV using multiple processes (each hashing a byte-range chunk of the CSV)
+# Argument: `csv_fn` = filename of the input CSV file (plain, not gzip/stream)
+# Argument: `processes` = number of processes
+# Return: `output_structure` = `DigestSet` representing the CSV entries from `csv_fn`
+def build_data_structure_parallel(csv_fn, processes):
+    tasks = [(csv_fn, start, end, True) for start, end in chunk_ranges(csv_fn, processes * CHUNKS_PER_PROCESS)]
+    with get_context('fork').Pool(processes) as pool:
+        digests = [chunk_digests for chunk_digests, starts, ends in pool.imap(hash_chunk, tasks)]
+    output_structure = DigestSet(); output_structure.insert_digests(b''.join(digests))
+    return output_structure
+
 # main program
 def main():
     args = parse_args()
-    with open_file(args.input_csv, 'r') as csv_file:
-        output_structure = build_data_structure(csv_file, hash_func=HASH_FUNC)
+    if args.processes > 1 and args.output_structure.lower().endswith(DIGEST_SET_SUFFIX) and isfile(args.input_csv) and not args.input_csv.lower().endswith('.gz'):
+        output_structure = build_data_structure_parallel(args.input_csv, args.processes)
+    else:
+        with open_file(args.input_csv, 'r') as csv_file:
+            output_structure = build_data_structure(csv_file, args.output_structure, hash_func=HASH_FUNC)
     output_structure.dump(args.output_structure)
 
 # run main program
@@ -6,36 +6,28 @@ as well as a copy of the input data structure but with matched entries removed (
 '''
 
 # imports
-from gzip import open as gopen
-from niemabf import HashSet
+from csv_delta_digest import chunk_ranges, hash_chunk, load_structure, DigestSet, CHUNKS_PER_PROCESS, DIGEST_SET_SUFFIX
+from multiprocessing import get_context
 from os.path import isfile
 from sys import argv, stderr, stdin, stdout
+from true_append_io import open_file
 import argparse
+import numpy as np
 
 # constants
 STDIO = {'stderr':stderr, 'stdin':stdin, 'stdout':stdout}
 
-# open file and return file object
-def open_file(fn, mode='r', text=True):
-    if fn in STDIO:
-        return STDIO[fn]
-    elif fn.lower().endswith('.gz'):
-        if mode == 'a':
-            raise NotImplementedError("Cannot append to gzip file")
-        if text:
-            mode += 't'
-        return gopen(fn, mode)
-    else:
-        return open(fn, mode)
-
 # parse user args
 def parse_args():
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-ic', '--input_csv', required=False, type=str, default='stdin', help="Input Dataset (CSV)")
-    parser.add_argument('-is', '--input_structure', required=True, type=str, help="Input Structure (PKL)")
+    parser.add_argument('-is', '--input_structure', required=True, type=str, help="Input Structure (PKL, or %s for a compact digest set)" % DIGEST_SET_SUFFIX)
     parser.add_argument('-oc', '--output_csv', required=False, type=str, default='stdout', help="Output Dataset (CSV)")
-    parser.add_argument('-os', '--output_structure', required=True, type=str, help="Output Structure (PKL)")
+    parser.add_argument('-os', '--output_structure', required=True, type=str, help="Output Structure (PKL, or %s for a compact digest set)" % DIGEST_SET_SUFFIX)
+    parser.add_argument('-p', '--processes', required=False, type=int, default=1, help="Number of processes for hashing (%s structure and plain input file only)" % DIGEST_SET_SUFFIX)
     args = parser.parse_args()
+    if args.processes < 1:
+        raise ValueError("Number of processes must be positive: %s" % args.processes)
     for fn in [args.input_csv, args.input_structure]:
         if not isfile(fn) and fn not in STDIO and not fn.startswith('/dev/fd'):
             raise ValueError("File not found: %s" % fn)
@@ -57,13 +49,32 @@ def prune_csv(input_csv_file, input_structure, output_csv_file):
             output_csv_file.write(l + '\n')
     output_csv_file.flush()
 
+# prune old entries from the input CSV using multiple processes (each hashing a byte-range chunk of the CSV)
+# Argument: `input_csv_fn` = filename of the input CSV file (plain, not gzip/stream)
+# Argument: `input_structure` = `DigestSet` representing the CSV entries from the old CSV
+# Argument: `output_csv_file` = file stream of the output pruned CSV file containing only new and updated entries
+# Argument: `processes` = number of processes
+def prune_csv_parallel(input_csv_fn, input_structure, output_csv_file, processes):
+    tasks = [(input_csv_fn, start, end, False) for start, end in chunk_ranges(input_csv_fn, processes * CHUNKS_PER_PROCESS)]
+    with open(input_csv_fn, 'rb') as input_csv_file, get_context('fork').Pool(processes) as pool:
+        for digests, starts, ends in pool.imap(hash_chunk, tasks): # chunks are merged in file order
+            found = input_structure.discard_digests(digests) # exists in data structure (so unchanged entry = prune)
+            for i in np.flatnonzero(~found): # doesn't exist in data structure (so new/updated entry or header line = include in output)
+                input_csv_file.seek(starts[i])
+                output_csv_file.write(input_csv_file.read(ends[i] - starts[i]).decode().strip() + '\n')
+    output_csv_file.flush()
+
 # main program
 def main():
     args = parse_args()
-    structure = HashSet.load(args.input_structure)
-    with open_file(args.input_csv, 'r') as input_csv_file:
+    structure = load_structure(args.input_structure)
+    if args.processes > 1 and isinstance(structure, DigestSet) and isfile(args.input_csv) and not args.input_csv.lower().endswith('.gz'):
         with open_file(args.output_csv, 'w') as output_csv_file:
-            prune_csv(input_csv_file, structure, output_csv_file)
+            prune_csv_parallel(args.input_csv, structure, output_csv_file, args.processes)
+    else:
+        with open_file(args.input_csv, 'r') as input_csv_file:
+            with open_file(args.output_csv, 'w') as output_csv_file:
+                prune_csv(input_csv_file, structure, output_csv_file)
     structure.dump(args.output_structure)
 
 # run main program
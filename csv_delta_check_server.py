@@ -4,33 +4,20 @@ Use a data structure built by csv_delta_check_client.py to check what CSV entrie
 '''
 
 # imports
-from gzip import open as gopen
-from niemabf import HashSet
+from csv_delta_digest import load_structure, DIGEST_SET_SUFFIX
 from os.path import isfile
 from sys import argv, stderr, stdin, stdout
+from true_append_io import open_file
 import argparse
 
 # constants
 STDIO = {'stderr':stderr, 'stdin':stdin, 'stdout':stdout}
 
-# open file and return file object
-def open_file(fn, mode='r', text=True):
-    if fn in STDIO:
-        return STDIO[fn]
-    elif fn.lower().endswith('.gz'):
-        if mode == 'a':
-            raise NotImplementedError("Cannot append to gzip file")
-        if text:
-            mode += 't'
-        return gopen(fn, mode)
-    else:
-        return open(fn, mode)
-
 # parse user args
 def parse_args():
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-ic', '--input_csv', required=False, type=str, default='stdin', help="Input Old Dataset (CSV)")
-    parser.add_argument('-is', '--input_structure', required=True, type=str, help="Input Pruned Structure (PKL)")
+    parser.add_argument('-is', '--input_structure', required=True, type=str, help="Input Pruned Structure (PKL, or %s for a compact digest set)" % DIGEST_SET_SUFFIX)
     parser.add_argument('-o', '--output_csv', required=False, type=str, default='stdout', help="Output Removed Entries (CSV)")
     args = parser.parse_args()
     for fn in [args.input_csv, args.input_structure]:
@@ -55,7 +42,7 @@ def determine_removed(input_csv_file, input_structure):
 # main program
 def main():
     args = parse_args()
-    structure = HashSet.load(args.input_structure)
+    structure = load_structure(args.input_structure)
     with open_file(args.input_csv, 'r') as input_csv_file:
         removed = determine_removed(input_csv_file, structure)
     with open_file(args.output_csv, 'w') as output_csv_file:
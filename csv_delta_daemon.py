@@ -0,0 +1,182 @@
+#! /usr/bin/env python3
+'''
+Keep a CSV delta data structure resident in memory and answer streamed batch queries over a local Unix socket
+
+Each connection sends one command line, optionally followed by CSV lines (until the client shuts down its side of the socket):
+  ADD           insert the CSV entries (header rows are skipped, as in csv_delta_build.py)
+  CHECK         reply 1 or 0 per CSV entry (whether it exists in the structure)
+  REMOVE        remove the CSV entries that exist in the structure, and reply the ones that don't (as in csv_delta_check_client.py)
+  LIST_REMOVED  reply the (old) CSV entries that still exist in the (pruned) structure (as in csv_delta_check_server.py)
+  DUMP <path>   dump the structure (default: the file it was loaded from)
+  RELOAD        reload the structure from the file it was loaded from
+  SHUTDOWN      stop the daemon
+Reply data lines are prefixed with 'D', and every reply ends with a status line ('OK ...' or 'ERROR ...').
+The structure is locked per batch of CSV entries (not per connection), so the streamed commands of concurrent
+connections interleave batch by batch, and socket I/O never blocks other connections.
+'''
+
+# imports
+from csv_delta_digest import entry_digest, load_structure, DigestSet, DIGEST_SET_SUFFIX
+from datetime import datetime
+from os import remove
+from os.path import exists, isfile
+from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+from sys import argv, stderr
+from threading import Lock, Thread
+import argparse
+
+# constants
+BATCH_SIZE = 4096 # CSV entries per membership batch
+PAYLOAD_COMMANDS = {'ADD', 'CHECK', 'REMOVE', 'LIST_REMOVED'}
+COMMANDS = PAYLOAD_COMMANDS | {'DUMP', 'RELOAD', 'SHUTDOWN'}
+
+# return the current time as a string
+def get_time():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+# print to log (prefixed by current time)
+def print_log(s='', end='\n'):
+    print("[%s] %s" % (get_time(), s), file=stderr, end=end); stderr.flush()
+
+# parse user args
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-is', '--input_structure', required=True, type=str, help="Input Structure (PKL, or %s for a compact digest set)" % DIGEST_SET_SUFFIX)
+    parser.add_argument('-s', '--socket', required=True, type=str, help="Unix Socket Path")
+    args = parser.parse_args()
+    if not isfile(args.input_structure):
+        raise ValueError("File not found: %s" % args.input_structure)
+    if exists(args.socket):
+        raise ValueError("File exists: %s" % args.socket)
+    return args
+
+# iterate over batches of CSV entries from a binary stream
+def iter_batches(infile, batch_size=BATCH_SIZE):
+    batch = list()
+    for line in infile:
+        batch.append(line.decode().strip())
+        if len(batch) == batch_size:
+            yield batch; batch = list()
+    if len(batch) != 0:
+        yield batch
+
+# check which CSV entries of a batch exist in a structure
+# Return: `list` of `bool` (one per entry)
+def check_batch(structure, batch):
+    if isinstance(structure, DigestSet):
+        return structure.contains_digests(b''.join(entry_digest(l) for l in batch)).tolist()
+    return [l in structure for l in batch]
+
+# remove the CSV entries of a batch that exist in a structure (in order, so only the first of repeated entries)
+# Return: `list` of `bool` (one per entry: `True` if it was removed)
+def remove_batch(structure, batch):
+    if isinstance(structure, DigestSet):
+        return structure.discard_digests(b''.join(entry_digest(l) for l in batch)).tolist()
+    out = list()
+    for l in batch:
+        found = l in structure
+        if found:
+            structure.remove(l)
+        out.append(found)
+    return out
+
+# handle one client connection
+class CSVDeltaHandler(StreamRequestHandler):
+    def handle(self):
+        command = self.rfile.readline().decode().strip().split(' ', 1)
+        if command[0] not in COMMANDS:
+            self.wfile.write(("ERROR Invalid command: %s\n" % command[0]).encode()); return
+        server = self.server
+        try:
+            status = getattr(self, 'handle_%s' % command[0].lower())(server, None if len(command) == 1 else command[1])
+        except Exception as e:
+            print_log("%s failed: %s" % (command[0], e))
+            self.wfile.write(("ERROR %s\n" % str(e).replace('\n', ' ')).encode()); return
+        print_log("%s: %s" % (command[0], status))
+        self.wfile.write(("OK %s\n" % status).encode())
+
+    # write reply data lines
+    def write_data(self, lines):
+        if len(lines) != 0:
+            self.wfile.write(''.join('D%s\n' % l for l in lines).encode())
+
+    def handle_add(self, server, arg):
+        num_added = 0
+        for batch in iter_batches(self.rfile):
+            batch = [l for l in batch if 'ehars_uid' not in l] # skip header rows
+            with server.lock:
+                for l in batch:
+                    server.structure.insert(l)
+            num_added += len(batch)
+        return "%d entries inserted" % num_added
+
+    def handle_check(self, server, arg):
+        num_checked = 0; num_found = 0
+        for batch in iter_batches(self.rfile):
+            with server.lock:
+                found = check_batch(server.structure, batch)
+            self.write_data(['1' if f else '0' for f in found])
+            num_checked += len(batch); num_found += sum(found)
+        return "%d checked, %d found" % (num_checked, num_found)
+
+    def handle_remove(self, server, arg):
+        num_removed = 0; num_kept = 0
+        for batch in iter_batches(self.rfile):
+            with server.lock:
+                removed = remove_batch(server.structure, batch)
+            kept = [l for l, r in zip(batch, removed) if not r]
+            self.write_data(kept); num_removed += len(batch) - len(kept); num_kept += len(kept)
+        return "%d removed, %d new/updated" % (num_removed, num_kept)
+
+    def handle_list_removed(self, server, arg):
+        seen = set()
+        for batch in iter_batches(self.rfile):
+            with server.lock:
+                found = check_batch(server.structure, batch)
+            new = list()
+            for l, f in zip(batch, found):
+                if f and l not in seen:
+                    seen.add(l); new.append(l)
+            self.write_data(new)
+        return "%d removed entries" % len(seen)
+
+    def handle_dump(self, server, arg):
+        fn = server.structure_fn if arg is None else arg.strip()
+        with server.lock:
+            server.structure.dump(fn); num_entries = len(server.structure)
+        return "dumped %d entries to %s" % (num_entries, fn)
+
+    def handle_reload(self, server, arg):
+        structure = load_structure(server.structure_fn) # (loaded outside the lock, so batches of other connections continue meanwhile)
+        with server.lock:
+            server.structure = structure
+        return "reloaded %d entries from %s" % (len(structure), server.structure_fn)
+
+    def handle_shutdown(self, server, arg):
+        Thread(target=server.shutdown).start() # `shutdown` blocks until `serve_forever` returns, so it can't be called from a handler thread directly
+        return "shutting down"
+
+# CSV delta daemon (one structure shared by all connections; batches are serialized by `lock`)
+class CSVDeltaServer(ThreadingUnixStreamServer):
+    daemon_threads = True
+    def __init__(self, socket_fn, structure_fn):
+        self.structure_fn = structure_fn; self.structure = load_structure(structure_fn); self.lock = Lock()
+        super().__init__(socket_fn, CSVDeltaHandler)
+
+# main program
+def main():
+    args = parse_args()
+    print_log("Command: %s" % ' '.join(argv))
+    print_log("Loading structure: %s" % args.input_structure)
+    server = CSVDeltaServer(args.socket, args.input_structure)
+    print_log("- Num Entries: %s" % len(server.structure))
+    print_log("Listening on: %s" % args.socket)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close(); remove(args.socket)
+    print_log("Daemon stopped")
+
+# run main program
+if __name__ == "__main__":
+    main()
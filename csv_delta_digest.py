@@ -0,0 +1,215 @@
+'''
+Compact sorted-digest store for the CSV delta scripts (a drop-in replacement for `niemabf.HashSet`)
+
+Each CSV entry is stored as a fixed-width 128-bit digest (two `uint64` halves), sorted so membership is a binary search.
+`remove` only sets a bit in a tombstone bitmap, so a loaded structure is never rewritten in place.
+The file (header, sorted `hi` halves, matching `lo` halves, tombstone bitmap) is memory-mapped on load,
+so loading takes constant time regardless of the number of entries.
+'''
+
+# imports
+from hashlib import blake2b
+from os import replace
+from os.path import getsize
+import numpy as np
+
+# constants
+DIGEST_SET_MAGIC = b'CSVDGST\0'
+DIGEST_SET_VERSION = 1
+DIGEST_SET_SUFFIX = '.dgs'
+DIGEST_SIZE = 16 # bytes (two uint64 halves)
+HEADER_DTYPE = np.dtype([('magic', 'S8'), ('version', '<u4'), ('reserved', '<u4'), ('num_entries', '<u8'), ('num_removed', '<u8')])
+HALF_DTYPE = np.dtype('<u8')
+CHUNKS_PER_PROCESS = 4 # more chunks than processes to balance the load
+
+# compute the digest of a CSV entry
+def entry_digest(x):
+    return blake2b(x.encode(), digest_size=DIGEST_SIZE).digest()
+
+# split concatenated digests into `hi` and `lo` halves
+# Argument: `digests` = `bytes` of concatenated `DIGEST_SIZE`-byte digests
+# Return: `hi` and `lo` halves (NumPy `uint64` arrays)
+def split_digests(digests):
+    halves = np.frombuffer(digests, dtype=HALF_DTYPE).reshape(-1, 2)
+    return halves[:,0], halves[:,1]
+
+# split a file into byte-range chunks aligned to line boundaries
+# Argument: `fn` = filename of a plain (uncompressed) file
+# Argument: `num_chunks` = maximum number of chunks
+# Return: `list` of (start, end) byte ranges covering `fn` in order
+def chunk_ranges(fn, num_chunks):
+    size = getsize(fn); bounds = [0]
+    with open(fn, 'rb') as f:
+        for i in range(1, num_chunks):
+            pos = size * i // num_chunks
+            if pos <= bounds[-1]:
+                continue
+            f.seek(pos - 1); f.readline() # finish the line containing byte `pos - 1`
+            pos = f.tell()
+            if pos >= size:
+                break
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    bounds.append(size)
+    return [(bounds[i], bounds[i+1]) for i in range(len(bounds)-1) if bounds[i] < bounds[i+1]]
+
+# hash the lines of a byte-range chunk of a file (run in worker processes)
+# Argument: `task` = (filename, start, end, skip_header) tuple, where `skip_header` skips lines containing 'ehars_uid'
+# Return: `bytes` of concatenated line digests, and NumPy `int64` arrays of the lines' start and end offsets
+def hash_chunk(task):
+    fn, start, end, skip_header = task; digests = list(); starts = list(); ends = list()
+    with open(fn, 'rb') as f:
+        f.seek(start); pos = start
+        while pos < end:
+            line = f.readline()
+            if len(line) == 0:
+                break
+            if not (skip_header and b'ehars_uid' in line):
+                digests.append(entry_digest(line.decode().strip())); starts.append(pos); ends.append(pos + len(line))
+            pos += len(line)
+    return b''.join(digests), np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+
+# Digest Set class (only stores digests, not actual elements)
+class DigestSet:
+    # initialize a new (empty) Digest Set
+    def __init__(self):
+        self.hi = np.empty(0, dtype=HALF_DTYPE); self.lo = np.empty(0, dtype=HALF_DTYPE)
+        self.tombstones = np.zeros(0, dtype=np.uint8); self.num_removed = 0
+        self.pending = set() # digests inserted since the structure was sorted
+
+    # return the total number of elements in this Digest Set
+    def __len__(self):
+        return len(self.hi) - self.num_removed + len(self.pending)
+
+    # return the sorted indices of the given digests (-1 if absent or removed)
+    # Argument: `hi` and `lo` = digest halves to find (NumPy `uint64` arrays)
+    def find_indices(self, hi, lo):
+        left = np.searchsorted(self.hi, hi, side='left'); right = np.searchsorted(self.hi, hi, side='right')
+        inds = np.full(len(hi), -1, dtype=np.int64)
+        single = (right - left == 1) & (self.lo[np.minimum(left, len(self.lo)-1)] == lo) if len(self.lo) != 0 else np.zeros(len(hi), dtype=bool)
+        inds[single] = left[single]
+        for i in np.flatnonzero(right - left > 1): # `hi` collisions (extremely rare)
+            run = np.flatnonzero(self.lo[left[i]:right[i]] == lo[i])
+            if len(run) != 0:
+                inds[i] = left[i] + run[0]
+        found = inds != -1
+        removed = np.zeros(len(hi), dtype=bool)
+        removed[found] = (self.tombstones[inds[found] >> 3] >> (inds[found] & 7).astype(np.uint8)) & 1 == 1
+        inds[removed] = -1
+        return inds
+
+    # find many digests at once
+    # Argument: `digests` = `bytes` of concatenated digests (see `entry_digest`)
+    # Return: NumPy `bool` array (`True` if the corresponding digest exists in this Digest Set)
+    def contains_digests(self, digests):
+        out = self.find_indices(*split_digests(digests)) != -1
+        if len(self.pending) != 0:
+            for i in np.flatnonzero(~out):
+                out[i] = digests[i*DIGEST_SIZE:(i+1)*DIGEST_SIZE] in self.pending
+        return out
+
+    # insert many digests at once
+    # Argument: `digests` = `bytes` of concatenated digests (see `entry_digest`)
+    def insert_digests(self, digests):
+        if len(self.hi) != 0 or len(self.pending) != 0:
+            for i in range(0, len(digests), DIGEST_SIZE):
+                digest = digests[i:i+DIGEST_SIZE]
+                if not self.contains_digests(digest)[0]:
+                    self.pending.add(digest)
+        elif len(digests) != 0: # empty, so just sort (and deduplicate) the new digests
+            hi, lo = split_digests(digests); order = np.lexsort((lo, hi)); hi = hi[order]; lo = lo[order]
+            unique = np.ones(len(hi), dtype=bool); unique[1:] = (hi[1:] != hi[:-1]) | (lo[1:] != lo[:-1])
+            self.hi = hi[unique]; self.lo = lo[unique]; self.tombstones = np.zeros((len(self.hi)+7) // 8, dtype=np.uint8)
+
+    # remove many digests at once, in order (absent digests are ignored)
+    # Argument: `digests` = `bytes` of concatenated digests (see `entry_digest`)
+    # Return: NumPy `bool` array (`True` if the corresponding digest was removed, so only the first of repeated digests)
+    def discard_digests(self, digests):
+        inds = self.find_indices(*split_digests(digests)); out = inds != -1
+        found = np.flatnonzero(out); inds, first = np.unique(inds[found], return_index=True)
+        out[found] = False; out[found[first]] = True
+        if len(inds) != 0:
+            np.bitwise_or.at(self.tombstones, inds >> 3, np.left_shift(1, inds & 7).astype(np.uint8))
+            self.num_removed += len(inds)
+        if len(self.pending) != 0:
+            for i in np.flatnonzero(~out):
+                digest = digests[i*DIGEST_SIZE:(i+1)*DIGEST_SIZE]
+                if digest in self.pending:
+                    self.pending.remove(digest); out[i] = True
+        return out
+
+    # insert an element into this Digest Set
+    def insert(self, x):
+        digest = entry_digest(x)
+        if len(self.hi) == 0 or not self.contains_digests(digest)[0]:
+            self.pending.add(digest)
+
+    # remove an element from this Digest Set (raise `KeyError` if it doesn't exist)
+    def remove(self, x):
+        if not self.discard_digests(entry_digest(x))[0]:
+            raise KeyError(x)
+
+    # discard an element from this Digest Set (if it exists)
+    def discard(self, x):
+        self.discard_digests(entry_digest(x))
+
+    # find an element in this Digest Set
+    def find(self, x):
+        return bool(self.contains_digests(entry_digest(x))[0])
+
+    # overload the `in` operator (just call `find`)
+    def __contains__(self, x):
+        return self.find(x)
+
+    # dump this Digest Set into a file
+    # Argument: `fn` = output filename
+    # Argument: `compact` = `True` to drop removed digests (otherwise, keep them as tombstones)
+    def dump(self, fn, compact=True):
+        hi = self.hi; lo = self.lo; tombstones = self.tombstones; num_removed = self.num_removed
+        if compact and num_removed != 0:
+            live = np.unpackbits(tombstones, count=len(hi), bitorder='little') == 0
+            hi = hi[live]; lo = lo[live]; tombstones = np.zeros((len(hi)+7) // 8, dtype=np.uint8); num_removed = 0
+        if len(self.pending) != 0:
+            pending_hi, pending_lo = split_digests(b''.join(self.pending))
+            hi = np.concatenate([hi, pending_hi]); lo = np.concatenate([lo, pending_lo])
+            order = np.lexsort((lo, hi)); hi = hi[order]; lo = lo[order]
+            removed = np.zeros(len(order), dtype=np.uint8)
+            if num_removed != 0:
+                removed[:len(order)-len(pending_hi)] = np.unpackbits(tombstones, count=len(order)-len(pending_hi), bitorder='little')
+            tombstones = np.packbits(removed[order], bitorder='little')
+        header = np.zeros(1, dtype=HEADER_DTYPE)
+        header['magic'] = DIGEST_SET_MAGIC; header['version'] = DIGEST_SET_VERSION
+        header['num_entries'] = len(hi); header['num_removed'] = num_removed
+        tmp_fn = '%s.tmp' % fn # write then rename, in case `fn` is the memory-mapped input
+        with open(tmp_fn, 'wb') as f:
+            f.write(header.tobytes()); f.write(hi.tobytes()); f.write(lo.tobytes()); f.write(tombstones.tobytes())
+        replace(tmp_fn, fn)
+
+    # load a Digest Set from a file (memory-mapped copy-on-write, so removals are never written back to the file)
+    # Argument: `fn` = input filename
+    @classmethod
+    def load(cls, fn):
+        header = np.fromfile(fn, dtype=HEADER_DTYPE, count=1)
+        if len(header) != 1 or header['magic'][0] != DIGEST_SET_MAGIC.rstrip(b'\0') or header['version'][0] != DIGEST_SET_VERSION:
+            raise ValueError("Invalid digest set file: %s" % fn)
+        num_entries = int(header['num_entries'][0]); offset = HEADER_DTYPE.itemsize
+        out = cls(); out.num_removed = int(header['num_removed'][0])
+        if num_entries != 0:
+            out.hi = np.memmap(fn, dtype=HALF_DTYPE, mode='r', offset=offset, shape=(num_entries,)); offset += 8*num_entries
+            out.lo = np.memmap(fn, dtype=HALF_DTYPE, mode='r', offset=offset, shape=(num_entries,)); offset += 8*num_entries
+            out.tombstones = np.memmap(fn, dtype=np.uint8, mode='c', offset=offset, shape=((num_entries+7) // 8,))
+        return out
+
+# create an empty CSV delta structure of the type given by its filename (`DIGEST_SET_SUFFIX` = `DigestSet`, otherwise PKL `niemabf.HashSet`)
+def new_structure(fn, hash_func='sha512_str'):
+    if fn.lower().endswith(DIGEST_SET_SUFFIX):
+        return DigestSet()
+    from niemabf import HashSet
+    return HashSet(hash_func=hash_func)
+
+# load a CSV delta structure of the type given by its filename (`DIGEST_SET_SUFFIX` = `DigestSet`, otherwise PKL `niemabf.HashSet`)
+def load_structure(fn):
+    if fn.lower().endswith(DIGEST_SET_SUFFIX):
+        return DigestSet.load(fn)
+    from niemabf import HashSet
+    return HashSet.load(fn)
@@ -0,0 +1,121 @@
+#! /usr/bin/env python3
+'''
+Build a keyed index of what CSV entries are in the existing dataset (one line per key: row digest and per-column digests),
+for csv_delta_keyed_check.py to classify user-uploaded rows as add/replace/delete/keep by key instead of by whole line
+'''
+
+# imports
+from csv import reader
+from hashlib import blake2b
+from os.path import isfile
+from sys import stderr, stdin, stdout
+from true_append_io import open_file
+import argparse
+
+# constants
+KEYED_INDEX_VERSION = 1
+KEYED_INDEX_HEADER = '#csv_delta_keyed_index\tv%d' % KEYED_INDEX_VERSION
+ROW_DIGEST_SIZE = 16 # bytes (so 32 hex characters)
+COL_DIGEST_SIZE = 8 # bytes (so 16 hex characters)
+DEFAULT_KEY_COL = 'ehars_uid'
+STDIO = {'stderr':stderr, 'stdin':stdin, 'stdout':stdout}
+
+# parse user args
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--input_csv', required=False, type=str, default='stdin', help="Input Dataset (CSV)")
+    parser.add_argument('-o', '--output_index', required=True, type=str, help="Output Keyed Index (TSV)")
+    parser.add_argument('-k', '--key_col', required=False, type=str, default=DEFAULT_KEY_COL, help="Key Column")
+    args = parser.parse_args()
+    if not isfile(args.input_csv) and args.input_csv not in STDIO and not args.input_csv.startswith('/dev/fd'):
+        raise ValueError("File not found: %s" % args.input_csv)
+    if isfile(args.output_index):
+        raise ValueError("File exists: %s" % args.output_index)
+    return args
+
+# compute the digest of a whole row (excluding its key)
+# Argument: `values` = `list` of the row's non-key values (in column order)
+def row_digest(values):
+    return blake2b('\x1f'.join(values).encode(), digest_size=ROW_DIGEST_SIZE).hexdigest()
+
+# compute the concatenated per-column digests of a row (excluding its key)
+# Argument: `values` = `list` of the row's non-key values (in column order)
+def col_digests(values):
+    return ''.join(blake2b(v.encode(), digest_size=COL_DIGEST_SIZE).hexdigest() for v in values)
+
+# iterate over the keyed rows of a CSV
+# Argument: `csv_file` = file stream of the CSV file (with a header row)
+# Argument: `key_col` = name of the key column
+# Return: header, non-key column names, and a generator of (key, non-key values, row) tuples
+def iter_keyed_rows(csv_file, key_col=DEFAULT_KEY_COL):
+    rows = reader(csv_file)
+    try:
+        header = next(rows)
+    except StopIteration:
+        raise ValueError("Empty CSV file")
+    if key_col not in header:
+        raise ValueError("Key column (%s) not found in CSV header" % key_col)
+    key_ind = header.index(key_col)
+    cols = header[:key_ind] + header[key_ind+1:]
+    def generator():
+        keys = set()
+        for row in rows:
+            if len(row) == 0:
+                continue
+            if len(row) != len(header):
+                raise ValueError("Row of key %s has %d columns (header has %d)" % (row[key_ind] if key_ind < len(row) else '?', len(row), len(header)))
+            key = row[key_ind].strip()
+            if key in keys:
+                raise ValueError("Duplicate key: %s" % key)
+            keys.add(key)
+            yield key, row[:key_ind] + row[key_ind+1:], row
+    return header, cols, generator()
+
+# build the keyed index from a CSV
+# Argument: `csv_file` = file stream of the input CSV file
+# Argument: `key_col` = name of the key column
+# Return: non-key column names, and a `dict` where keys are CSV keys and values are (row digest, per-column digests) tuples
+def build_keyed_index(csv_file, key_col=DEFAULT_KEY_COL):
+    header, cols, rows = iter_keyed_rows(csv_file, key_col=key_col)
+    return cols, {key: (row_digest(values), col_digests(values)) for key, values, row in rows}
+
+# load a keyed index
+# Argument: `fn` = filename of the keyed index
+# Return: key column name, non-key column names, and a `dict` where keys are CSV keys and values are (row digest, per-column digests) tuples
+def load_keyed_index(fn):
+    index = dict()
+    with open_file(fn) as index_file:
+        header = index_file.readline().rstrip('\n').split('\t')
+        if len(header) != 3 or '\t'.join(header[:2]) != KEYED_INDEX_HEADER:
+            raise ValueError("Invalid keyed index header: %s" % fn)
+        cols = index_file.readline().rstrip('\n').split('\t')
+        if cols[0] != '#columns':
+            raise ValueError("Invalid keyed index header: %s" % fn)
+        for line in index_file:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) != 3:
+                raise ValueError("Malformed keyed index: %s" % fn)
+            index[parts[0]] = (parts[1], parts[2])
+    return header[2], cols[1:], index
+
+# write a keyed index
+# Argument: `fn` = filename of the keyed index
+# Argument: `key_col` = name of the key column
+# Argument: `cols` = non-key column names
+# Argument: `index` = `dict` where keys are CSV keys and values are (row digest, per-column digests) tuples
+def write_keyed_index(fn, key_col, cols, index):
+    with open_file(fn, 'w') as index_file:
+        index_file.write('%s\t%s\n#columns\t%s\n' % (KEYED_INDEX_HEADER, key_col, '\t'.join(cols)))
+        for key, (digest, digests) in index.items():
+            index_file.write('%s\t%s\t%s\n' % (key, digest, digests))
+
+# main program
+def main():
+    args = parse_args()
+    with open_file(args.input_csv, 'r') as csv_file:
+        cols, index = build_keyed_index(csv_file, key_col=args.key_col)
+    write_keyed_index(args.output_index, args.key_col, cols, index)
+
+# run main program
+if __name__ == "__main__":
+    main()
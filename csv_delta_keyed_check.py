@@ -0,0 +1,102 @@
+#! /usr/bin/env python3
+'''
+Use a keyed index built by csv_delta_keyed_build.py to classify the user-uploaded CSV rows by key as add/replace/delete/keep,
+and output a manifest (key, action, and optionally a bitmask of changed columns),
+as well as (optionally) a CSV of just the added and replaced rows
+'''
+
+# imports
+from csv import writer
+from csv_delta_keyed_build import col_digests, iter_keyed_rows, load_keyed_index, row_digest, COL_DIGEST_SIZE
+from os.path import isfile
+from sys import stderr, stdin, stdout
+from true_append_io import open_file
+import argparse
+
+# constants
+STDIO = {'stderr':stderr, 'stdin':stdin, 'stdout':stdout}
+
+# parse user args
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-ic', '--input_csv', required=False, type=str, default='stdin', help="Input Dataset (CSV)")
+    parser.add_argument('-ii', '--input_index', required=True, type=str, help="Input Keyed Index (TSV)")
+    parser.add_argument('-o', '--output_manifest', required=False, type=str, default='stdout', help="Output Manifest (CSV)")
+    parser.add_argument('-oc', '--output_csv', required=False, type=str, default=None, help="Output Added and Replaced Rows (CSV)")
+    parser.add_argument('-m', '--changed_mask', action='store_true', help="Include a bitmask of changed columns for replaced rows (bit i = column i of the user CSV header)")
+    args = parser.parse_args()
+    for fn in [args.input_csv, args.input_index]:
+        if not isfile(fn) and fn not in STDIO and not fn.startswith('/dev/fd'):
+            raise ValueError("File not found: %s" % fn)
+    for fn in [args.output_manifest, args.output_csv]:
+        if fn is not None and isfile(fn):
+            raise ValueError("File exists: %s" % fn)
+    return args
+
+# compute the bitmask of changed columns of a row
+# Argument: `new_digests` = concatenated per-column digests of the new row (in new column order)
+# Argument: `old_digests` = concatenated per-column digests of the old row (in old column order)
+# Argument: `col_map` = `list` of (bit, old column index or `None`) tuples (one per new non-key column)
+# Argument: `empty_digest` = digest of an empty value (for columns that didn't exist in the old CSV)
+def changed_mask(new_digests, old_digests, col_map, empty_digest):
+    w = 2*COL_DIGEST_SIZE; mask = 0
+    for i, (bit, old_i) in enumerate(col_map):
+        old_digest = empty_digest if old_i is None else old_digests[old_i*w:(old_i+1)*w]
+        if new_digests[i*w:(i+1)*w] != old_digest:
+            mask |= 1 << bit
+    return mask
+
+# classify the rows of the user CSV
+# Argument: `input_csv_file` = file stream of the user CSV file
+# Argument: `key_col` = name of the key column
+# Argument: `old_cols` = non-key column names of the old CSV
+# Argument: `index` = keyed index of the old CSV
+# Argument: `manifest_file` = file stream of the output manifest CSV
+# Argument: `output_csv_file` = file stream of the output added/replaced rows CSV (or `None`)
+# Argument: `mask` = `True` to include the bitmask of changed columns
+# Return: `dict` with the number of rows per action
+def classify_rows(input_csv_file, key_col, old_cols, index, manifest_file, output_csv_file=None, mask=False):
+    header, cols, rows = iter_keyed_rows(input_csv_file, key_col=key_col)
+    key_ind = header.index(key_col); old_col_inds = {c:i for i, c in enumerate(old_cols)}
+    col_map = [(i if i < key_ind else i+1, old_col_inds.get(c)) for i, c in enumerate(cols)] # mask bits are user CSV header columns
+    same_cols = cols == old_cols # row digests are only comparable if the non-key columns match
+    empty_digest = col_digests([''])
+    manifest = writer(manifest_file, lineterminator='\n'); manifest.writerow(['key', 'action'] + (['changed_mask'] if mask else []))
+    out = None
+    if output_csv_file is not None:
+        out = writer(output_csv_file, lineterminator='\n'); out.writerow(header)
+    counts = {'add':0, 'replace':0, 'delete':0, 'keep':0}; seen = set()
+    for key, values, row in rows:
+        seen.add(key); row_mask = 0
+        if key not in index:
+            action = 'add'
+        elif same_cols and row_digest(values) == index[key][0]:
+            action = 'keep'
+        else: # compare column by column (removed columns are ignored)
+            row_mask = changed_mask(col_digests(values), index[key][1], col_map, empty_digest)
+            action = 'replace' if row_mask != 0 else 'keep'
+        counts[action] += 1
+        manifest.writerow([key, action] + ([('%x' % row_mask) if action == 'replace' else ''] if mask else []))
+        if out is not None and action != 'keep':
+            out.writerow(row)
+    for key in index:
+        if key not in seen:
+            counts['delete'] += 1
+            manifest.writerow([key, 'delete'] + ([''] if mask else []))
+    return counts
+
+# main program
+def main():
+    args = parse_args()
+    key_col, old_cols, index = load_keyed_index(args.input_index)
+    with open_file(args.input_csv, 'r') as input_csv_file:
+        with open_file(args.output_manifest, 'w') as manifest_file:
+            output_csv_file = None if args.output_csv is None else open_file(args.output_csv, 'w')
+            counts = classify_rows(input_csv_file, key_col, old_cols, index, manifest_file, output_csv_file=output_csv_file, mask=args.changed_mask)
+            if output_csv_file is not None:
+                output_csv_file.close()
+    print(', '.join('%s: %d' % (action, count) for action, count in counts.items()), file=stderr)
+
+# run main program
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#! /usr/bin/env python3
+'''
+Stream CSV entries to a running csv_delta_daemon.py and write its replies
+'''
+
+# imports
+from os.path import isfile
+from socket import socket, AF_UNIX, SHUT_WR, SOCK_STREAM
+from sys import stderr, stdin, stdout
+from threading import Thread
+from true_append_io import open_file
+import argparse
+
+# constants
+COMMANDS = ['ADD', 'CHECK', 'REMOVE', 'LIST_REMOVED', 'DUMP', 'RELOAD', 'SHUTDOWN']
+PAYLOAD_COMMANDS = {'ADD', 'CHECK', 'REMOVE', 'LIST_REMOVED'}
+SEND_BATCH_SIZE = 4096 # CSV lines per socket write
+STDIO = {'stderr':stderr, 'stdin':stdin, 'stdout':stdout}
+
+# parse user args
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-s', '--socket', required=True, type=str, help="Unix Socket Path of csv_delta_daemon.py")
+    parser.add_argument('-c', '--command', required=True, type=str, choices=COMMANDS, help="Command")
+    parser.add_argument('-i', '--input_csv', required=False, type=str, default='stdin', help="Input Dataset (CSV) (for %s)" % '/'.join(c for c in COMMANDS if c in PAYLOAD_COMMANDS))
+    parser.add_argument('-o', '--output', required=False, type=str, default='stdout', help="Output Reply Lines")
+    parser.add_argument('-d', '--dump_path', required=False, type=str, default=None, help="Structure Dump Path (for DUMP; default: file it was loaded from)")
+    args = parser.parse_args()
+    if args.command in PAYLOAD_COMMANDS and not isfile(args.input_csv) and args.input_csv not in STDIO and not args.input_csv.startswith('/dev/fd'):
+        raise ValueError("File not found: %s" % args.input_csv)
+    if isfile(args.output):
+        raise ValueError("File exists: %s" % args.output)
+    return args
+
+# stream CSV lines to the daemon, then shut down the write side of the socket
+def send_csv(sock, input_csv_fn):
+    with open_file(input_csv_fn, 'r') as input_csv_file:
+        batch = list()
+        for line in input_csv_file:
+            batch.append(line if line.endswith('\n') else line + '\n')
+            if len(batch) == SEND_BATCH_SIZE:
+                sock.sendall(''.join(batch).encode()); batch = list()
+        if len(batch) != 0:
+            sock.sendall(''.join(batch).encode())
+    sock.shutdown(SHUT_WR)
+
+# send a command to the daemon and write its reply data lines
+# Argument: `socket_fn` = Unix socket path of the daemon
+# Argument: `command` = command line (e.g. 'CHECK' or 'DUMP out.dgs')
+# Argument: `input_csv_fn` = filename of the input CSV (or `None` for commands without CSV entries)
+# Argument: `output_file` = file stream to write reply data lines to
+# Return: reply status message
+def query(socket_fn, command, input_csv_fn, output_file):
+    with socket(AF_UNIX, SOCK_STREAM) as sock:
+        sock.connect(socket_fn); sock.sendall(('%s\n' % command).encode())
+        if input_csv_fn is None:
+            sock.shutdown(SHUT_WR); sender = None
+        else: # send in a separate thread so replies are read while entries are still being sent
+            sender = Thread(target=send_csv, args=(sock, input_csv_fn)); sender.start()
+        status = None
+        for line in sock.makefile('rb'):
+            line = line.decode()
+            if line.startswith('D'):
+                output_file.write(line[1:])
+            else:
+                status = line.strip(); break
+        if sender is not None:
+            sender.join()
+    if status is None or not status.startswith('OK'):
+        raise RuntimeError("csv_delta_daemon.py %s failed: %s" % (command.split(' ')[0], status))
+    output_file.flush()
+    return status[2:].strip()
+
+# main program
+def main():
+    args = parse_args()
+    command = args.command
+    if command == 'DUMP' and args.dump_path is not None:
+        command = '%s %s' % (command, args.dump_path)
+    with open_file(args.output, 'w') as output_file:
+        status = query(args.socket, command, args.input_csv if args.command in PAYLOAD_COMMANDS else None, output_file)
+    print(status, file=stderr)
+
+# run main program
+if __name__ == "__main__":
+    main()
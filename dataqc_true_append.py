@@ -6,10 +6,18 @@ True Append for DataQC
 # imports
 from csv import reader, writer
 from datetime import datetime
+from os import remove
 from os.path import isfile
 from shutil import copyfile
 from subprocess import run
 from sys import argv, stderr, stdin, stdout
+from time import perf_counter
+from true_append_index import build_index, load_index, write_index, DEFAULT_INDEX_SUFFIX
+from true_append_io import open_file
+from true_append_metrics import add_metrics_args, metrics_from_args, Metrics
+from true_append_staging import append_part, new_part, BackgroundTask
+from true_append_state import StateStore
+from true_append_offsets import append_kept_records, load_offset_index, offset_index_fn, write_offset_index
 import argparse
 
 # constants
@@ -24,36 +32,34 @@ def get_time():
 def print_log(s='', end='\n'):
     print("[%s] %s" % (get_time(), s), file=stderr, end=end); stderr.flush()
 
-# open file and return file object
-def open_file(fn, mode='r', text=True):
-    if fn in STDIO:
-        return STDIO[fn]
-    elif fn.lower().endswith('.gz'):
-        if mode == 'a':
-            raise NotImplementedError("Cannot append to gzip file")
-        if text:
-            mode += 't'
-        return gopen(fn, mode)
-    else:
-        return open(fn, mode)
-
 # parse user args
 def parse_args():
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-c', '--csv-file', required=True, type=str, help="Input: User table (CSV)")
-    parser.add_argument('-oc', '--old-csv-file', required=True, type=str, help="Input: Old table (CSV)")
-    parser.add_argument('-of', '--old-fasta-file', required=True, type=str, help="Input: Old sequences (FASTA)")
-    parser.add_argument('-or', '--old-full-report', required=True, type=str, help="Input: Old Full Report (CSV)")
+    parser.add_argument('-oc', '--old-csv-file', required=False, type=str, default=None, help="Input: Old table (CSV)")
+    parser.add_argument('-oi', '--old-index', required=False, type=str, default=None, help="Input: Old table sequence digest index (instead of --old-csv-file)")
+    parser.add_argument('-of', '--old-fasta-file', required=False, type=str, default=None, help="Input: Old sequences (FASTA)")
+    parser.add_argument('-or', '--old-full-report', required=False, type=str, default=None, help="Input: Old Full Report (CSV)")
     parser.add_argument('-f', '--fasta-file', required=True, type=str, help="Output: Updated sequences (FASTA)")
+    parser.add_argument('--output-index', required=False, type=str, default=None, help="Output: Table sequence digest index (default: output FASTA file + '%s')" % DEFAULT_INDEX_SUFFIX)
     parser.add_argument('-py', '--dataqc_py', required=True, type=str, help="PATH to DataQC.py script")
     parser.add_argument('-d', '--dram', required=False, type=str, default=None, help="DRAM CSV file")
     parser.add_argument('-C', '--comet', required=False, type=str, default=None, help="PATH to the COMET executable")
     parser.add_argument('-t', '--tn93', required=False, type=str, default=None, help="PATH to the TN93 executable")
+    parser.add_argument('--state-db', required=False, type=str, default=None, help="Run state store (SQLite) holding the previous run (instead of --old-* files; outputs then only hold new/updated entries)")
+    add_metrics_args(parser, sep='-')
     args = parser.parse_args()
-    for fn in [args.csv_file, args.old_csv_file, args.old_fasta_file, args.old_full_report]:
-        if not isfile(fn) and not fn.startswith('/dev/fd'):
+    if args.state_db is None:
+        if (args.old_csv_file is None) == (args.old_index is None):
+            raise ValueError("Must specify exactly one of --old-csv-file or --old-index")
+        if args.old_fasta_file is None or args.old_full_report is None:
+            raise ValueError("Must specify --old-fasta-file and --old-full-report (or --state-db)")
+    if args.output_index is None:
+        args.output_index = '%s%s' % (args.fasta_file, DEFAULT_INDEX_SUFFIX)
+    for fn in [args.csv_file, args.old_csv_file, args.old_index, args.old_fasta_file, args.old_full_report]:
+        if fn is not None and not isfile(fn) and not fn.startswith('/dev/fd'):
             raise ValueError("File not found: %s" % fn)
-    for fn in [args.fasta_file]:
+    for fn in [args.fasta_file, args.output_index]:
         if fn.lower().endswith('.gz'):
             raise ValueError("Cannot directly write to gzip output file")
         if isfile(fn):
@@ -89,8 +95,8 @@ def parse_table(input_table_fn):
     return seqs
 
 # determine dataset deltas
-# Argument: `seqs_new` = `dict` where keys are user-uploaded sequence IDs and values are sequences
-# Argument: `seqs_old` = `dict` where keys are existing sequence IDs and values are sequences
+# Argument: `seqs_new` = `dict` where keys are user-uploaded sequence IDs and values are sequences (or digest index entries)
+# Argument: `seqs_old` = `dict` where keys are existing sequence IDs and values are sequences (or digest index entries)
 # Return: `to_add` = `set` containing IDs in `seqs_new` that need to be added to `seqs_old`
 # Return: `to_replace` = `set` containing IDs in `seqs_old` whose sequences need to be updated with those in `seqs_new`
 # Return: `to_delete` = `set` containing IDs in `seqs_old` that need to be deleted
@@ -117,7 +123,8 @@ def determine_deltas(seqs_new, seqs_old):
 # Argument: `dram_path` = path to DRAM CSV file
 # Argument: `comet_path` = path to comet executable
 # Argument: `tn93_path` = path to tn93 executable
-def run_DataQC(user_csv_fn, new_updated_csv_fn, to_add, to_replace, out_fasta_fn, dataqc_py_path, dram_path=None, comet_path=None, tn93_path=None):
+# Argument: `metrics` = `Metrics` to record the DataQC run in (or `None`)
+def run_DataQC(user_csv_fn, new_updated_csv_fn, to_add, to_replace, out_fasta_fn, dataqc_py_path, dram_path=None, comet_path=None, tn93_path=None, metrics=None):
     # build CSV file containing just new/updated sequences
     new_updated_csv_file = open_file(new_updated_csv_fn, 'w')
     new_updated_csv_writer = writer(new_updated_csv_file)
@@ -145,79 +152,198 @@ def run_DataQC(user_csv_fn, new_updated_csv_fn, to_add, to_replace, out_fasta_fn
         dataqc_command += ['--tn93', tn93_path]
     log_f = open_file('%s.dataqc.log' % new_updated_csv_fn, 'w')
     print_log("Running DataQC: %s" % ' '.join(dataqc_command))
-    run(dataqc_command, stderr=log_f); log_f.close()
+    start = perf_counter(); exit_code = run(dataqc_command, stderr=log_f).returncode; log_f.close()
+    if metrics is not None:
+        metrics.subprocess(dataqc_command, exit_code, perf_counter() - start)
+
+# index the records of a DataQC FASTA (by document_uid)
+# Argument: `fasta_fn` = filename of DataQC FASTA
+# Return: `list` of (document_uid, start, end) tuples in file order
+def index_fasta_offsets(fasta_fn):
+    entries = list(); ID = None; start = 0; pos = 0
+    if not isfile(fasta_fn):
+        return entries
+    with open(fasta_fn, 'rb') as fasta_file:
+        for line in fasta_file:
+            if line.startswith(b'>'):
+                if ID is not None:
+                    entries.append((ID, start, pos))
+                ID = line[1:].split(b'~')[0].strip().decode(); start = pos
+            pos += len(line)
+    if ID is not None:
+        entries.append((ID, start, pos))
+    return entries
+
+# index the entries of a DataQC full report CSV (by document_uid)
+# Argument: `full_report_fn` = filename of DataQC full report CSV
+# Return: `list` of (document_uid, start, end) tuples in file order
+def index_full_report_offsets(full_report_fn):
+    entries = list(); pos = 0
+    with open(full_report_fn, 'rb') as full_report_file:
+        for line_num, line in enumerate(full_report_file):
+            if line_num != 0:
+                entries.append((line.split(b',')[1].strip().decode(), pos, pos + len(line))) # assumes document_uid is the second column (index 1 of the row)
+            pos += len(line)
+    return entries
 
 # copy unchanged sequences to new/updated DataQC output
-# assumes all lines (including empty ones) end in a newline character, so no newline == EOF
 # Argument: `old_fasta_fn` = filename of old DataQC FASTA
 # Argument: `to_keep` = `set` containing IDs to keep from old FASTA
 # Argument: `out_fasta_fn` = filename of output DataQC FASTA
-def copy_unchanged_seqs(old_fasta_fn, to_keep, out_fasta_fn):
-    # set things up for reading/writing
-    old_fasta_file = open_file(old_fasta_fn)
-    out_fasta_file = open_file(out_fasta_fn, 'a')
-    line = old_fasta_file.readline()
-
-    # read old FASTA
-    while True:
-        # check for validity
-        if len(line) == 0:
-            break
-        elif line[0] != '>':
+# Argument: `old_offsets` = offset index of old DataQC FASTA (or `None` to parse it)
+# Return: `list` of (document_uid, start, end) tuples of the copied sequences in output DataQC FASTA
+def copy_unchanged_seqs(old_fasta_fn, to_keep, out_fasta_fn, old_offsets=None):
+    if old_offsets is not None:
+        return append_kept_records(old_fasta_fn, old_offsets, to_keep, out_fasta_fn)
+    entries = list(); keep = False # (records are copied as raw bytes, so the output matches the offset index path)
+    old_fasta_file = open_file(old_fasta_fn, 'rb'); out_fasta_file = open(out_fasta_fn, 'ab'); pos = out_fasta_file.tell()
+    for line_num, line in enumerate(old_fasta_file):
+        if line.startswith(b'>'):
+            ID = line[1:].split(b'~')[0].strip().decode(); keep = ID in to_keep
+            if keep:
+                entries.append([ID, pos, pos])
+        elif line_num == 0:
             raise ValueError("Malformed FASTA: %s" % old_fasta_fn)
-        document_uid = line.split('~')[0][1:].strip()
-
-        # move to next sequence (and write this one to output if keeping it)
-        keep_seq = document_uid in to_keep
-        if keep_seq:
-            out_fasta_file.write(line)
-        line = old_fasta_file.readline()
-        while len(line) != 0 and line[0] != '>':
-            if keep_seq:
-                out_fasta_file.write(line)
-            line = old_fasta_file.readline()
+        if keep:
+            out_fasta_file.write(line); pos += len(line); entries[-1][2] = pos
     old_fasta_file.close(); out_fasta_file.close()
+    return [tuple(entry) for entry in entries]
 
 # copy unchanged entries to DataQC full report CSV
 # Argument: `old_full_report_fn` = filename of old DataQC full report CSV
 # Argument: `to_keep` = `set` containing IDs to keep from old full report CSV
 # Argument: `out_full_report` = filename of output DataQC full report CSV
-def copy_unchanged_full_report(old_full_report_fn, to_keep, out_full_report_fn):
-    old_full_report_file = open_file(old_full_report_fn); out_full_report_file = open_file(out_full_report_fn, 'a')
+# Argument: `old_offsets` = offset index of old DataQC full report CSV (or `None` to parse it)
+# Return: `list` of (document_uid, start, end) tuples of the copied entries in output DataQC full report CSV
+def copy_unchanged_full_report(old_full_report_fn, to_keep, out_full_report_fn, old_offsets=None):
+    if old_offsets is not None:
+        return append_kept_records(old_full_report_fn, old_offsets, to_keep, out_full_report_fn)
+    entries = list(); old_full_report_file = open(old_full_report_fn, 'rb'); out_full_report_file = open(out_full_report_fn, 'ab'); pos = out_full_report_file.tell()
     for line_num, line in enumerate(old_full_report_file):
         if line_num == 0:
             continue
-        if line.split(',')[1].strip() in to_keep: # assumes document_uid is the second column (index 1 of the row)
-            out_full_report_file.write(line)
+        ID = line.split(b',')[1].strip().decode() # assumes document_uid is the second column (index 1 of the row)
+        if ID in to_keep:
+            out_full_report_file.write(line); entries.append((ID, pos, pos + len(line))); pos += len(line)
     old_full_report_file.close(); out_full_report_file.close()
+    return entries
+
+# run DataQC on all new and updated sequences while copying unchanged sequences and full report entries into staging parts, then append the parts (and write output offset indices)
+# Argument: `csv_fn` = filename of user-given (new) CSV file
+# Argument: `to_add` = `set` containing IDs to add
+# Argument: `to_replace` = `set` containing IDs whose sequences need to be updated
+# Argument: `to_keep` = `set` containing IDs to keep from old outputs
+# Argument: `fasta_fn` = filename of output DataQC FASTA
+# Argument: `old_fasta_fn` = filename of old DataQC FASTA
+# Argument: `old_full_report_fn` = filename of old DataQC full report CSV
+def append_dataqc(csv_fn, to_add, to_replace, to_keep, fasta_fn, old_fasta_fn, old_full_report_fn, dataqc_py_path, dram_path=None, comet_path=None, tn93_path=None, metrics=None):
+    if metrics is None:
+        metrics = Metrics('dataqc') # (records nothing)
+    new_updated_csv_fn = '%s.new_updated.csv' % csv_fn.rstrip('.csv')
+    out_full_report_fn = '%s.full_report.csv' % '.'.join(fasta_fn.split('.')[:-1])
+    fasta_part_fn = new_part(fasta_fn); full_report_part_fn = new_part(out_full_report_fn)
+    def copy_parts():
+        with metrics.phase('copy') as counts:
+            old_fasta_offsets = load_offset_index(old_fasta_fn)
+            print_log("Copying unchanged DataQC sequences from: %s%s" % (old_fasta_fn, '' if old_fasta_offsets is None else ' (using offset index)'))
+            kept_fasta_offsets = copy_unchanged_seqs(old_fasta_fn, to_keep, fasta_part_fn, old_offsets=old_fasta_offsets)
+            old_full_report_offsets = load_offset_index(old_full_report_fn)
+            print_log("Copying unchanged DataQC full report entries from: %s%s" % (old_full_report_fn, '' if old_full_report_offsets is None else ' (using offset index)'))
+            kept_full_report_offsets = copy_unchanged_full_report(old_full_report_fn, to_keep, full_report_part_fn, old_offsets=old_full_report_offsets)
+            counts['fasta_records'] = len(kept_fasta_offsets); counts['full_report_entries'] = len(kept_full_report_offsets)
+        return kept_fasta_offsets, kept_full_report_offsets
+    try:
+        copier = BackgroundTask(copy_parts); copier.start()
+        try:
+            with metrics.phase('external') as counts:
+                print_log("Performing new DataQC analyses and writing FASTA output to: %s" % fasta_fn)
+                run_DataQC(csv_fn, new_updated_csv_fn, to_add, to_replace, fasta_fn, dataqc_py_path, dram_path=dram_path, comet_path=comet_path, tn93_path=tn93_path, metrics=metrics)
+                counts['sequences'] = len(to_add) + len(to_replace)
+        finally:
+            copier.join()
+        kept_fasta_offsets, kept_full_report_offsets = copier.wait()
+        with metrics.phase('append_part'):
+            print_log("Appending unchanged DataQC sequences to: %s" % fasta_fn)
+            fasta_offsets = index_fasta_offsets(fasta_fn) + append_part(fasta_part_fn, fasta_fn, kept_fasta_offsets)
+            print_log("Copying new DataQC full report contents to: %s" % out_full_report_fn)
+            copyfile('%s.full_report.csv' % new_updated_csv_fn.rstrip('.csv'), out_full_report_fn)
+            print_log("Appending unchanged DataQC full report entries to: %s" % out_full_report_fn)
+            full_report_offsets = index_full_report_offsets(out_full_report_fn) + append_part(full_report_part_fn, out_full_report_fn, kept_full_report_offsets)
+    finally:
+        remove(fasta_part_fn); remove(full_report_part_fn)
+    with metrics.phase('write_index'):
+        print_log("Writing output offset indices: %s and %s" % (offset_index_fn(fasta_fn), offset_index_fn(out_full_report_fn)))
+        write_offset_index(fasta_fn, fasta_offsets); write_offset_index(out_full_report_fn, full_report_offsets)
+
+# store new/updated DataQC FASTA records and full report entries in the run state store (replacing those of deleted and updated IDs)
+# Argument: `state` = `StateStore` of DataQC
+# Argument: `to_update` = `set` containing IDs that were added or updated
+# Argument: `to_delete` = `set` containing IDs that were deleted
+# Argument: `fasta_fn` = filename of new/updated DataQC FASTA
+# Argument: `full_report_fn` = filename of new/updated DataQC full report CSV
+def update_dataqc_state(state, to_update, to_delete, fasta_fn, full_report_fn):
+    for kind, fn, entries in [('fasta', fasta_fn, index_fasta_offsets(fasta_fn)), ('report', full_report_fn, index_full_report_offsets(full_report_fn))]:
+        state.delete_records(kind, to_delete | to_update) # updated IDs may no longer pass QC
+        records = dict()
+        with open(fn, 'rb') as f:
+            for ID, start, end in entries:
+                f.seek(start); records[ID] = records.get(ID, '') + f.read(end - start).decode()
+        state.put_records(kind, records.items())
+    with open(full_report_fn) as f:
+        state.put_meta('header\treport', f.readline())
 
 # main program
 def main():
     print_log("Running DataQC True Append v%s" % DATAQC_TRUE_APPEND_VERSION)
     args = parse_args()
     print_log("Command: %s" % ' '.join(argv))
-    print_log("Parsing user table: %s" % args.csv_file)
-    seqs_new = parse_table(args.csv_file)
-    print_log("- Num Sequences: %s" % len(seqs_new))
-    print_log("Parsing old table: %s" % args.old_csv_file)
-    seqs_old = parse_table(args.old_csv_file)
-    print_log("- Num Sequences: %s" % (len(seqs_old)))
-    print_log("Determining deltas between user table and old table...")
-    to_add, to_replace, to_delete, to_keep = determine_deltas(seqs_new, seqs_old)
-    print_log("- Add: %s" % len(to_add))
-    print_log("- Replace: %s" % len(to_replace))
-    print_log("- Delete: %s" % len(to_delete))
-    print_log("- Do nothing: %s" % (len(to_keep)))
-    new_updated_csv_fn = '%s.new_updated.csv' % args.csv_file.rstrip('.csv')
-    print_log("Performing new DataQC analyses and writing FASTA output to: %s" % args.fasta_file)
-    run_DataQC(args.csv_file, new_updated_csv_fn, to_add, to_replace, args.fasta_file, args.dataqc_py, dram_path=args.dram, comet_path=args.comet, tn93_path=args.tn93)
-    print_log("Copying unchanged DataQC sequences from: %s" % args.old_fasta_file)
-    copy_unchanged_seqs(args.old_fasta_file, to_keep, args.fasta_file)
-    out_full_report_fn = '%s.full_report.csv' % '.'.join(args.fasta_file.split('.')[:-1])
-    print_log("Copying new DataQC full report contents to: %s" % out_full_report_fn)
-    copyfile('%s.full_report.csv' % new_updated_csv_fn.rstrip('.csv'), out_full_report_fn)
-    print_log("Copying unchanged DataQC full report entries from: %s" % args.old_full_report)
-    copy_unchanged_full_report(args.old_full_report, to_keep, out_full_report_fn)
+    metrics = metrics_from_args(args, 'dataqc')
+    with metrics.phase('parse_user') as counts:
+        print_log("Parsing user table: %s" % args.csv_file)
+        seqs_new = parse_table(args.csv_file)
+        print_log("- Num Sequences: %s" % len(seqs_new))
+        print_log("Indexing user table sequences...")
+        index_new = build_index(seqs_new); counts['sequences'] = len(seqs_new); seqs_new = None # only the index is needed from here on
+    state = None
+    with metrics.phase('parse_old') as counts:
+        if args.state_db is not None:
+            print_log("Loading old table sequence index from state store: %s" % args.state_db)
+            state = StateStore(args.state_db, 'dataqc'); index_old = state.load_index()
+        elif args.old_index is None:
+            print_log("Parsing old table: %s" % args.old_csv_file)
+            index_old = build_index(parse_table(args.old_csv_file))
+        else:
+            print_log("Loading old table sequence index: %s" % args.old_index)
+            index_old = load_index(args.old_index)
+        print_log("- Num Sequences: %s" % (len(index_old))); counts['sequences'] = len(index_old)
+    with metrics.phase('delta') as counts:
+        print_log("Determining deltas between user table and old table...")
+        to_add, to_replace, to_delete, to_keep = determine_deltas(index_new, index_old)
+        print_log("- Add: %s" % len(to_add))
+        print_log("- Replace: %s" % len(to_replace))
+        print_log("- Delete: %s" % len(to_delete))
+        print_log("- Do nothing: %s" % (len(to_keep)))
+        counts.update({'add': len(to_add), 'replace': len(to_replace), 'delete': len(to_delete), 'keep': len(to_keep)})
+    if state is None:
+        append_dataqc(args.csv_file, to_add, to_replace, to_keep, args.fasta_file, args.old_fasta_file, args.old_full_report, args.dataqc_py, dram_path=args.dram, comet_path=args.comet, tn93_path=args.tn93, metrics=metrics)
+    else:
+        new_updated_csv_fn = '%s.new_updated.csv' % args.csv_file.rstrip('.csv')
+        with metrics.phase('external') as counts:
+            print_log("Performing new DataQC analyses and writing FASTA output to: %s" % args.fasta_file)
+            run_DataQC(args.csv_file, new_updated_csv_fn, to_add, to_replace, args.fasta_file, args.dataqc_py, dram_path=args.dram, comet_path=args.comet, tn93_path=args.tn93, metrics=metrics)
+            counts['sequences'] = len(to_add) + len(to_replace)
+        with metrics.phase('copy'):
+            out_full_report_fn = '%s.full_report.csv' % '.'.join(args.fasta_file.split('.')[:-1])
+            print_log("Copying new DataQC full report contents to: %s" % out_full_report_fn)
+            copyfile('%s.full_report.csv' % new_updated_csv_fn.rstrip('.csv'), out_full_report_fn)
+        with metrics.phase('update_state'):
+            print_log("Updating state store: %s" % args.state_db)
+            update_dataqc_state(state, to_add | to_replace, to_delete, args.fasta_file, out_full_report_fn)
+            state.update_index(index_new, to_add | to_replace, to_delete); state.close()
+    with metrics.phase('write_index') as counts:
+        print_log("Writing table sequence index: %s" % args.output_index)
+        write_index(args.output_index, index_new); counts['sequences'] = len(index_new)
+    metrics.close()
 
 # run main program
 if __name__ == "__main__":
@@ -0,0 +1,301 @@
+#! /usr/bin/env python3
+'''
+Benchmark the True Append tools (TN93, cawlign, bealign) against from-scratch runs
+
+Replays the chained example/tn93 append series (Network-Old-1, Network-Old-2, ...), and optionally synthetic scaled-up
+series generated from their sequences (--sizes, with --churn of each dataset added/replaced/deleted per step).
+Every step after the first is run both as an append (onto the previous step's outputs) and from scratch (onto empty
+old inputs). Stub aligners stand in for cawlign and bealign, so alignment time isn't measured, only the True Append
+overhead around it. Each tool run records its wall time, CPU time, peak RSS, and block I/O (of the tool and its
+children), and the per-phase records of its `--metrics` output (wall time, CPU time, RSS, and bytes read/written).
+Results are written as JSON and CSV (one row per run, then one row per phase) to the output directory.
+'''
+from csv import reader, writer
+from datetime import datetime
+from glob import glob
+from json import dump as jdump, loads
+from os import chmod, cpu_count, makedirs, wait4, waitstatus_to_exitcode
+from os.path import abspath, dirname, exists, isdir, join
+from platform import platform, python_version
+from random import Random
+from shutil import rmtree
+from subprocess import DEVNULL, PIPE, Popen, run
+from sys import argv, executable, stderr
+from time import perf_counter
+import argparse
+
+# constants
+REPO_DIR = dirname(dirname(abspath(__file__)))
+DEFAULT_EXAMPLE_DIR = join(REPO_DIR, 'example', 'tn93')
+DEFAULT_SERIES = ['Network-Old', 'Network-New']
+DEFAULT_STEPS = 3
+DEFAULT_CHURN = 0.05
+DEFAULT_MUTATION_RATE = 0.01
+DEFAULT_SEED = 0
+TOOLS = ['tn93', 'cawlign', 'bealign']
+ID_COL = 'ehars_uid'
+SEQ_COL = 'clean_seq'
+NUCLEOTIDES = 'ACGT'
+PLACEHOLDER = {'true_append_benchmark_placeholder': 'ACGT'} # empty FASTAs are rejected, so from-scratch runs start from (and delete) a placeholder
+RESULTS_CSV_HEADER = ['series', 'step', 'tool', 'mode', 'phase', 'num_seqs', 'num_add', 'num_replace', 'num_delete', 'exit_code', 'wall_time', 'user_time', 'sys_time', 'children_user_time', 'children_sys_time', 'max_rss_kb', 'rss_start_kb', 'rss_end_kb', 'max_rss_increase_kb', 'read_bytes', 'write_bytes', 'read_blocks', 'write_blocks']
+TOTAL_PHASE = 'total' # `phase` of the per-run rows of results.csv
+STUB_CAWLIGN = '#!/bin/sh\nexec cat\n' # sequences are already aligned (same length) in the benchmark datasets
+STUB_BEALIGN = '''#! %s
+# stub bealign: write every input sequence as an unmapped read
+from pysam import AlignedSegment, AlignmentFile, AlignmentHeader
+from sys import argv, path
+path.insert(0, %r)
+from true_append_fasta import iter_fasta
+header = AlignmentHeader.from_dict({'HD': {'VN': '1.6', 'SO': 'unsorted'}, 'SQ': [{'SN': 'stub', 'LN': 100000}]})
+with AlignmentFile(argv[-1], 'wb', header=header) as out_file:
+    for name, seq in iter_fasta(argv[-2]):
+        read = AlignedSegment(header); read.query_name = name; read.query_sequence = seq; read.flag = 4
+        out_file.write(read)
+'''
+
+# return the current time as a string
+def get_time():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+# print to log (prefixed by current time)
+def print_log(s='', end='\n'):
+    print("[%s] %s" % (get_time(), s), file=stderr, end=end); stderr.flush()
+
+# parse user args
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output_dir', required=True, type=str, help="Output: Benchmark directory (results.json, results.csv, and working files)")
+    parser.add_argument('-e', '--example_dir', required=False, type=str, default=DEFAULT_EXAMPLE_DIR, help="Directory of the example series (default: example/tn93)")
+    parser.add_argument('-n', '--sizes', required=False, type=str, default='', help="Comma-separated sizes of synthetic series (e.g. 10000,100000,500000; default: none)")
+    parser.add_argument('-s', '--steps', required=False, type=int, default=DEFAULT_STEPS, help="Number of datasets per synthetic series (default: %d)" % DEFAULT_STEPS)
+    parser.add_argument('-c', '--churn', required=False, type=float, default=DEFAULT_CHURN, help="Fraction of a synthetic dataset changed per step, split evenly across add/replace/delete (default: %g)" % DEFAULT_CHURN)
+    parser.add_argument('-m', '--mutation_rate', required=False, type=float, default=DEFAULT_MUTATION_RATE, help="Per-position substitution rate of synthetic sequences (default: %g)" % DEFAULT_MUTATION_RATE)
+    parser.add_argument('-t', '--tools', required=False, type=str, default=','.join(TOOLS), help="Comma-separated tools to benchmark (default: %s)" % ','.join(TOOLS))
+    parser.add_argument('-p', '--threads', required=False, type=int, default=1, help="Number of TN93 worker processes (default: 1)")
+    parser.add_argument('--seed', required=False, type=int, default=DEFAULT_SEED, help="Random seed of synthetic series (default: %d)" % DEFAULT_SEED)
+    parser.add_argument('--no_replay', action='store_true', help="Don't replay the example series")
+    parser.add_argument('--no_baseline', action='store_true', help="Don't run the from-scratch baseline of steps after the first")
+    parser.add_argument('--keep_files', action='store_true', help="Keep the datasets and tool outputs of each series")
+    args = parser.parse_args()
+    args.output_dir = abspath(args.output_dir); args.example_dir = abspath(args.example_dir) # (tools run from the repository directory)
+    args.sizes = [int(v) for v in args.sizes.split(',') if v.strip() != '']
+    args.tools = [v.strip() for v in args.tools.split(',') if v.strip() != '']
+    for tool in args.tools:
+        if tool not in TOOLS:
+            raise ValueError("Invalid tool: %s (options: %s)" % (tool, ', '.join(TOOLS)))
+    if exists(args.output_dir):
+        raise ValueError("Output directory exists: %s" % args.output_dir)
+    if not isdir(args.example_dir):
+        raise ValueError("Directory not found: %s" % args.example_dir)
+    if args.steps < 2:
+        raise ValueError("Number of steps must be at least 2: %s" % args.steps)
+    if not 0 <= args.churn <= 1:
+        raise ValueError("Churn rate must be in [0, 1]: %s" % args.churn)
+    return args
+
+# load the sequences of a table
+# Return: `dict` where keys are sequence IDs and values are sequences (empty if it isn't a sequence table, e.g. TN93 CSVs)
+def load_table(fn):
+    seqs = dict(); header = None
+    with open(fn) as infile:
+        for row in reader(infile):
+            if header is None:
+                header = {k.strip():i for i, k in enumerate(row)}
+                if ID_COL not in header or SEQ_COL not in header:
+                    break
+            elif len(row) != 0:
+                seqs[row[header[ID_COL]].strip()] = row[header[SEQ_COL]].strip().upper()
+    return seqs
+
+# write the sequences of a dataset as a table (CSV) and as FASTA
+def write_dataset(seqs, prefix):
+    with open('%s.csv' % prefix, 'w') as out_file:
+        out = writer(out_file, lineterminator='\n'); out.writerow([ID_COL, SEQ_COL])
+        for ID, seq in seqs.items():
+            out.writerow([ID, seq])
+    with open('%s.fas' % prefix, 'w') as out_file:
+        for ID, seq in seqs.items():
+            out_file.write('>%s\n%s\n' % (ID, seq))
+
+# find the example series (all with at least 2 datasets)
+# Return: `dict` where keys are series names and values are `list` of table filenames (in order)
+def find_example_series(example_dir):
+    out = dict()
+    for name in DEFAULT_SERIES:
+        fns = glob(join(example_dir, '%s-*.csv' % name))
+        fns = sorted((fn for fn in fns if fn.rsplit('-', 1)[1][:-4].isdigit()), key=lambda fn: int(fn.rsplit('-', 1)[1][:-4]))
+        if len(fns) > 1:
+            out[name] = fns
+    return out
+
+# randomly substitute positions of a sequence
+def mutate(seq, rate, rng):
+    seq = list(seq)
+    for _ in range(max(1, round(rate * len(seq)))):
+        i = rng.randrange(len(seq)); seq[i] = rng.choice(NUCLEOTIDES.replace(seq[i], ''))
+    return ''.join(seq)
+
+# generate a synthetic series from a pool of sequences
+# Argument: `pool` = `list` of sequences (all of the same length)
+# Return: generator of datasets (`dict` where keys are sequence IDs and values are sequences)
+def generate_series(pool, size, steps, churn, mutation_rate, seed):
+    rng = Random(seed); next_ID = 0; seqs = dict()
+    def new_seq():
+        return mutate(rng.choice(pool), mutation_rate, rng)
+    for _ in range(size):
+        seqs['SYN%09d' % next_ID] = new_seq(); next_ID += 1
+    yield dict(seqs)
+    num_each = round(size * churn / 3)
+    for _ in range(steps - 1):
+        IDs = rng.sample(list(seqs.keys()), 2*num_each)
+        for ID in IDs[:num_each]:
+            del seqs[ID]
+        for ID in IDs[num_each:]:
+            seqs[ID] = mutate(seqs[ID], mutation_rate, rng)
+        for _ in range(num_each):
+            seqs['SYN%09d' % next_ID] = new_seq(); next_ID += 1
+        yield dict(seqs)
+
+# load the records of a tool's metrics file (see true_append_metrics.py)
+# Return: `list` of records (`dict`), empty if the file doesn't exist (e.g. the tool failed before writing it)
+def load_metrics(fn):
+    if not exists(fn):
+        return list()
+    with open(fn) as metrics_file:
+        return [loads(line) for line in metrics_file if len(line.strip()) != 0]
+
+# run a tool and measure it
+# Argument: `command` = command of the tool run (without `--metrics`)
+# Argument: `metrics_fn` = filename of the tool's metrics output (JSON lines)
+# Return: `dict` with the exit code and resource usage of the run, and its phase and subprocess records from `metrics_fn`
+def run_tool(command, metrics_fn, log_fn):
+    start = perf_counter()
+    with open(log_fn, 'w') as log_file:
+        proc = Popen(command + ['--metrics', metrics_fn], stdout=DEVNULL, stderr=log_file, cwd=REPO_DIR)
+        pid, status, usage = wait4(proc.pid, 0); proc.returncode = waitstatus_to_exitcode(status)
+    wall_time = perf_counter() - start; records = load_metrics(metrics_fn)
+    run_records = [record for record in records if record['type'] == 'run']
+    totals = run_records[-1] if len(run_records) != 0 else dict()
+    return {
+        'exit_code': proc.returncode, 'wall_time': wall_time, 'user_time': usage.ru_utime, 'sys_time': usage.ru_stime,
+        'max_rss_kb': usage.ru_maxrss, 'read_blocks': usage.ru_inblock, 'write_blocks': usage.ru_oublock,
+        'read_bytes': totals.get('read_bytes'), 'write_bytes': totals.get('write_bytes'),
+        'phases': [record for record in records if record['type'] == 'phase'],
+        'subprocesses': [record for record in records if record['type'] == 'subprocess'],
+    }
+
+# build the command of a tool run
+# Argument: `prefix` = prefix of the current dataset (with .csv and .fas files)
+# Argument: `old` = `dict` of the previous run's dataset prefix and output filenames of each tool
+# Argument: `out_prefix` = prefix of this run's outputs
+def tool_command(tool, prefix, old, out_prefix, stubs, threads=1):
+    python = [executable, join(REPO_DIR, '%s_true_append.py' % tool)]
+    if tool == 'tn93':
+        return python + ['-it', '%s.csv' % prefix, '-iT', '%s.csv' % old['prefix'], '-iD', old['tn93'], '-o', '%s.tn93.csv' % out_prefix, '-p', str(threads)]
+    elif tool == 'cawlign':
+        return python + ['-of', '%s.fas' % old['prefix'], '-oa', old['cawlign'], '-o', '%s.aln.fas' % out_prefix, '--cawlign_path', stubs['cawlign'], '%s.fas' % prefix]
+    else:
+        return python + ['-of', '%s.fas' % old['prefix'], '-ob', old['bealign'], '--bealign_path', stubs['bealign'], '%s.fas' % prefix, '%s.bam' % out_prefix]
+
+# output filenames of a tool run
+def tool_outputs(out_prefix):
+    return {'tn93': '%s.tn93.csv' % out_prefix, 'cawlign': '%s.aln.fas' % out_prefix, 'bealign': '%s.bam' % out_prefix}
+
+# benchmark one series
+# Argument: `datasets` = iterable of datasets (`dict` where keys are sequence IDs and values are sequences)
+# Return: `list` of result `dict`s (one per tool run)
+def benchmark_series(name, datasets, work_dir, empty, stubs, tools, threads=1, baseline=True):
+    results = list(); old = empty; old_seqs = dict()
+    for step, seqs in enumerate(datasets, start=1):
+        prefix = join(work_dir, 'step%d' % step); write_dataset(seqs, prefix)
+        deltas = {
+            'num_seqs': len(seqs), 'num_add': sum(ID not in old_seqs for ID in seqs),
+            'num_replace': sum(ID in old_seqs and old_seqs[ID] != seq for ID, seq in seqs.items()), 'num_delete': sum(ID not in seqs for ID in old_seqs),
+        }
+        if step == 1: # first step is always from scratch
+            modes = [('baseline', empty)]
+        else:
+            modes = [('append', old)] + ([('baseline', empty)] if baseline else [])
+        for mode, mode_old in modes:
+            out_prefix = '%s.%s' % (prefix, mode)
+            for tool in tools:
+                print_log("Running %s (%s): %s step %d (%d sequences)" % (tool, mode, name, step, len(seqs)))
+                command = tool_command(tool, prefix, mode_old, out_prefix, stubs, threads=threads)
+                result = run_tool(command, '%s.%s.metrics.jsonl' % (out_prefix, tool), '%s.%s.log' % (out_prefix, tool))
+                if result['exit_code'] != 0:
+                    print_log("- %s failed (exit code %d): see %s.%s.log" % (tool, result['exit_code'], out_prefix, tool))
+                else:
+                    print_log("- Wall time: %.3f s, Peak RSS: %d KB" % (result['wall_time'], result['max_rss_kb']))
+                results.append(dict({'series': name, 'step': step, 'tool': tool, 'mode': mode}, **deltas, **result))
+        old = dict({'prefix': prefix}, **tool_outputs('%s.%s' % (prefix, 'baseline' if step == 1 else 'append'))); old_seqs = seqs
+    return results
+
+# create the empty old inputs of from-scratch runs and the stub aligners
+# Return: `dict` of the empty old inputs, and `dict` of the stub aligner paths
+def prepare(out_dir, tools):
+    empty_prefix = join(out_dir, 'empty'); write_dataset(PLACEHOLDER, empty_prefix)
+    with open('%s.tn93.csv' % empty_prefix, 'w') as out_file:
+        out_file.write('ID1,ID2,Distance\n')
+    stubs = {'cawlign': join(out_dir, 'stub_cawlign'), 'bealign': join(out_dir, 'stub_bealign')}
+    with open(stubs['cawlign'], 'w') as out_file:
+        out_file.write(STUB_CAWLIGN)
+    with open(stubs['bealign'], 'w') as out_file:
+        out_file.write(STUB_BEALIGN % (executable, REPO_DIR))
+    for fn in stubs.values():
+        chmod(fn, 0o755)
+    empty = dict({'prefix': empty_prefix}, **tool_outputs(empty_prefix)); empty['cawlign'] = '%s.fas' % empty_prefix # stub alignment of the placeholder
+    if 'bealign' in tools:
+        run([stubs['bealign'], '%s.fas' % empty_prefix, empty['bealign']], check=True)
+    else:
+        empty['bealign'] = None
+    return empty, stubs
+
+# return the current commit of the repository (or `None` if it can't be determined)
+def get_commit():
+    try:
+        return run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+# write the results
+def write_results(out_dir, args, results):
+    with open(join(out_dir, 'results.json'), 'w') as out_file:
+        jdump({
+            'time': get_time(), 'commit': get_commit(), 'command': ' '.join(argv), 'python': python_version(), 'platform': platform(), 'cpu_count': cpu_count(),
+            'settings': {k: v for k, v in vars(args).items() if k != 'output_dir'}, 'results': results,
+        }, out_file, indent=1)
+    with open(join(out_dir, 'results.csv'), 'w') as out_file:
+        out = writer(out_file, lineterminator='\n'); out.writerow(RESULTS_CSV_HEADER)
+        for result in results:
+            rows = [dict(result, phase=TOTAL_PHASE)] + [dict({k: result[k] for k in RESULTS_CSV_HEADER[:4]}, **phase) for phase in result['phases']]
+            for row in rows:
+                out.writerow([('%.6f' % row[k]) if isinstance(row.get(k), float) else row.get(k) for k in RESULTS_CSV_HEADER])
+
+# main program
+def main():
+    args = parse_args(); makedirs(args.output_dir)
+    print_log("Command: %s" % ' '.join(argv))
+    empty, stubs = prepare(args.output_dir, args.tools); results = list(); series = list()
+    if not args.no_replay:
+        for name, fns in find_example_series(args.example_dir).items():
+            series.append((name, (load_table(fn) for fn in fns)))
+    if len(args.sizes) != 0:
+        pool = list({seq for fn in glob(join(args.example_dir, '*.csv')) for seq in load_table(fn).values()})
+        pool_lengths = {len(seq) for seq in pool}
+        if len(pool_lengths) > 1: # keep the most common length so stub alignments stay aligned
+            length = max(pool_lengths, key=lambda l: sum(len(seq) == l for seq in pool)); pool = [seq for seq in pool if len(seq) == length]
+        pool.sort()
+        for size in args.sizes:
+            series.append(('synthetic-%d' % size, generate_series(pool, size, args.steps, args.churn, args.mutation_rate, args.seed)))
+    for name, datasets in series:
+        work_dir = join(args.output_dir, name); makedirs(work_dir)
+        results += benchmark_series(name, datasets, work_dir, empty, stubs, args.tools, threads=args.threads, baseline=not args.no_baseline)
+        write_results(args.output_dir, args, results)
+        if not args.keep_files:
+            rmtree(work_dir)
+    write_results(args.output_dir, args, results)
+    print_log("Results written to: %s" % args.output_dir)
+
+# run tool
+if __name__ == "__main__":
+    main()
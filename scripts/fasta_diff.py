@@ -1,59 +1,119 @@
 #! /usr/bin/env python3
 '''
-Compare 2 FASTA files
+Compare 2 FASTA files (sequences are compared case-insensitively)
+
+By default, both files are loaded into memory. With --digest, each file is streamed once into a map of sequence IDs to
+fixed-size digests of the uppercased sequences (optionally hashed by parallel threads), so memory is bounded by the
+number of sequences instead of the size of the files.
 '''
-from gzip import open as gopen
-from sys import argv
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
+from itertools import islice
+from os.path import abspath, dirname
+from sys import path
+import argparse
+path.insert(0, dirname(dirname(abspath(__file__))))
+from true_append_fasta import iter_fasta, load_fasta
+from true_append_io import open_file
+
+# constants
+DIGEST_SIZE = 16 # bytes
+HASH_BATCH = 256 # records per parallel hashing task
+
+# digest a batch of (ID, sequence) records (run in worker threads; hashlib releases the GIL for large inputs)
+def digest_batch(batch):
+    return [(ID, blake2b(seq.upper().encode(), digest_size=DIGEST_SIZE).digest()) for ID, seq in batch]
 
-# load FASTA
-def load_fasta(fn):
-    if fn.strip().lower().endswith('.gz'):
-        infile = gopen(fn, 'rt')
+# stream a FASTA file into a map of sequence digests
+# Argument: `threads` = number of hashing threads
+# Return: `dict` where keys are sequence IDs and values are digests of the uppercased sequences (`bytes`)
+def digest_fasta(fn, threads=1):
+    records = iter_fasta(fn); batches = iter(lambda: list(islice(records, HASH_BATCH)), [])
+    if threads == 1:
+        results = map(digest_batch, batches); executor = None
     else:
-        infile = open(fn, 'r')
-    seqs = dict(); name = None; seq = ''
-    for line in infile:
-        l = line.strip()
-        if len(l) == 0:
-            continue
-        if l[0] == '>':
-            if name is not None:
-                if len(seq) == 0:
-                    raise ValueError("Malformed FASTA: %s" % fn)
-                seqs[name] = seq
-            name = l[1:]
-            if name in seqs:
-                raise ValueError("Duplicate sequence ID (%s): %s" % (name, fn))
-            seq = ''
-        else:
-            seq += l
-    if name is None or len(seq) == 0:
-        raise ValueError("Malformed FASTA: %s" % fn)
-    seqs[name] = seq
-    return seqs
+        executor = ThreadPoolExecutor(max_workers=threads); results = bounded_map(executor, digest_batch, batches, 2*threads)
+    digests = dict()
+    try:
+        for batch in results:
+            for ID, digest in batch:
+                if ID in digests:
+                    raise ValueError("Duplicate sequence ID (%s): %s" % (ID, fn))
+                digests[ID] = digest
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return digests
 
-# compare 2 FASTAs
-def compare_fasta(fn1, fn2):
-    seqs1 = load_fasta(fn1); seqs2 = load_fasta(fn2)
-    seqs_equal = list(); seqs_unequal = list(); seqs_fn1_not_fn2 = list(); seqs_fn2_not_fn1 = list()
+# map a function over an iterable in an executor (in order), with at most `max_pending` tasks in flight
+def bounded_map(executor, func, iterable, max_pending):
+    pending = list()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= max_pending:
+            yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
+
+# compare 2 ID -> sequence (or digest) maps
+# Argument: `keep_ids` = `True` to also return the IDs of differing records (equal records are only counted)
+# Return: `dict` of counts ('equal', 'unequal', 'fn1_not_fn2', 'fn2_not_fn1'), and `dict` of `list` of IDs ('unequal', 'fn1_not_fn2', 'fn2_not_fn1'; `None` if not `keep_ids`)
+def compare_maps(seqs1, seqs2, keep_ids=True):
+    counts = {'equal': 0, 'unequal': 0, 'fn1_not_fn2': 0, 'fn2_not_fn1': 0}
+    ids = {'unequal': list(), 'fn1_not_fn2': list(), 'fn2_not_fn1': list()} if keep_ids else None
+    def add(kind, k):
+        counts[kind] += 1
+        if keep_ids and kind != 'equal':
+            ids[kind].append(k)
     for k in seqs1:
         if k in seqs2:
-            if seqs1[k].upper() == seqs2[k].upper():
-                seqs_equal.append(k)
-            else:
-                seqs_unequal.append(k)
+            add('equal' if seqs1[k] == seqs2[k] else 'unequal', k)
         else:
-                seqs_fn1_not_fn2.append(k)
+            add('fn1_not_fn2', k)
     for k in seqs2:
         if k not in seqs1:
-            seqs_fn2_not_fn1.append(k)
-    print("Same Sequence: %d" % len(seqs_equal))
-    print("Diff Sequence: %d" % len(seqs_unequal))
-    print("Missing in '%s': %d" % (fn1, len(seqs_fn2_not_fn1)))
-    print("Missing in '%s': %d" % (fn2, len(seqs_fn1_not_fn2)))
+            add('fn2_not_fn1', k)
+    return counts, ids
+
+# compare 2 FASTAs
+# Argument: `digest` = `True` to compare digests of the sequences (streamed) instead of the sequences themselves
+# Argument: `threads` = number of hashing threads (digest mode)
+# Argument: `out_fn` = filename of the output list of differing IDs (or `None`)
+def compare_fasta(fn1, fn2, digest=False, threads=1, out_fn=None):
+    if digest:
+        seqs1 = digest_fasta(fn1, threads=threads); seqs2 = digest_fasta(fn2, threads=threads)
+    else:
+        seqs1 = {k: v.upper() for k, v in load_fasta(fn1).items()}; seqs2 = {k: v.upper() for k, v in load_fasta(fn2).items()}
+    counts, ids = compare_maps(seqs1, seqs2, keep_ids=out_fn is not None)
+    print("Same Sequence: %d" % counts['equal'])
+    print("Diff Sequence: %d" % counts['unequal'])
+    print("Missing in '%s': %d" % (fn1, counts['fn2_not_fn1']))
+    print("Missing in '%s': %d" % (fn2, counts['fn1_not_fn2']))
+    if out_fn is not None:
+        out_file = open_file(out_fn, 'w'); out_file.write('ID\tdifference\n')
+        for k in ids['unequal']:
+            out_file.write('%s\tdiff_sequence\n' % k)
+        for k in ids['fn2_not_fn1']:
+            out_file.write('%s\tmissing_in_1\n' % k)
+        for k in ids['fn1_not_fn2']:
+            out_file.write('%s\tmissing_in_2\n' % k)
+        if out_fn != 'stdout':
+            out_file.close()
+
+# parse user args
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('fasta_1', type=str, help="FASTA 1")
+    parser.add_argument('fasta_2', type=str, help="FASTA 2")
+    parser.add_argument('-d', '--digest', action='store_true', help="Compare sequence digests (streamed; bounded memory)")
+    parser.add_argument('-t', '--threads', required=False, type=int, default=1, help="Number of hashing threads (digest mode)")
+    parser.add_argument('-o', '--output', required=False, type=str, default=None, help="Output: Differing IDs (TSV: ID, difference)")
+    args = parser.parse_args()
+    if args.threads < 1:
+        raise ValueError("Number of threads must be positive: %d" % args.threads)
+    return args
 
 # run tool
 if __name__ == "__main__":
-    if len(argv) != 3:
-        print("USAGE: %s <fasta_1> <fasta_2>" % argv[0]); exit(1)
-    compare_fasta(argv[1], argv[2])
+    args = parse_args()
+    compare_fasta(args.fasta_1, args.fasta_2, digest=args.digest, threads=args.threads, out_fn=args.output)
@@ -1,17 +1,31 @@
 #! /usr/bin/env python3
 '''
 Compare 2 TN93 CSV files
+
+By default, both files are loaded into memory. With --streaming, pairs are canonicalized and hash-partitioned into
+temporary files, and each pair of partitions is then joined separately (optionally by parallel processes), so memory
+is bounded by the size of a partition instead of the size of the files.
 '''
-from csv import reader
-from gzip import open as gopen
-from sys import argv
+from csv import reader, writer
+from math import ceil
+from multiprocessing import get_context
+from os import cpu_count
+from os.path import abspath, dirname, getsize, join
+from sys import path
+from tempfile import TemporaryDirectory
+from zlib import crc32
+import argparse
+path.insert(0, dirname(dirname(abspath(__file__))))
+from true_append_io import is_gzip_fn, open_file
+
+# constants
+PARTITION_SIZE = 67108864 # target (uncompressed) bytes of an input file per partition
+GZIP_RATIO = 5 # estimated compression ratio of gzip inputs (to choose the number of partitions)
+WRITE_BATCH = 4096 # rows buffered per partition before writing
 
 # load TN93 CSV
 def load_tn93(fn):
-    if fn.strip().lower().endswith('.gz'):
-        infile = gopen(fn, 'rt')
-    else:
-        infile = open(fn, 'r')
+    infile = open_file(fn)
     dists = dict()
     for row in reader(infile):
         u, v, d = [x.strip() for x in row]
@@ -28,14 +42,25 @@ def load_tn93(fn):
     infile.close()
     return dists
 
+# check if 2 distances are equal (within a tolerance)
+def dists_equal(d1, d2, tolerance=0.):
+    return d1 == d2 or abs(d1 - d2) <= tolerance
+
+# print the comparison counts
+def print_counts(fn1, fn2, num_equal, num_unequal, num_fn1_not_fn2, num_fn2_not_fn1):
+    print("Same Distance: %d pairs" % num_equal)
+    print("Diff Distance: %d pairs" % num_unequal)
+    print("Missing in '%s': %d pairs" % (fn1, num_fn2_not_fn1))
+    print("Missing in '%s': %d pairs" % (fn2, num_fn1_not_fn2))
+
 # compare 2 TN93 CSVs
-def compare_tn93(fn1, fn2):
+def compare_tn93(fn1, fn2, tolerance=0.):
     dists1 = load_tn93(fn1); dists2 = load_tn93(fn2)
     pairs_equal = list(); pairs_unequal = list(); pairs_fn1_not_fn2 = list(); pairs_fn2_not_fn1 = list()
     for u in dists1:
         for v in dists1[u]:
             if u in dists2 and v in dists2[u]:
-                if dists1[u][v] == dists2[u][v]:
+                if dists_equal(dists1[u][v], dists2[u][v], tolerance):
                     pairs_equal.append((u,v))
                 else:
                     pairs_unequal.append((u,v))
@@ -45,13 +70,99 @@ def compare_tn93(fn1, fn2):
         for v in dists2[u]:
             if u not in dists1 or v not in dists1[u]:
                 pairs_fn2_not_fn1.append((u,v))
-    print("Same Distance: %d pairs" % len(pairs_equal))
-    print("Diff Distance: %d pairs" % len(pairs_unequal))
-    print("Missing in '%s': %d pairs" % (fn1, len(pairs_fn2_not_fn1)))
-    print("Missing in '%s': %d pairs" % (fn2, len(pairs_fn1_not_fn2)))
+    print_counts(fn1, fn2, len(pairs_equal), len(pairs_unequal), len(pairs_fn1_not_fn2), len(pairs_fn2_not_fn1))
+
+# hash-partition the canonicalized pairs of a TN93 CSV into `num_partitions` CSV files (`<prefix>.<i>.csv`)
+def partition_tn93(fn, prefix, num_partitions):
+    out_files = [open('%s.%d.csv' % (prefix, i), 'w') for i in range(num_partitions)]
+    outs = [writer(out_file, lineterminator='\n') for out_file in out_files]; batches = [list() for _ in range(num_partitions)]
+    infile = open_file(fn)
+    for row in reader(infile):
+        u, v, d = [x.strip() for x in row]
+        try:
+            float(d)
+        except:
+            continue # header row
+        if v < u:
+            u, v = v, u
+        i = crc32(('%s,%s' % (u, v)).encode()) % num_partitions
+        batches[i].append((u, v, d))
+        if len(batches[i]) == WRITE_BATCH:
+            outs[i].writerows(batches[i]); batches[i] = list()
+    infile.close()
+    for out, out_file, batch in zip(outs, out_files, batches):
+        out.writerows(batch); out_file.close()
+
+# load one partition of a TN93 CSV
+# Return: `dict` where keys are (ID1, ID2) tuples and values are distances
+def load_partition(fn, orig_fn):
+    dists = dict()
+    with open(fn) as infile:
+        for u, v, d in reader(infile):
+            if (u, v) in dists:
+                raise ValueError("Duplicate pairwise distance between '%s' and '%s': %s" % (u, v, orig_fn))
+            dists[(u, v)] = float(d)
+    return dists
+
+# join the partitions of the 2 TN93 CSVs with the same index (in a worker process)
+# Return: number of pairs with equal distances, with unequal distances, only in file 1, and only in file 2
+def join_partition(task):
+    fn1, fn2, part_fn1, part_fn2, tolerance = task
+    dists1 = load_partition(part_fn1, fn1); dists2 = load_partition(part_fn2, fn2)
+    num_equal = 0; num_unequal = 0; num_fn1_not_fn2 = 0
+    for pair, d1 in dists1.items():
+        d2 = dists2.pop(pair, None)
+        if d2 is None:
+            num_fn1_not_fn2 += 1
+        elif dists_equal(d1, d2, tolerance):
+            num_equal += 1
+        else:
+            num_unequal += 1
+    return num_equal, num_unequal, num_fn1_not_fn2, len(dists2)
+
+# compare 2 TN93 CSVs by hash-partitioning them to disk
+# Argument: `num_partitions` = number of partitions (default: from the input file sizes)
+# Argument: `processes` = number of partitions joined in parallel
+# Argument: `tmp_dir` = parent directory of the temporary partition files (default: system temporary directory)
+def compare_tn93_streaming(fn1, fn2, tolerance=0., num_partitions=None, processes=1, tmp_dir=None):
+    if num_partitions is None:
+        size = max(getsize(fn) * (GZIP_RATIO if is_gzip_fn(fn) else 1) for fn in [fn1, fn2])
+        num_partitions = max(1, ceil(size / PARTITION_SIZE))
+    with TemporaryDirectory(dir=tmp_dir) as part_dir:
+        partition_tn93(fn1, join(part_dir, '1'), num_partitions); partition_tn93(fn2, join(part_dir, '2'), num_partitions)
+        tasks = [(fn1, fn2, join(part_dir, '1.%d.csv' % i), join(part_dir, '2.%d.csv' % i), tolerance) for i in range(num_partitions)]
+        if processes == 1:
+            results = map(join_partition, tasks)
+        else:
+            pool = get_context('fork').Pool(processes); results = pool.imap_unordered(join_partition, tasks)
+        totals = [0, 0, 0, 0]
+        for result in results:
+            totals = [a + b for a, b in zip(totals, result)]
+        if processes != 1:
+            pool.close(); pool.join()
+    print_counts(fn1, fn2, *totals)
+
+# parse user args
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('tn93_csv_1', type=str, help="TN93 CSV 1")
+    parser.add_argument('tn93_csv_2', type=str, help="TN93 CSV 2")
+    parser.add_argument('--tolerance', required=False, type=float, default=0., help="Distances that differ by at most this much are considered equal (default: 0)")
+    parser.add_argument('-s', '--streaming', action='store_true', help="Compare by hash-partitioning to disk (bounded memory)")
+    parser.add_argument('--partitions', required=False, type=int, default=None, help="Number of partitions (streaming; default: ~%d MB of input per partition)" % (PARTITION_SIZE // 1048576))
+    parser.add_argument('-p', '--processes', required=False, type=int, default=1, help="Number of partitions joined in parallel (streaming; default: 1, max: %d)" % (cpu_count() or 1))
+    parser.add_argument('--tmp_dir', required=False, type=str, default=None, help="Directory for temporary partition files (streaming)")
+    args = parser.parse_args()
+    if args.tolerance < 0:
+        raise ValueError("Tolerance must be non-negative: %s" % args.tolerance)
+    if (args.partitions is not None and args.partitions < 1) or args.processes < 1:
+        raise ValueError("Number of partitions and processes must be positive")
+    return args
 
 # run tool
 if __name__ == "__main__":
-    if len(argv) != 3:
-        print("USAGE: %s <tn93_csv_1> <tn93_csv_2>" % argv[0]); exit(1)
-    compare_tn93(argv[1], argv[2])
+    args = parse_args()
+    if args.streaming:
+        compare_tn93_streaming(args.tn93_csv_1, args.tn93_csv_2, tolerance=args.tolerance, num_partitions=args.partitions, processes=args.processes, tmp_dir=args.tmp_dir)
+    else:
+        compare_tn93(args.tn93_csv_1, args.tn93_csv_2, tolerance=args.tolerance)
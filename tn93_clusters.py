@@ -0,0 +1,264 @@
+#! /usr/bin/env python3
+'''
+Incremental clustering of a TN93 edge list (connected components of the sub-threshold distance graph)
+
+Cluster membership is written with each sequence's digest, so the next run can tell which IDs were added, replaced, or
+deleted (compared to the table's sequence digest index). Clusters of kept IDs are reused as-is, edges involving
+added or replaced IDs are applied with union-find, and only clusters that lost a (deleted or replaced) member are
+recomputed from their remaining internal edges. Clusters keep their number when they keep their largest share of members.
+
+  tn93_clusters.py -i Network-Old-2.tn93.csv -iI Network-Old-2.tn93.csv.seqidx -o Network-Old-2.clusters.csv
+  tn93_clusters.py -i Network-Old-3.tn93.csv -iI Network-Old-3.tn93.csv.seqidx -iC Network-Old-2.clusters.csv -o Network-Old-3.clusters.csv -r changes.tsv
+'''
+
+# imports
+from csv import reader
+from datetime import datetime
+from os.path import isfile
+from sys import argv, stderr, stdin, stdout
+from tn93_true_append import parse_table, DEFAULT_ID_COL, DEFAULT_SEQ_COL, DEFAULT_THRESHOLD
+from true_append_index import build_index, load_index
+from true_append_io import open_file
+from true_append_metrics import add_metrics_args, metrics_from_args
+import argparse
+
+# constants
+TN93_CLUSTERS_VERSION = '0.0.1'
+CLUSTERS_HEADER = 'ID,Cluster,Digest'
+REPORT_HEADER = 'Cluster\tStatus\tSize\tOld Size\tOld Clusters'
+STDIO = {'stderr':stderr, 'stdin':stdin, 'stdout':stdout}
+
+# return the current time as a string
+def get_time():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+# print to log (prefixed by current time)
+def print_log(s='', end='\n'):
+    print("[%s] %s" % (get_time(), s), file=stderr, end=end); stderr.flush()
+
+# parse user args
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-i', '--input_dists', required=True, type=str, help="Input: Pairwise distances of the current dataset (TN93 CSV)")
+    parser.add_argument('-it', '--input_table', required=False, type=str, default=None, help="Input: User table (CSV)")
+    parser.add_argument('-iI', '--input_index', required=False, type=str, default=None, help="Input: User table sequence digest index (instead of --input_table)")
+    parser.add_argument('-iC', '--input_old_clusters', required=False, type=str, default=None, help="Input: Old cluster membership (CSV written by this tool; default: cluster from scratch)")
+    parser.add_argument('-o', '--output', required=False, type=str, default='stdout', help="Output: Cluster membership (CSV)")
+    parser.add_argument('-r', '--report', required=False, type=str, default=None, help="Output: Changed clusters (TSV)")
+    parser.add_argument('-t', '--threshold', required=False, type=float, default=DEFAULT_THRESHOLD, help="Distance threshold (only cluster pairs with distance <= threshold; must match the old clusters)")
+    parser.add_argument('--id_col', required=False, type=str, default=DEFAULT_ID_COL, help="Sequence ID column in the table")
+    parser.add_argument('--seq_col', required=False, type=str, default=DEFAULT_SEQ_COL, help="Sequence column in the table")
+    add_metrics_args(parser)
+    args = parser.parse_args()
+    if (args.input_table is None) == (args.input_index is None):
+        raise ValueError("Must specify exactly one of --input_table or --input_index")
+    for fn in [args.input_dists, args.input_table, args.input_index, args.input_old_clusters]:
+        if fn is not None and not isfile(fn) and fn not in STDIO and not fn.startswith('/dev/fd'):
+            raise ValueError("File not found: %s" % fn)
+    for fn in [args.output, args.report]:
+        if fn is not None and isfile(fn):
+            raise ValueError("File exists: %s" % fn)
+    return args
+
+# union-find (disjoint sets) over sequence IDs
+class UnionFind:
+    def __init__(self):
+        self.parent = dict(); self.size = dict()
+
+    # add an ID as its own set (if it isn't in a set yet)
+    def add(self, ID):
+        if ID not in self.parent:
+            self.parent[ID] = ID; self.size[ID] = 1
+
+    # return the representative of the set containing an ID
+    def find(self, ID):
+        parent = self.parent
+        while parent[ID] != ID:
+            parent[ID] = parent[parent[ID]]; ID = parent[ID] # (path halving)
+        return ID
+
+    # merge the sets containing 2 IDs (the smaller set joins the larger one)
+    def union(self, u, v):
+        self.add(u); self.add(v); u = self.find(u); v = self.find(v)
+        if u == v:
+            return
+        if self.size[u] < self.size[v]:
+            u, v = v, u
+        self.parent[v] = u; self.size[u] += self.size[v]
+
+    # return the sets
+    # Return: `dict` where keys are representatives and values are `list`s of IDs
+    def components(self):
+        out = dict()
+        for ID in self.parent:
+            root = self.find(ID)
+            if root not in out:
+                out[root] = list()
+            out[root].append(ID)
+        return out
+
+# load cluster membership written by `write_clusters`
+# Return: `dict` where keys are sequence IDs and values are (cluster, digest) tuples
+def load_clusters(fn):
+    infile = open_file(fn); clusters = dict()
+    header = infile.readline().rstrip('\n')
+    if header != CLUSTERS_HEADER:
+        raise ValueError("Invalid cluster membership (expected header '%s'): %s" % (CLUSTERS_HEADER, fn))
+    for row in reader(infile):
+        if len(row) == 0:
+            continue
+        if len(row) != 3:
+            raise ValueError("Malformed cluster membership: %s" % fn)
+        ID, cluster, digest = row
+        if ID in clusters:
+            raise ValueError("Duplicate sequence ID (%s): %s" % (ID, fn))
+        clusters[ID] = (int(cluster), digest)
+    infile.close()
+    return clusters
+
+# write cluster membership (sorted by cluster, then ID)
+# Argument: `clusters` = `dict` where keys are sequence IDs and values are clusters
+# Argument: `index` = digest index of the sequences (`dict` where keys are sequence IDs and values are (digest, length) tuples)
+def write_clusters(fn, clusters, index):
+    out_file = open_file(fn, 'w'); out_file.write(CLUSTERS_HEADER + '\n')
+    for ID in sorted(clusters.keys(), key=lambda ID: (clusters[ID], ID)):
+        if ID not in index:
+            raise ValueError("Sequence ID (%s) in distances is missing from the table" % ID)
+        out_file.write('%s,%d,%s\n' % (ID, clusters[ID], index[ID][0]))
+    if fn in STDIO:
+        out_file.flush()
+    else:
+        out_file.close()
+
+# update clusters with the current edge list
+# Argument: `dists_fn` = filename of the current TN93 CSV
+# Argument: `index` = digest index of the current dataset
+# Argument: `old_clusters` = `dict` where keys are sequence IDs and values are (cluster, digest) tuples (empty to cluster from scratch)
+# Return: `uf` = `UnionFind` of the current clusters (only IDs in non-singleton clusters, or in recomputed old clusters)
+# Return: `stats` = `dict` of counts ('removed', 'recomputed', 'recomputed_ids', 'edges')
+def update_clusters(dists_fn, index, old_clusters, threshold=DEFAULT_THRESHOLD):
+    removed = {ID for ID, (cluster, digest) in old_clusters.items() if ID not in index or index[ID][0] != digest} # deleted or replaced
+    affected = {old_clusters[ID][0] for ID in removed}
+    kept = {ID for ID in old_clusters if ID not in removed}
+    recompute = {ID for ID in kept if old_clusters[ID][0] in affected}
+    uf = UnionFind(); first = dict()
+    for ID in kept: # reuse unaffected clusters as-is (and start affected members as singletons)
+        uf.add(ID); cluster = old_clusters[ID][0]
+        if cluster not in affected:
+            if cluster in first:
+                uf.union(first[cluster], ID)
+            else:
+                first[cluster] = ID
+    dists_file = open_file(dists_fn); num_edges = 0
+    for line in dists_file:
+        parts = line.split(',')
+        if len(parts) != 3:
+            continue
+        u = parts[0].strip(); v = parts[1].strip()
+        # edges between kept IDs are already in the old clusters, unless both ends are in a recomputed cluster
+        if (u in kept and v in kept) and not (u in recompute and v in recompute):
+            continue
+        try:
+            d = float(parts[2])
+        except ValueError:
+            continue # header row
+        if d <= threshold:
+            uf.union(u, v); num_edges += 1
+    dists_file.close()
+    stats = {'removed': len(removed), 'recomputed': len(affected), 'recomputed_ids': len(recompute), 'edges': num_edges}
+    return uf, stats
+
+# label the current clusters, keeping old cluster numbers where possible, and report the changed clusters
+# Argument: `components` = `list` of `list`s of IDs (non-singleton clusters)
+# Argument: `old_clusters` = `dict` where keys are sequence IDs and values are (cluster, digest) tuples
+# Return: `clusters` = `dict` where keys are sequence IDs and values are clusters
+# Return: `report` = `list` of (cluster, status, size, old size, old clusters) tuples of changed clusters
+def label_clusters(components, old_clusters):
+    old_sizes = dict()
+    for cluster, digest in old_clusters.values():
+        old_sizes[cluster] = old_sizes.get(cluster, 0) + 1
+    next_cluster = max(old_sizes.keys(), default=0) + 1
+    # each old cluster number goes to the current cluster holding most of its members (ties: the first one)
+    components = sorted((sorted(members) for members in components), key=lambda members: members[0])
+    shares = list(); owner = dict(); num_parts = dict()
+    for i, members in enumerate(components):
+        counts = dict()
+        for ID in members:
+            if ID in old_clusters:
+                counts[old_clusters[ID][0]] = counts.get(old_clusters[ID][0], 0) + 1
+        shares.append(counts)
+        for cluster, n in counts.items():
+            num_parts[cluster] = num_parts.get(cluster, 0) + 1
+            if cluster not in owner or n > shares[owner[cluster]][cluster]:
+                owner[cluster] = i
+    clusters = dict(); report = list()
+    for i, members in enumerate(components):
+        counts = shares[i]; owned = [cluster for cluster in counts if owner[cluster] == i]
+        if len(owned) == 0:
+            label = next_cluster; next_cluster += 1
+        else:
+            label = min(owned, key=lambda cluster: (-counts[cluster], cluster))
+        for ID in members:
+            clusters[ID] = label
+        old = sorted(counts.keys())
+        if len(old) == 0:
+            status = 'new'
+        elif len(old) > 1:
+            status = 'merged'
+        elif num_parts[old[0]] > 1:
+            status = 'split'
+        else:
+            gained = len(members) - counts[old[0]]; lost = old_sizes[old[0]] - counts[old[0]]
+            if gained == 0 and lost == 0:
+                continue # unchanged
+            status = 'shrunk' if gained == 0 else 'grown' if lost == 0 else 'changed'
+        report.append((label, status, len(members), sum(old_sizes[cluster] for cluster in old), ';'.join(str(cluster) for cluster in old)))
+    for cluster in sorted(set(old_sizes.keys()) - set(owner.keys())):
+        report.append((cluster, 'removed', 0, old_sizes[cluster], str(cluster)))
+    report.sort()
+    return clusters, report
+
+# main program
+def main():
+    print_log("Running TN93 Clusters v%s" % TN93_CLUSTERS_VERSION)
+    args = parse_args()
+    print_log("Command: %s" % ' '.join(argv))
+    metrics = metrics_from_args(args, 'tn93_clusters')
+    with metrics.phase('parse_user') as counts:
+        if args.input_index is None:
+            print_log("Parsing user table: %s" % args.input_table)
+            index = build_index(parse_table(args.input_table, id_col=args.id_col, seq_col=args.seq_col))
+        else:
+            print_log("Loading user table sequence index: %s" % args.input_index)
+            index = load_index(args.input_index)
+        print_log("- Num Sequences: %s" % len(index)); counts['sequences'] = len(index)
+    with metrics.phase('parse_old') as counts:
+        old_clusters = dict()
+        if args.input_old_clusters is not None:
+            print_log("Loading old cluster membership: %s" % args.input_old_clusters)
+            old_clusters = load_clusters(args.input_old_clusters)
+        print_log("- Num Clustered Sequences: %s" % len(old_clusters)); counts['sequences'] = len(old_clusters)
+    with metrics.phase('compute') as counts:
+        print_log("Updating clusters with edges from: %s" % args.input_dists)
+        uf, stats = update_clusters(args.input_dists, index, old_clusters, threshold=args.threshold)
+        print_log("- Deleted or Replaced Clustered Sequences: %s" % stats['removed'])
+        print_log("- Recomputed Clusters: %s (%s sequences)" % (stats['recomputed'], stats['recomputed_ids']))
+        print_log("- Applied Edges: %s" % stats['edges'])
+        components = [members for members in uf.components().values() if len(members) > 1]
+        clusters, report = label_clusters(components, old_clusters)
+        print_log("- Num Clusters: %s (%s sequences)" % (len(components), len(clusters)))
+        print_log("- Changed Clusters: %s" % len(report)); counts.update(stats); counts.update({'clusters': len(components), 'changed': len(report)})
+    with metrics.phase('write') as counts:
+        print_log("Writing cluster membership: %s" % args.output)
+        write_clusters(args.output, clusters, index); counts['sequences'] = len(clusters)
+        if args.report is not None:
+            print_log("Writing changed clusters report: %s" % args.report)
+            report_file = open_file(args.report, 'w'); report_file.write(REPORT_HEADER + '\n')
+            for row in report:
+                report_file.write('%s\t%s\t%d\t%d\t%s\n' % row)
+            report_file.close()
+    metrics.close()
+
+# run main program
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+#! /usr/bin/env python3
+'''
+Binary edge store for TN93 distances (a compact, memory-mappable alternative to TN93 CSV)
+
+An edge store is a directory holding an ID dictionary and 3 raw little-endian column files:
+
+  ids.txt    header line (format version, number of IDs, number of edges), then one ID per line (its line number is its index)
+  id1.u32    uint32 index of the first ID of each edge
+  id2.u32    uint32 index of the second ID of each edge
+  dist.f32   float32 distance of each edge
+
+Columns are memory-mapped when loaded, so dropping the edges of deleted/replaced IDs or applying a threshold is a
+vectorized mask instead of a parse of every CSV row. float32 holds the 6 significant digits TN93 CSVs are written with,
+so converting a TN93 CSV to an edge store and back reproduces it (up to the formatting of the distances).
+This script converts between TN93 CSV and edge stores, optionally dropping IDs and applying a threshold:
+
+  tn93_edge_store.py -i Network-Old-4.tn93.csv -o Network-Old-4.edges
+  tn93_edge_store.py -i Network-Old-4.edges -o Network-Old-4.tn93.csv -t 0.01 --drop deleted_ids.txt
+'''
+
+# imports
+from array import array
+from os import makedirs
+from os.path import isdir, isfile, join
+from sys import byteorder, stderr, stdin, stdout
+from true_append_io import open_file
+import argparse
+import numpy as np
+
+# constants
+EDGE_STORE_VERSION = 1
+EDGE_STORE_HEADER = '#true_append_edges\tv%d' % EDGE_STORE_VERSION
+DEFAULT_EDGE_STORE_SUFFIX = '.edges'
+IDS_FN = 'ids.txt'
+COLUMNS = [('id1.u32', np.dtype('<u4'), 'I'), ('id2.u32', np.dtype('<u4'), 'I'), ('dist.f32', np.dtype('<f4'), 'f')]
+BUFFER_EDGES = 1048576 # edges buffered before writing
+CSV_CHUNK = 1048576 # edges formatted per write when converting to CSV
+MAX_IDS = 1 << 32
+FORMATS = {'csv', 'edges'}
+TN93_HEADER = 'ID1,ID2,Distance' # (as in tn93_true_append.py)
+STDIO = {'stderr':stderr, 'stdin':stdin, 'stdout':stdout}
+
+# return `True` if a path is an edge store
+def is_edge_store(fn):
+    return isdir(fn) and isfile(join(fn, IDS_FN))
+
+# streaming edge store writer
+class EdgeStoreWriter:
+    # create (or overwrite) the edge store in directory `dn`
+    def __init__(self, dn):
+        makedirs(dn, exist_ok=True); self.dn = dn; self.ids = dict(); self.num_edges = 0
+        self.files = [open(join(dn, fn), 'wb') for fn, dtype, typecode in COLUMNS]
+        self.buffers = [array(typecode) for fn, dtype, typecode in COLUMNS]
+
+    # return the index of an ID (adding it to the dictionary if needed)
+    def id_index(self, ID):
+        if ID not in self.ids:
+            if len(self.ids) == MAX_IDS:
+                raise ValueError("Too many IDs for an edge store: %s" % self.dn)
+            self.ids[ID] = len(self.ids)
+        return self.ids[ID]
+
+    # add one edge
+    def add(self, u, v, d):
+        id1, id2, dist = self.buffers
+        id1.append(self.id_index(u)); id2.append(self.id_index(v)); dist.append(d)
+        if len(dist) == BUFFER_EDGES:
+            self.flush()
+
+    # add edges given as lists of first IDs, second IDs, and distances
+    def add_many(self, us, vs, ds):
+        ids = self.ids; id_index = self.id_index; id1, id2, dist = self.buffers
+        id1.extend([ids[u] if u in ids else id_index(u) for u in us]); id2.extend([ids[v] if v in ids else id_index(v) for v in vs]); dist.extend(ds)
+        if len(dist) >= BUFFER_EDGES:
+            self.flush()
+
+    # add edges given as columns (e.g. filtered columns of another edge store)
+    # Argument: `IDs` = `list` of the IDs the indices in `id1` and `id2` refer to
+    def add_columns(self, IDs, id1, id2, dist):
+        self.flush()
+        if len(dist) == 0:
+            return
+        used = np.zeros(len(IDs), dtype=bool); used[id1] = True; used[id2] = True
+        mapping = np.zeros(len(IDs), dtype=np.uint32)
+        for i in np.flatnonzero(used):
+            mapping[i] = self.id_index(IDs[i])
+        for out_file, (fn, dtype, typecode), column in zip(self.files, COLUMNS, [mapping[id1], mapping[id2], dist]):
+            out_file.write(np.ascontiguousarray(column, dtype=dtype).tobytes())
+        self.num_edges += len(dist)
+
+    # write the buffered edges
+    def flush(self):
+        for out_file, buf in zip(self.files, self.buffers):
+            if byteorder != 'little':
+                buf.byteswap()
+            out_file.write(buf.tobytes())
+        self.num_edges += len(self.buffers[2]); self.buffers = [array(typecode) for fn, dtype, typecode in COLUMNS]
+
+    # write the buffered edges and the ID dictionary
+    def close(self):
+        self.flush()
+        for out_file in self.files:
+            out_file.close()
+        with open(join(self.dn, IDS_FN), 'w') as ids_file:
+            ids_file.write('%s\t%d\t%d\n' % (EDGE_STORE_HEADER, len(self.ids), self.num_edges))
+            for ID in self.ids:
+                ids_file.write('%s\n' % ID)
+
+# load an edge store
+# Argument: `dn` = edge store directory
+# Argument: `mmap` = `True` to memory-map the columns (otherwise, they are read into memory)
+# Return: `IDs` = `list` of IDs (indexed by the values of `id1` and `id2`)
+# Return: `id1`, `id2`, `dist` = `numpy.ndarray` columns (uint32, uint32, and float32)
+def load_edges(dn, mmap=True):
+    with open(join(dn, IDS_FN)) as ids_file:
+        header = ids_file.readline().rstrip('\n').split('\t')
+        if len(header) != 4 or '\t'.join(header[:2]) != EDGE_STORE_HEADER:
+            raise ValueError("Invalid or incompatible edge store (expected header '%s'): %s" % (EDGE_STORE_HEADER, dn))
+        num_ids = int(header[2]); num_edges = int(header[3])
+        IDs = [line.rstrip('\n') for line in ids_file]
+    if len(IDs) != num_ids:
+        raise ValueError("Malformed edge store (expected %d IDs, found %d): %s" % (num_ids, len(IDs), dn))
+    columns = list()
+    for fn, dtype, typecode in COLUMNS:
+        path = join(dn, fn)
+        if num_edges == 0:
+            column = np.zeros(0, dtype=dtype)
+        elif mmap:
+            column = np.memmap(path, dtype=dtype, mode='r', shape=(num_edges,))
+        else:
+            column = np.fromfile(path, dtype=dtype, count=num_edges)
+        if len(column) != num_edges:
+            raise ValueError("Malformed edge store (truncated %s): %s" % (fn, dn))
+        columns.append(column)
+    return (IDs,) + tuple(columns)
+
+# select edges (vectorized)
+# Argument: `IDs`, `id1`, `id2`, `dist` = edge store (see `load_edges`)
+# Argument: `to_remove` = `set` containing IDs whose edges must be dropped (or `None`)
+# Argument: `threshold` = maximum distance of the kept edges (or `None`)
+# Return: `numpy.ndarray` of `bool` (`True` for kept edges)
+def select_edges(IDs, id1, id2, dist, to_remove=None, threshold=None):
+    keep = np.ones(len(dist), dtype=bool)
+    if to_remove is not None and len(to_remove) != 0:
+        drop = np.fromiter((ID in to_remove for ID in IDs), dtype=bool, count=len(IDs))
+        if drop.any():
+            keep &= ~drop[id1]; keep &= ~drop[id2]
+    if threshold is not None:
+        keep &= dist <= threshold
+    return keep
+
+# write the selected edges of an edge store as TN93 CSV rows (without a header)
+# Argument: `keep` = `numpy.ndarray` of `bool` (see `select_edges`), or `None` for all edges
+# Return: number of edges written
+def write_edges_csv(IDs, id1, id2, dist, out_file, keep=None):
+    IDs = np.array(IDs, dtype=object); num_written = 0
+    for start in range(0, len(dist), CSV_CHUNK):
+        end = min(start + CSV_CHUNK, len(dist)); rows = slice(start, end)
+        if keep is None:
+            u = IDs[id1[rows]]; v = IDs[id2[rows]]; d = dist[rows]
+        else:
+            kept = np.flatnonzero(keep[rows]) + start; u = IDs[id1[kept]]; v = IDs[id2[kept]]; d = dist[kept]
+        if len(d) != 0:
+            out_file.write(''.join(['%s,%s,%g\n' % row for row in zip(u.tolist(), v.tolist(), d.tolist())]))
+        num_written += len(d)
+    return num_written
+
+# iterate over the edges of a TN93 CSV
+# Return: generator of (line, ID1, ID2, distance) tuples (header rows are skipped)
+def iter_csv_edges(csv_fn):
+    infile = open_file(csv_fn)
+    for line in infile:
+        parts = line.split(',')
+        if len(parts) != 3:
+            continue
+        try:
+            d = float(parts[2])
+        except ValueError:
+            continue # header row
+        yield line, parts[0].strip(), parts[1].strip(), d
+    infile.close()
+
+# convert TN93 CSV rows to an edge store
+# Return: number of edges converted
+def csv_to_edges(csv_fn, writer, to_remove=None, threshold=None):
+    num_edges = 0; us = list(); vs = list(); ds = list()
+    for line, u, v, d in iter_csv_edges(csv_fn):
+        if (to_remove is not None and (u in to_remove or v in to_remove)) or (threshold is not None and d > threshold):
+            continue
+        us.append(u); vs.append(v); ds.append(d)
+        if len(ds) == BUFFER_EDGES:
+            writer.add_many(us, vs, ds); num_edges += len(ds); us = list(); vs = list(); ds = list()
+    writer.add_many(us, vs, ds); num_edges += len(ds)
+    return num_edges
+
+# parse user args
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-i', '--input', required=True, type=str, help="Input: Pairwise distances (TN93 CSV or edge store)")
+    parser.add_argument('-o', '--output', required=False, type=str, default='stdout', help="Output: Pairwise distances (TN93 CSV or edge store)")
+    parser.add_argument('-f', '--format', required=False, type=str, default=None, help="Output format (%s; default: edges if the output ends with '%s', otherwise csv)" % (', '.join(sorted(FORMATS)), DEFAULT_EDGE_STORE_SUFFIX))
+    parser.add_argument('-t', '--threshold', required=False, type=float, default=None, help="Only keep pairs with distance <= threshold")
+    parser.add_argument('--drop', required=False, type=str, default=None, help="Drop all pairs involving the IDs in this file (one per line)")
+    args = parser.parse_args()
+    if args.format is None:
+        args.format = 'edges' if args.output.endswith(DEFAULT_EDGE_STORE_SUFFIX) else 'csv'
+    if args.format not in FORMATS:
+        raise ValueError("Invalid output format (%s). Options: %s" % (args.format, ', '.join(sorted(FORMATS))))
+    if args.format == 'edges' and args.output in STDIO:
+        raise ValueError("Must specify an output directory (-o) for an edge store")
+    for fn in [args.input, args.drop]:
+        if fn is not None and not isfile(fn) and not is_edge_store(fn) and fn not in STDIO and not fn.startswith('/dev/fd'):
+            raise ValueError("File not found: %s" % fn)
+    if isfile(args.output) or isdir(args.output):
+        raise ValueError("File exists: %s" % args.output)
+    return args
+
+# main program
+def main():
+    args = parse_args(); to_remove = None
+    if args.drop is not None:
+        drop_file = open_file(args.drop); to_remove = {line.strip() for line in drop_file if len(line.strip()) != 0}; drop_file.close()
+    if args.format == 'edges':
+        writer = EdgeStoreWriter(args.output)
+        if is_edge_store(args.input):
+            IDs, id1, id2, dist = load_edges(args.input); keep = select_edges(IDs, id1, id2, dist, to_remove=to_remove, threshold=args.threshold)
+            writer.add_columns(IDs, id1[keep], id2[keep], dist[keep]); num_edges = int(keep.sum())
+        else:
+            num_edges = csv_to_edges(args.input, writer, to_remove=to_remove, threshold=args.threshold)
+        writer.close()
+    else:
+        out_file = open_file(args.output, 'w'); out_file.write(TN93_HEADER + '\n')
+        if is_edge_store(args.input):
+            IDs, id1, id2, dist = load_edges(args.input); keep = None
+            if to_remove is not None or args.threshold is not None:
+                keep = select_edges(IDs, id1, id2, dist, to_remove=to_remove, threshold=args.threshold)
+            num_edges = write_edges_csv(IDs, id1, id2, dist, out_file, keep=keep)
+        else:
+            num_edges = 0
+            for line, u, v, d in iter_csv_edges(args.input):
+                if (to_remove is not None and (u in to_remove or v in to_remove)) or (args.threshold is not None and d > args.threshold):
+                    continue
+                out_file.write(line if line.endswith('\n') else line + '\n'); num_edges += 1
+        if args.output in STDIO:
+            out_file.flush()
+        else:
+            out_file.close()
+    print("Wrote %d edges: %s" % (num_edges, args.output), file=stderr)
+
+# run main program
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+'''
+Block sketch candidate-pair prefilter for threshold-limited TN93 distances
+
+Each aligned sequence is summarized by a sketch: the exact contents of its fixed-width blocks of positions (packed into
+one integer per block, or 0 if the block holds a gap or an ambiguous nucleotide) and its number of non-gap positions.
+If two sequences differ in a block where both are unambiguous, they mismatch at >= 1 position of that block, and the
+TN93 distance is never smaller than the mismatch proportion (its log corrections only increase it), so
+
+    TN93(a, b) >= (number of such blocks) / min(non-gap(a), non-gap(b))
+
+Pairs whose bound exceeds the threshold (or that can't reach the minimum overlap) are discarded before the exact TN93
+computation. The bound is conservative, so prefiltering never changes the output. Sketches are saved in an npz index
+keyed by sequence digest, so the next run only sketches added and replaced sequences.
+'''
+
+# imports
+import numpy as np
+
+# constants
+SKETCH_VERSION = 1
+DEFAULT_SKETCH_SUFFIX = '.sketch.npz'
+DEFAULT_BLOCK_SIZE = 8 # positions per block
+MAX_BLOCK_SIZE = 16 # 4-bit nucleotide codes packed into 64 bits
+UNAMBIGUOUS_CODES = np.array([1, 2, 4, 8], dtype=np.uint8) # A, C, G, T (see `NUCLEOTIDE_BITS` in tn93_true_append.py)
+BOUND_CHUNK = 8388608 # query x reference x block comparisons per chunk (bounds the temporary memory)
+BOUND_TOLERANCE = 1e-9 # relative slack on the threshold (so rounding in the exact distance can't be cut off)
+
+# integer type of the block values of a given block size
+def block_dtype(block_size):
+    return np.uint32 if block_size <= 8 else np.uint64
+
+# sketch encoded sequences
+# Argument: `IDs` = `list` of sequence IDs
+# Argument: `encoded` = `numpy.ndarray` of shape (len(IDs), L) holding nucleotide bitmasks (see `encode_seqs` in tn93_true_append.py)
+# Return: `dict` where keys are sequence IDs and values are (block values, number of non-gap positions) tuples
+def build_sketch(IDs, encoded, block_size=DEFAULT_BLOCK_SIZE):
+    N, L = encoded.shape; B = -(-L // block_size); dtype = block_dtype(block_size)
+    padded = np.zeros((N, B * block_size), dtype=np.uint8); padded[:,:L] = encoded
+    blocks = padded.reshape(N, B, block_size)
+    shifts = (4 * np.arange(block_size)).astype(dtype)
+    values = (blocks.astype(dtype) << shifts).sum(axis=2, dtype=dtype)
+    values[~np.isin(blocks, UNAMBIGUOUS_CODES).all(axis=2)] = 0
+    nongap = (encoded != 0).sum(axis=1)
+    return {ID: (values[i], int(nongap[i])) for i, ID in enumerate(IDs)}
+
+# stack the sketches of sequences (shorter sketches padded with gap blocks)
+# Argument: `sketch` = `dict` where keys are sequence IDs and values are (block values, number of non-gap positions) tuples
+# Argument: `IDs` = `list` of sequence IDs (row order)
+# Return: `numpy.ndarray` of shape (len(IDs), max blocks) holding block values, and `numpy.ndarray` of shape (len(IDs),) holding non-gap counts
+def stack_sketch(sketch, IDs, block_size=DEFAULT_BLOCK_SIZE):
+    B = max((len(sketch[ID][0]) for ID in IDs), default=0)
+    values = np.zeros((len(IDs), B), dtype=block_dtype(block_size)); nongap = np.zeros(len(IDs), dtype=np.int64)
+    for i, ID in enumerate(IDs):
+        row, n = sketch[ID]; values[i,:len(row)] = row; nongap[i] = n
+    return values, nongap
+
+# find the candidate pairs of a block of query and reference sequences
+# Argument: `q_values`/`q_nongap` = stacked sketches of the query sequences (see `stack_sketch`)
+# Argument: `r_values`/`r_nongap` = stacked sketches of the reference sequences (with the same number of blocks)
+# Return: `numpy.ndarray` of shape (Q, R) holding `True` for pairs whose TN93 distance may be <= `threshold`
+def sketch_candidates(q_values, q_nongap, r_values, r_nongap, threshold, min_overlap):
+    Q, B = q_values.shape; R = r_values.shape[0]
+    overlap = np.minimum(q_nongap[:,None], r_nongap[None,:])
+    # blocks that differ, minus those that differ only because one of the two sequences is unknown there (a matrix product)
+    q_unknown = q_values == 0; r_unknown = r_values == 0
+    num_diff = -(q_unknown.astype(np.float32) @ (~r_unknown).T.astype(np.float32) + (~q_unknown).astype(np.float32) @ r_unknown.T.astype(np.float32)).astype(np.int64)
+    step = max(1, BOUND_CHUNK // max(1, R * B))
+    for start in range(0, Q, step):
+        num_diff[start:start+step] += np.count_nonzero(q_values[start:start+step,None,:] != r_values[None,:,:], axis=2)
+    return (overlap >= min_overlap) & (num_diff <= threshold * (1 + BOUND_TOLERANCE) * overlap)
+
+# load a sketch index written by `write_sketch`
+# Argument: `fn` = filename of the sketch index
+# Argument: `index` = current digest index (`dict` where keys are sequence IDs and values are (digest, length) tuples): only sketches of sequences with the same digest are loaded
+# Return: `dict` where keys are sequence IDs and values are (block values, number of non-gap positions) tuples
+def load_sketch(fn, index, block_size=DEFAULT_BLOCK_SIZE):
+    with np.load(fn) as data:
+        if int(data['version']) != SKETCH_VERSION or int(data['block_size']) != block_size:
+            raise ValueError("Incompatible sketch index (expected v%d with block size %d): %s" % (SKETCH_VERSION, block_size, fn))
+        IDs = data['ids']; digests = data['digests']; values = data['values']; nongap = data['nongap']
+    sketch = dict()
+    for i, ID in enumerate(IDs.tolist()):
+        if ID in index and index[ID][0] == digests[i]:
+            sketch[ID] = (values[i], int(nongap[i]))
+    return sketch
+
+# write a sketch index
+# Argument: `fn` = filename of the sketch index
+# Argument: `sketch` = `dict` where keys are sequence IDs and values are (block values, number of non-gap positions) tuples
+# Argument: `index` = digest index of the sketched sequences (`dict` where keys are sequence IDs and values are (digest, length) tuples)
+def write_sketch(fn, sketch, index, block_size=DEFAULT_BLOCK_SIZE):
+    IDs = sorted(sketch.keys()); values, nongap = stack_sketch(sketch, IDs, block_size=block_size)
+    with open(fn, 'wb') as out_file: # (a file object, so numpy doesn't append '.npz' to the filename)
+        np.savez(out_file, version=SKETCH_VERSION, block_size=block_size, ids=np.array(IDs, dtype=str),
+                 digests=np.array([index[ID][0] for ID in IDs], dtype=str), values=values, nongap=nongap)
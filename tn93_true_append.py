@@ -0,0 +1,450 @@
+#! /usr/bin/env python3
+'''
+True Append for TN93
+'''
+
+# imports
+from csv import reader
+from datetime import datetime
+from multiprocessing import cpu_count, get_context
+from os.path import isdir, isfile
+from sys import argv, stderr, stdin, stdout
+from true_append_index import build_index, load_index, write_index, DEFAULT_INDEX_SUFFIX
+from true_append_io import open_file
+from true_append_metrics import add_metrics_args, metrics_from_args
+from true_append_packed import PackedSeq
+from true_append_state import StateStore
+from tn93_edge_store import is_edge_store, load_edges, select_edges, write_edges_csv, EdgeStoreWriter
+from tn93_prefilter import build_sketch, load_sketch, sketch_candidates, stack_sketch, write_sketch, DEFAULT_BLOCK_SIZE, DEFAULT_SKETCH_SUFFIX, MAX_BLOCK_SIZE
+import argparse
+import numpy as np
+
+# constants
+TN93_TRUE_APPEND_VERSION = '0.0.1'
+DEFAULT_ID_COL = 'ehars_uid'
+DEFAULT_SEQ_COL = 'clean_seq'
+DEFAULT_THRESHOLD = 0.015
+DEFAULT_MIN_OVERLAP = 500
+DEFAULT_AMBIGUITY = 'resolve'
+DEFAULT_FRACTION = 1.0
+DEFAULT_BATCH_SIZE = 1024
+PREFILTER_DENSE_FRACTION = 0.25 # if more pairs of a block are candidates, compute the whole block
+PREFILTER_GROUP_SIZE = 16 # otherwise, compute the candidates of this many queries at a time
+AMBIGUITY_MODES = {'resolve', 'average', 'skip'}
+TN93_HEADER = 'ID1,ID2,Distance'
+STDIO = {'stderr':stderr, 'stdin':stdin, 'stdout':stdout}
+
+# nucleotide encoding: bitmask over A (1), C (2), G (4), T (8); gaps and unknown characters are 0
+NUCLEOTIDE_BITS = {
+    'A':1, 'C':2, 'G':4, 'T':8, 'U':8,
+    'R':5, 'Y':10, 'S':6, 'W':9, 'K':12, 'M':3,
+    'B':14, 'D':13, 'H':11, 'V':7, 'N':15,
+}
+ENCODE_TABLE = np.zeros(256, dtype=np.uint8)
+for c, bits in NUCLEOTIDE_BITS.items():
+    ENCODE_TABLE[ord(c)] = bits; ENCODE_TABLE[ord(c.lower())] = bits
+RESOLUTIONS = [[i for i in range(4) if (code >> i) & 1] for code in range(16)]
+
+# return the current time as a string
+def get_time():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+# print to log (prefixed by current time)
+def print_log(s='', end='\n'):
+    print("[%s] %s" % (get_time(), s), file=stderr, end=end); stderr.flush()
+
+# parse user args
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-it', '--input_table', required=True, type=str, help="Input: User table (CSV)")
+    parser.add_argument('-iT', '--input_old_table', required=False, type=str, default=None, help="Input: Old table (CSV)")
+    parser.add_argument('-iI', '--input_old_index', required=False, type=str, default=None, help="Input: Old table sequence digest index (instead of --input_old_table)")
+    parser.add_argument('-iD', '--input_old_dists', required=False, type=str, default=None, help="Input: Old pairwise distances (TN93 CSV or edge store)")
+    parser.add_argument('-o', '--output', required=False, type=str, default='stdout', help="Output: Pairwise distances (TN93 CSV)")
+    parser.add_argument('-oE', '--output_edge_store', required=False, type=str, default=None, help="Output: Pairwise distances as an edge store (in addition to --output)")
+    parser.add_argument('--output_index_file', required=False, type=str, default=None, help="Output: Table sequence digest index (default: output file + '%s')" % DEFAULT_INDEX_SUFFIX)
+    parser.add_argument('-t', '--threshold', required=False, type=float, default=DEFAULT_THRESHOLD, help="Distance threshold (only output pairs with distance <= threshold)")
+    parser.add_argument('-l', '--min_overlap', required=False, type=int, default=DEFAULT_MIN_OVERLAP, help="Minimum overlap (non-gap positions) for a pair to be reported")
+    parser.add_argument('-a', '--ambiguity', required=False, type=str, default=DEFAULT_AMBIGUITY, help="Ambiguity handling (%s)" % ', '.join(sorted(AMBIGUITY_MODES)))
+    parser.add_argument('-g', '--fraction', required=False, type=float, default=DEFAULT_FRACTION, help="Maximum fraction of ambiguous positions that can be resolved (otherwise averaged)")
+    parser.add_argument('-p', '--threads', required=False, type=int, default=cpu_count(), help="Number of worker processes")
+    parser.add_argument('--batch_size', required=False, type=int, default=DEFAULT_BATCH_SIZE, help="Number of sequences compared per vectorized batch")
+    parser.add_argument('--id_col', required=False, type=str, default=DEFAULT_ID_COL, help="Sequence ID column in the tables")
+    parser.add_argument('--seq_col', required=False, type=str, default=DEFAULT_SEQ_COL, help="Sequence column in the tables")
+    parser.add_argument('--prefilter', action='store_true', help="Discard pairs that can't be within the threshold using block sketches before computing exact distances")
+    parser.add_argument('-iS', '--input_old_sketch', required=False, type=str, default=None, help="Input: Old table sequence sketch index (reused by --prefilter)")
+    parser.add_argument('--output_sketch_file', required=False, type=str, default=None, help="Output: Table sequence sketch index (default with --prefilter: output file + '%s')" % DEFAULT_SKETCH_SUFFIX)
+    parser.add_argument('--sketch_block', required=False, type=int, default=DEFAULT_BLOCK_SIZE, help="Positions per sketch block (1-%d)" % MAX_BLOCK_SIZE)
+    parser.add_argument('--state_db', required=False, type=str, default=None, help="Run state store (SQLite) holding the previous run (instead of --input_old_* files; output then only holds new distances)")
+    add_metrics_args(parser)
+    args = parser.parse_args()
+    if args.state_db is None:
+        if (args.input_old_table is None) == (args.input_old_index is None):
+            raise ValueError("Must specify exactly one of --input_old_table or --input_old_index")
+        if args.input_old_dists is None:
+            raise ValueError("Must specify --input_old_dists (or --state_db)")
+    if args.ambiguity not in AMBIGUITY_MODES:
+        raise ValueError("Invalid ambiguity mode (%s). Options: %s" % (args.ambiguity, ', '.join(sorted(AMBIGUITY_MODES))))
+    if args.threads < 1:
+        raise ValueError("Number of threads must be positive: %s" % args.threads)
+    if args.sketch_block < 1 or args.sketch_block > MAX_BLOCK_SIZE:
+        raise ValueError("Sketch block size must be 1-%d: %s" % (MAX_BLOCK_SIZE, args.sketch_block))
+    if (args.input_old_sketch is not None or args.output_sketch_file is not None) and not args.prefilter:
+        raise ValueError("Sketch indices require --prefilter")
+    if args.output_index_file is None and args.output not in STDIO:
+        args.output_index_file = '%s%s' % (args.output, DEFAULT_INDEX_SUFFIX)
+    if args.prefilter and args.output_sketch_file is None and args.output not in STDIO:
+        args.output_sketch_file = '%s%s' % (args.output, DEFAULT_SKETCH_SUFFIX)
+    for fn in [args.input_table, args.input_old_table, args.input_old_index, args.input_old_dists]:
+        if fn is not None and not isfile(fn) and not is_edge_store(fn) and fn not in STDIO and not fn.startswith('/dev/fd'):
+            raise ValueError("File not found: %s" % fn)
+    if args.input_old_sketch is not None and not isfile(args.input_old_sketch):
+        raise ValueError("File not found: %s" % args.input_old_sketch)
+    for fn in [args.output, args.output_index_file, args.output_sketch_file, args.output_edge_store]:
+        if fn is not None and (isfile(fn) or isdir(fn)):
+            raise ValueError("File exists: %s" % fn)
+    return args
+
+# parse input table
+# Argument: `input_table_fn` = path to input table CSV
+# Argument: `packed` = `True` to store the sequences as `PackedSeq` objects (4 bits per base) instead of `str`
+# Return: `dict` in which keys are sequence IDs and values are (uppercase) sequences
+def parse_table(input_table_fn, id_col=DEFAULT_ID_COL, seq_col=DEFAULT_SEQ_COL, packed=False):
+    header_row = None; col2ind = None; seqs = dict()
+    infile = open_file(input_table_fn)
+    for row in reader(infile):
+        if header_row is None:
+            header_row = row; col2ind = {k.strip():i for i,k in enumerate(header_row)}
+            for k in [id_col, seq_col]:
+                if k not in col2ind:
+                    raise ValueError("Column '%s' missing from input table: %s" % (k, input_table_fn))
+        elif len(row) != 0:
+            ID = row[col2ind[id_col]].strip(); seq = row[col2ind[seq_col]].strip().upper()
+            if ID in seqs:
+                raise ValueError("Duplicate sequence ID (%s) in file: %s" % (ID, input_table_fn))
+            seqs[ID] = PackedSeq(seq) if packed else seq
+    infile.close()
+    return seqs
+
+# determine dataset deltas
+# Argument: `seqs_new` = `dict` where keys are user-uploaded sequence IDs and values are sequences (or digest index entries)
+# Argument: `seqs_old` = `dict` where keys are existing sequence IDs and values are sequences (or digest index entries)
+# Return: `to_add` = `set` containing IDs in `seqs_new` that need to be added to `seqs_old`
+# Return: `to_replace` = `set` containing IDs in `seqs_old` whose sequences need to be updated with those in `seqs_new`
+# Return: `to_delete` = `set` containing IDs in `seqs_old` that need to be deleted
+# Return: `to_keep` = `set` containing IDs in `seqs_old` that need to be kept as-is
+def determine_deltas(seqs_new, seqs_old):
+    to_add = set(); to_replace = set(); to_delete = set(seqs_old.keys()); to_keep = set()
+    for ID in seqs_new:
+        if ID in seqs_old:
+            to_delete.remove(ID)
+            if seqs_new[ID] == seqs_old[ID]:
+                to_keep.add(ID)
+            else:
+                to_replace.add(ID)
+        else:
+            to_add.add(ID)
+    return to_add, to_replace, to_delete, to_keep
+
+# encode sequences as a uint8 matrix (one row per sequence, shorter sequences padded with gaps)
+# Argument: `seqs` = `list` of sequences (`str` or `PackedSeq`)
+# Return: `numpy.ndarray` of shape (len(seqs), max sequence length) holding nucleotide bitmasks
+def encode_seqs(seqs):
+    L = max((len(s) for s in seqs), default=0)
+    encoded = np.zeros((len(seqs), L), dtype=np.uint8)
+    for i, s in enumerate(seqs):
+        if isinstance(s, PackedSeq) and s.packed: # packed codes are already nucleotide bitmasks
+            encoded[i,:len(s)] = s.codes()
+        else:
+            encoded[i,:len(s)] = ENCODE_TABLE[np.frombuffer(str(s).encode(), dtype=np.uint8)]
+    return encoded
+
+# build the weights mapping each (code1, code2) pair of nucleotide bitmasks onto the 4x4 pairwise count matrix
+# Argument: `mode` = ambiguity handling mode ('resolve', 'average', or 'skip')
+# Return: `numpy.ndarray` of shape (256, 16), where row (16*code1 + code2) holds the flattened 4x4 contribution of that pair
+def build_pair_weights(mode):
+    weights = np.zeros((256, 16), dtype=np.float64)
+    for c1 in range(1, 16):
+        r1 = RESOLUTIONS[c1]
+        for c2 in range(1, 16):
+            r2 = RESOLUTIONS[c2]; w = weights[16*c1 + c2]
+            if len(r1) == 1 and len(r2) == 1:
+                w[4*r1[0] + r2[0]] = 1.
+            elif mode == 'skip':
+                continue
+            else:
+                shared = [x for x in r1 if x in r2]
+                if mode == 'resolve' and len(shared) != 0:
+                    for x in shared:
+                        w[5*x] += 1. / len(shared)
+                else:
+                    for x in r1:
+                        for y in r2:
+                            w[4*x + y] += 1. / (len(r1) * len(r2))
+    return weights
+
+# constants derived from the pair weights
+NUM_RESOLUTIONS = np.array([len(r) for r in RESOLUTIONS], dtype=np.uint8)
+RESOLVE_CORRECTION = build_pair_weights('resolve') - build_pair_weights('average') # nonzero only for resolvable ambiguous pairs
+RESOLVE_CORRECTION_ROWS = np.abs(RESOLVE_CORRECTION).sum(axis=1) != 0
+RESOLVE_CORRECTION_COLS = np.flatnonzero(np.abs(RESOLVE_CORRECTION).sum(axis=0) != 0)
+PLANE_SCALE = 12 # least common multiple of the possible numbers of resolutions (1, 2, 3, 4)
+PLANE_WEIGHTS = np.array([0 if n == 0 else PLANE_SCALE // n for n in NUM_RESOLUTIONS], dtype=np.int64)
+SKIP_WEIGHTS = np.array([PLANE_SCALE if n == 1 else 0 for n in NUM_RESOLUTIONS], dtype=np.int64)
+MAX_FLOAT32_LENGTH = (1 << 24) // (PLANE_SCALE * PLANE_SCALE) # float32 represents integers exactly up to 2^24
+
+# split encoded sequences into per-nucleotide weight planes
+# Weights are scaled by `PLANE_SCALE` so they are small integers: every product of two planes is then computed exactly,
+# even in float32 (as long as the alignment is shorter than `MAX_FLOAT32_LENGTH`).
+# Argument: `encoded` = `numpy.ndarray` of shape (M, L) holding nucleotide bitmasks
+# Argument: `mode` = ambiguity handling mode; ambiguous positions are spread evenly over their resolutions (or dropped if 'skip')
+# Return: `numpy.ndarray` of shape (4, M, L), where plane x holds the (scaled) weight of nucleotide x at each position
+def nucleotide_planes(encoded, mode=DEFAULT_AMBIGUITY):
+    dtype = np.float32 if encoded.shape[1] < MAX_FLOAT32_LENGTH else np.float64
+    scale = (SKIP_WEIGHTS if mode == 'skip' else PLANE_WEIGHTS).astype(dtype)[encoded]
+    return np.stack([((encoded >> x) & 1).astype(dtype) * scale for x in range(4)])
+
+# compute TN93 distances from pairwise nucleotide counts
+# Argument: `counts` = `numpy.ndarray` of shape (M, 16) holding flattened 4x4 pairwise counts
+# Argument: `min_overlap` = minimum number of (non-gap) positions for a distance to be defined
+# Return: `numpy.ndarray` of shape (M,) holding distances (`inf` if undefined)
+def tn93_from_counts(counts, min_overlap=DEFAULT_MIN_OVERLAP):
+    pairs = counts.reshape(-1, 4, 4); total = pairs.sum(axis=(1,2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        freqs = (pairs.sum(axis=1) + pairs.sum(axis=2)) / (2 * total[:,None])
+        AG = (pairs[:,0,2] + pairs[:,2,0]) / total; CT = (pairs[:,1,3] + pairs[:,3,1]) / total
+        tv = 1. - (AG + CT + np.trace(pairs, axis1=1, axis2=2) / total)
+        fA, fC, fG, fT = freqs[:,0], freqs[:,1], freqs[:,2], freqs[:,3]; fR = fA + fG; fY = fC + fT
+        K1 = 2 * fA * fG / fR; K2 = 2 * fC * fT / fY
+        K3 = 2 * (fR * fY - fA * fG * fY / fR - fC * fT * fR / fY)
+        dist = -K1 * np.log(1. - AG / K1 - 0.5 * tv / fR) - K2 * np.log(1. - CT / K2 - 0.5 * tv / fY) - K3 * np.log(1. - 0.5 * tv / (fR * fY))
+        use_k2p = (freqs == 0).any(axis=1) # TN93 is undefined if a nucleotide is missing, so fall back to K2P
+        if use_k2p.any():
+            P = AG[use_k2p] + CT[use_k2p]; Q = tv[use_k2p]
+            dist[use_k2p] = -0.5 * np.log(1. - 2 * P - Q) - 0.25 * np.log(1. - 2 * Q)
+    dist = np.where(np.isnan(dist), np.inf, np.maximum(dist, 0.))
+    dist[total < min_overlap] = np.inf
+    return dist
+
+# compute TN93 distances between every query sequence and every reference sequence of a block
+# Ambiguity averaging (and unambiguous counting) is a single matrix product of nucleotide planes;
+# the 'resolve' mode then corrects only the (sparse) positions where one of the two sequences is ambiguous.
+# Argument: `queries` = `numpy.ndarray` of shape (Q, L) (encoded query sequences)
+# Argument: `refs` = `numpy.ndarray` of shape (R, L) (encoded reference sequences)
+# Return: `numpy.ndarray` of shape (Q, R) holding distances (`inf` if undefined)
+def tn93_block(queries, refs, mode=DEFAULT_AMBIGUITY, fraction=DEFAULT_FRACTION, min_overlap=DEFAULT_MIN_OVERLAP):
+    Q, L = queries.shape; R = refs.shape[0]
+    q_planes = nucleotide_planes(queries, mode=mode).reshape(4*Q, L)
+    r_planes = nucleotide_planes(refs, mode=mode).reshape(4*R, L)
+    counts = (q_planes @ r_planes.T).reshape(4, Q, 4, R).transpose(1, 3, 0, 2).reshape(Q*R, 16).astype(np.float64) / (PLANE_SCALE * PLANE_SCALE)
+    if mode == 'resolve':
+        # pair codes (16*query code + reference code) at positions where the reference is ambiguous...
+        r_ambig = NUM_RESOLUTIONS[refs] > 1; r_rows, r_cols = np.nonzero(r_ambig)
+        codes_r = (queries[:,r_cols] << 4) | refs[r_rows, r_cols]
+        pair_r = np.arange(Q, dtype=np.int64)[:,None] * R + r_rows
+        # ...and where the query is ambiguous (but the reference isn't, so no position is counted twice)
+        q_rows, q_cols = np.nonzero(NUM_RESOLUTIONS[queries] > 1)
+        codes_q = (queries[q_rows, q_cols] << 4)[:,None] | refs[:,q_cols].T
+        pair_q = q_rows.astype(np.int64)[:,None] * R + np.arange(R, dtype=np.int64)
+        not_both = ~r_ambig[:,q_cols].T
+        codes = np.concatenate([codes_r.ravel(), codes_q[not_both]])
+        pair = np.concatenate([pair_r.ravel(), pair_q[not_both]])
+        correct = RESOLVE_CORRECTION_ROWS[codes]
+        if fraction < 1.:
+            both_non_gap = ((codes >> 4) != 0) & ((codes & 15) != 0)
+            num_ambig = np.bincount(pair[both_non_gap], minlength=Q*R)
+            correct &= num_ambig[pair] <= fraction * L # too many ambiguities: keep them averaged
+        codes = codes[correct]; pair = pair[correct]
+        for col in RESOLVE_CORRECTION_COLS:
+            counts[:,col] += np.bincount(pair, weights=RESOLVE_CORRECTION[codes, col], minlength=Q*R)
+    return tn93_from_counts(counts, min_overlap=min_overlap).reshape(Q, R)
+
+# worker state (inherited by forked worker processes)
+WORKER_STATE = dict()
+
+# initialize a worker process
+def init_worker(encoded, params):
+    WORKER_STATE['encoded'] = encoded; WORKER_STATE.update(params)
+
+# compare query sequences [q_start, q_end) against reference sequences [r_start, r_end)
+# With sketches, exact distances are only computed for the candidate pairs (see tn93_prefilter.py)
+# Return: `list` of (i, j, distance) tuples (j < i) for every pair within the threshold, and the number of pairs whose exact distance was computed
+def compare_block(task):
+    q_start, q_end, r_start, r_end = task; s = WORKER_STATE; encoded = s['encoded']
+    queries = encoded[q_start:q_end]; refs = encoded[r_start:r_end]
+    below = np.arange(r_start, r_end)[None,:] < np.arange(q_start, q_end)[:,None]
+    candidates = None
+    if s['sketch'] is not None:
+        values, nongap = s['sketch']
+        candidates = below & sketch_candidates(values[q_start:q_end], nongap[q_start:q_end], values[r_start:r_end], nongap[r_start:r_end], s['threshold'], s['min_overlap'])
+    if candidates is None or candidates.sum() > PREFILTER_DENSE_FRACTION * candidates.size:
+        dists = tn93_block(queries, refs, mode=s['mode'], fraction=s['fraction'], min_overlap=s['min_overlap'])
+        num_computed = int(below.sum())
+    else: # compute the rectangles spanned by the candidates of small groups of queries
+        dists = np.full(candidates.shape, np.inf); num_computed = 0; rows_all = np.flatnonzero(candidates.any(axis=1))
+        for start in range(0, len(rows_all), PREFILTER_GROUP_SIZE):
+            rows = rows_all[start:start+PREFILTER_GROUP_SIZE]; cols = np.flatnonzero(candidates[rows].any(axis=0))
+            dists[np.ix_(rows, cols)] = tn93_block(queries[rows], refs[cols], mode=s['mode'], fraction=s['fraction'], min_overlap=s['min_overlap'])
+            num_computed += int(below[np.ix_(rows, cols)].sum())
+    hits = list()
+    for qi, ri in zip(*np.nonzero((dists <= s['threshold']) & below)): # each new x new pair only once
+        hits.append((q_start + int(qi), r_start + int(ri), float(dists[qi,ri])))
+    return hits, num_computed
+
+# compute distances for all pairs involving new and updated sequences
+# Argument: `seqs_new` = `dict` where keys are user-uploaded sequence IDs and values are sequences
+# Argument: `to_compute` = `set` containing IDs whose distances need to be computed (added and replaced)
+# Argument: `to_keep` = `set` containing IDs whose old distances are kept as-is
+# Argument: `sketch` = sketches of all sequences in `seqs_new` to prefilter pairs with (see tn93_prefilter.py), or `None`
+# Argument: `stats` = `dict` to add the number of compared pairs ('pairs') and of exactly computed pairs ('computed') to, or `None`
+# Return: generator of (ID1, ID2, distance) tuples with distance <= `threshold`
+def compute_new_distances(seqs_new, to_compute, to_keep, threshold=DEFAULT_THRESHOLD, min_overlap=DEFAULT_MIN_OVERLAP, mode=DEFAULT_AMBIGUITY, fraction=DEFAULT_FRACTION, threads=1, batch_size=DEFAULT_BATCH_SIZE, sketch=None, sketch_block=DEFAULT_BLOCK_SIZE, stats=None):
+    IDs = sorted(to_keep) + sorted(to_compute); num_keep = len(to_keep)
+    encoded = encode_seqs([seqs_new[ID] for ID in IDs])
+    params = {'threshold':threshold, 'min_overlap':min_overlap, 'mode':mode, 'fraction':fraction, 'sketch':None}
+    if sketch is not None:
+        params['sketch'] = stack_sketch(sketch, IDs, block_size=sketch_block)
+    query_size = max(1, batch_size // 4)
+    tasks = [(q_start, min(q_start + query_size, len(IDs)), r_start, min(r_start + batch_size, len(IDs)))
+             for q_start in range(num_keep, len(IDs), query_size)
+             for r_start in range(0, min(q_start + query_size, len(IDs)) - 1, batch_size)]
+    if threads == 1:
+        init_worker(encoded, params)
+        results = map(compare_block, tasks)
+    else:
+        pool = get_context('fork').Pool(threads, initializer=init_worker, initargs=(encoded, params))
+        results = pool.imap(compare_block, tasks)
+    if stats is not None:
+        N = len(IDs); stats['pairs'] = stats.get('pairs', 0) + N * (N - 1) // 2 - num_keep * (num_keep - 1) // 2
+    for hits, num_computed in results:
+        if stats is not None:
+            stats['computed'] = stats.get('computed', 0) + num_computed
+        for i, j, d in hits:
+            yield IDs[i], IDs[j], d
+    if threads != 1:
+        pool.close(); pool.join()
+
+# copy old distances that don't involve deleted or replaced IDs
+# Argument: `old_dists_fn` = filename of old TN93 CSV (or edge store)
+# Argument: `to_remove` = `set` containing IDs whose old distances must be dropped
+# Argument: `out_file` = output TN93 CSV file stream
+# Argument: `edge_writer` = `EdgeStoreWriter` to also copy the distances to (or `None`)
+# Return: number of distances copied
+def copy_unchanged_dists(old_dists_fn, to_remove, out_file, edge_writer=None):
+    if is_edge_store(old_dists_fn):
+        IDs, id1, id2, dist = load_edges(old_dists_fn); keep = select_edges(IDs, id1, id2, dist, to_remove=to_remove)
+        if edge_writer is not None:
+            edge_writer.add_columns(IDs, id1[keep], id2[keep], dist[keep])
+        return write_edges_csv(IDs, id1, id2, dist, out_file, keep=keep)
+    old_dists_file = open_file(old_dists_fn); num_copied = 0
+    for line in old_dists_file:
+        parts = line.split(',')
+        if len(parts) != 3:
+            continue
+        u = parts[0].strip(); v = parts[1].strip()
+        if u in to_remove or v in to_remove:
+            continue
+        try:
+            d = float(parts[2])
+        except ValueError:
+            continue # header row
+        out_file.write(line if line.endswith('\n') else line + '\n'); num_copied += 1
+        if edge_writer is not None:
+            edge_writer.add(u, v, d)
+    old_dists_file.close()
+    return num_copied
+
+# main program
+def main():
+    print_log("Running TN93 True Append v%s" % TN93_TRUE_APPEND_VERSION)
+    args = parse_args()
+    print_log("Command: %s" % ' '.join(argv))
+    metrics = metrics_from_args(args, 'tn93')
+    with metrics.phase('parse_user') as counts:
+        print_log("Parsing user table: %s" % args.input_table)
+        seqs_new = parse_table(args.input_table, id_col=args.id_col, seq_col=args.seq_col, packed=True)
+        print_log("- Num Sequences: %s" % len(seqs_new))
+        index_new = build_index(seqs_new); state = None; counts['sequences'] = len(seqs_new)
+    with metrics.phase('parse_old') as counts:
+        if args.state_db is not None:
+            print_log("Loading old table sequence index from state store: %s" % args.state_db)
+            state = StateStore(args.state_db, 'tn93'); index_old = state.load_index()
+        elif args.input_old_index is None:
+            print_log("Parsing old table: %s" % args.input_old_table)
+            index_old = build_index(parse_table(args.input_old_table, id_col=args.id_col, seq_col=args.seq_col))
+        else:
+            print_log("Loading old table sequence index: %s" % args.input_old_index)
+            index_old = load_index(args.input_old_index)
+        print_log("- Num Sequences: %s" % len(index_old)); counts['sequences'] = len(index_old)
+    with metrics.phase('delta') as counts:
+        print_log("Determining deltas between user table and old table...")
+        to_add, to_replace, to_delete, to_keep = determine_deltas(index_new, index_old)
+        print_log("- Add: %s" % len(to_add))
+        print_log("- Replace: %s" % len(to_replace))
+        print_log("- Delete: %s" % len(to_delete))
+        print_log("- Do nothing: %s" % (len(to_keep)))
+        counts.update({'add': len(to_add), 'replace': len(to_replace), 'delete': len(to_delete), 'keep': len(to_keep)})
+    out_file = open_file(args.output, 'w')
+    out_file.write(TN93_HEADER + '\n'); edge_writer = None
+    if args.output_edge_store is not None:
+        edge_writer = EdgeStoreWriter(args.output_edge_store)
+    with metrics.phase('copy') as counts:
+        if state is None:
+            print_log("Copying unchanged distances from: %s" % args.input_old_dists)
+            num_copied = copy_unchanged_dists(args.input_old_dists, to_delete | to_replace, out_file, edge_writer=edge_writer)
+            print_log("- Num Distances: %s" % num_copied); counts['distances'] = num_copied
+        else:
+            print_log("Deleting distances of deleted and replaced sequences from state store...")
+            state.delete_distances(to_delete | to_replace)
+    sketch = None
+    if args.prefilter:
+        with metrics.phase('sketch') as counts:
+            sketch = dict()
+            if args.input_old_sketch is not None:
+                print_log("Loading old table sequence sketches: %s" % args.input_old_sketch)
+                sketch = load_sketch(args.input_old_sketch, index_new, block_size=args.sketch_block)
+                print_log("- Num Reused: %s" % len(sketch))
+            to_sketch = sorted(ID for ID in seqs_new if ID not in sketch)
+            print_log("Sketching %d sequence(s)..." % len(to_sketch))
+            sketch.update(build_sketch(to_sketch, encode_seqs([seqs_new[ID] for ID in to_sketch]), block_size=args.sketch_block))
+            counts.update({'reused': len(seqs_new) - len(to_sketch), 'sketched': len(to_sketch)})
+    with metrics.phase('compute') as counts:
+        print_log("Computing distances for new and updated sequences using %d thread(s)..." % args.threads)
+        new_dists = list(); num_new = 0
+        for u, v, d in compute_new_distances(seqs_new, to_add | to_replace, to_keep, threshold=args.threshold, min_overlap=args.min_overlap, mode=args.ambiguity, fraction=args.fraction, threads=args.threads, batch_size=args.batch_size, sketch=sketch, sketch_block=args.sketch_block, stats=counts):
+            d_str = '%g' % d; out_file.write('%s,%s,%s\n' % (u, v, d_str))
+            if edge_writer is not None:
+                edge_writer.add(u, v, float(d_str)) # (as written, so the edge store converts back to the same CSV)
+            if state is not None:
+                new_dists.append((u, v, d))
+                if len(new_dists) == args.batch_size:
+                    state.put_distances(new_dists); new_dists = list()
+            num_new += 1
+        if sketch is not None:
+            print_log("- Num Exactly Computed Pairs: %s of %s" % (counts['computed'], counts['pairs']))
+        print_log("- Num Distances: %s" % num_new); counts['distances'] = num_new
+    if state is not None:
+        with metrics.phase('update_state'):
+            print_log("Updating state store: %s" % args.state_db)
+            state.put_distances(new_dists); state.put_meta('header', TN93_HEADER + '\n')
+            state.update_index(index_new, to_add | to_replace, to_delete); state.close()
+    if args.output in STDIO:
+        out_file.flush()
+    else:
+        out_file.close()
+    if edge_writer is not None:
+        print_log("Writing edge store: %s" % args.output_edge_store)
+        edge_writer.close()
+    if args.output_index_file is not None:
+        with metrics.phase('write_index') as counts:
+            print_log("Writing table sequence index: %s" % args.output_index_file)
+            write_index(args.output_index_file, index_new); counts['sequences'] = len(index_new)
+    if args.output_sketch_file is not None:
+        with metrics.phase('write_sketch') as counts:
+            print_log("Writing table sequence sketch index: %s" % args.output_sketch_file)
+            write_sketch(args.output_sketch_file, sketch, index_new, block_size=args.sketch_block); counts['sequences'] = len(sketch)
+    metrics.close()
+
+# run main program
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+'''
+Content-addressed alignment cache shared by the True Append aligner wrappers
+
+Aligned records are stored on disk (SQLite) under a key derived from the unaligned sequence and a namespace identifying
+the aligner (see `aligner_namespace`: its arguments, executable, version, and the contents of files named in its
+arguments, e.g. a reference), so a sequence that was aligned before (under any ID, in any earlier run) never needs to be
+aligned again, while upgrading the aligner or editing its reference doesn't return stale alignments.
+The cache holds at most `max_entries` records: the least recently used ones are evicted when it is closed.
+'''
+
+# imports
+from hashlib import blake2b
+from os.path import isfile, realpath
+from shutil import which
+from subprocess import DEVNULL, PIPE, STDOUT, SubprocessError, run
+from time import time
+from zlib import compress, decompress
+import sqlite3
+
+# constants
+DEFAULT_CACHE_SIZE = 1000000 # max number of cached alignments
+READ_SIZE = 1048576 # bytes per read when digesting files
+VERSION_TIMEOUT = 30 # seconds to wait for `<aligner> --version`
+CACHE_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS alignments (key BLOB PRIMARY KEY, value BLOB NOT NULL, last_used REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS alignments_last_used ON alignments (last_used)",
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+]
+
+# compute the content digest of a file
+def file_digest(fn):
+    h = blake2b(digest_size=16)
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# build the cache namespace of an aligner
+# Argument: `name` = name of the aligner (e.g. 'cawlign')
+# Argument: `path` = path (or name on the PATH) of the aligner executable
+# Argument: `args` = aligner arguments (`str`)
+# Return: namespace (`str`) holding the arguments, the resolved executable and its content digest, its `--version` output, and the content digests of files named in the arguments
+def aligner_namespace(name, path, args):
+    args = args.split(); exe = which(path)
+    if exe is None:
+        raise ValueError("Aligner executable not found: %s" % path)
+    exe = realpath(exe)
+    try:
+        version = run([exe, '--version'], stdin=DEVNULL, stdout=PIPE, stderr=STDOUT, timeout=VERSION_TIMEOUT).stdout.decode(errors='replace').strip()
+    except (OSError, SubprocessError): # (the executable doesn't support it, so its content digest has to do)
+        version = ''
+    parts = [name, ' '.join(args), exe, file_digest(exe), version]
+    for arg in args:
+        for fn in {arg, arg.split('=', 1)[-1]}: # (e.g. '-r ref.fasta' or '--reference=ref.fasta')
+            if isfile(fn):
+                parts.append('%s=%s' % (fn, file_digest(fn)))
+    return '\t'.join(parts)
+
+# alignment cache
+class AlignmentCache:
+    # open (or create) the cache stored in `fn`; `namespace` identifies the aligner and its arguments
+    def __init__(self, fn, namespace, max_entries=DEFAULT_CACHE_SIZE):
+        if max_entries < 1:
+            raise ValueError("Alignment cache size must be positive: %s" % max_entries)
+        self.fn = fn; self.namespace = namespace; self.max_entries = max_entries
+        self.db = sqlite3.connect(fn)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        for statement in CACHE_SCHEMA:
+            self.db.execute(statement)
+        self.now = time(); self.hits = 0; self.misses = 0
+
+    # key of an unaligned sequence (under this cache's namespace)
+    def key(self, seq):
+        return blake2b(('%s\0%s' % (self.namespace, seq)).encode(), digest_size=16).digest()
+
+    # return the cached aligned record of `seq` (or `None` if it isn't cached)
+    def get(self, seq):
+        key = self.key(seq)
+        row = self.db.execute("SELECT value FROM alignments WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute("UPDATE alignments SET last_used = ? WHERE key = ?", (self.now, key))
+        return decompress(row[0]).decode()
+
+    # cache the aligned record `value` of `seq`
+    def put(self, seq, value):
+        self.db.execute("INSERT OR REPLACE INTO alignments (key, value, last_used) VALUES (?, ?, ?)", (self.key(seq), compress(value.encode(), 1), self.now))
+
+    # return a namespaced metadata value (or `None` if it isn't set)
+    def get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", ('%s\0%s' % (self.namespace, key),)).fetchone()
+        return None if row is None else row[0]
+
+    # set a namespaced metadata value
+    def put_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", ('%s\0%s' % (self.namespace, key), value))
+
+    # evict the least recently used records beyond `max_entries`, then commit and close
+    def close(self):
+        num_entries = self.db.execute("SELECT COUNT(*) FROM alignments").fetchone()[0]
+        if num_entries > self.max_entries:
+            self.db.execute("DELETE FROM alignments WHERE key IN (SELECT key FROM alignments ORDER BY last_used LIMIT ?)", (num_entries - self.max_entries,))
+        self.db.commit(); self.db.close()
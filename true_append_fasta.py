@@ -0,0 +1,99 @@
+'''
+Streaming FASTA reader shared by the True Append tools
+
+Plain files are memory-mapped and each record's sequence is built with a single C-level pass (no line-by-line string growth).
+Gzip files, standard input, and /dev/fd pipes are streamed line by line, joining each record's lines once.
+'''
+
+# imports
+from mmap import mmap, ACCESS_READ
+from os.path import isfile
+from sys import stdin
+from true_append_io import is_gzip_fn, open_file
+from true_append_packed import PackedSeq
+
+# constants
+WHITESPACE = b' \t\r\n\x0b\x0c'
+
+# open a FASTA file as a binary stream
+def open_fasta(fn):
+    if fn == 'stdin':
+        return stdin.buffer
+    elif is_gzip_fn(fn):
+        return open_file(fn, 'rb') # (decompressed ahead of the parser in background threads)
+    else:
+        return open(fn, 'rb')
+
+# iterate over the records of a memory-mapped FASTA file
+def iter_fasta_mmap(fn, mm):
+    end = len(mm); pos = 0
+    while pos < end and mm[pos:pos+1] in b' \t\r\n':
+        pos += 1
+    if pos == end or mm[pos:pos+1] != b'>':
+        raise ValueError("Malformed FASTA: %s" % fn)
+    while pos < end:
+        header_end = mm.find(b'\n', pos)
+        if header_end == -1:
+            raise ValueError("Malformed FASTA: %s" % fn)
+        next_pos = mm.find(b'\n>', header_end)
+        next_pos = end if next_pos == -1 else next_pos + 1
+        seq = mm[header_end+1:next_pos].translate(None, WHITESPACE)
+        if len(seq) == 0:
+            raise ValueError("Malformed FASTA: %s" % fn)
+        yield mm[pos+1:header_end].strip().decode(), seq.decode()
+        pos = next_pos
+
+# iterate over the records of a streamed (e.g. gzip or pipe) FASTA file
+def iter_fasta_stream(fn, infile):
+    name = None; lines = list()
+    for line in infile:
+        l = line.strip()
+        if len(l) == 0:
+            continue
+        if l[0] == 62: # '>'
+            if name is not None:
+                if len(lines) == 0:
+                    raise ValueError("Malformed FASTA: %s" % fn)
+                yield name, b''.join(lines).decode()
+            name = l[1:].decode(); lines = list()
+        elif name is None:
+            raise ValueError("Malformed FASTA: %s" % fn)
+        else:
+            lines.append(l)
+    if name is None or len(lines) == 0:
+        raise ValueError("Malformed FASTA: %s" % fn)
+    yield name, b''.join(lines).decode()
+
+# iterate over the records of a FASTA file
+# Argument: `fn` = filename of the FASTA file (plain, gzip, 'stdin', or /dev/fd pipe)
+# Return: generator of (ID, sequence) tuples in file order
+def iter_fasta(fn):
+    if fn != 'stdin' and not is_gzip_fn(fn) and isfile(fn):
+        with open(fn, 'rb') as infile:
+            try:
+                mm = mmap(infile.fileno(), 0, access=ACCESS_READ)
+            except ValueError: # empty file
+                raise ValueError("Malformed FASTA: %s" % fn)
+            try:
+                yield from iter_fasta_mmap(fn, mm)
+            finally:
+                mm.close()
+    else:
+        infile = open_fasta(fn)
+        try:
+            yield from iter_fasta_stream(fn, infile)
+        finally:
+            if fn != 'stdin':
+                infile.close()
+
+# load FASTA
+# Argument: `fn` = filename of the FASTA file
+# Argument: `packed` = `True` to store the sequences as `PackedSeq` objects (4 bits per base) instead of `str`
+# Return: `dict` where keys are sequence IDs and values are sequences
+def load_fasta(fn, packed=False):
+    seqs = dict()
+    for name, seq in iter_fasta(fn):
+        if name in seqs:
+            raise ValueError("Duplicate sequence ID (%s): %s" % (name, fn))
+        seqs[name] = PackedSeq(seq) if packed else seq
+    return seqs
@@ -0,0 +1,72 @@
+'''
+Per-ID sequence digest index shared by the True Append tools
+
+Each True Append run can write a compact sidecar index (one line per ID: ID, fixed-width content digest, sequence length)
+next to its outputs. The next run can then classify IDs as add/replace/delete/keep from that index alone,
+without loading the old sequences into memory.
+'''
+
+# imports
+from hashlib import blake2b
+from sys import stderr, stdin, stdout
+from true_append_io import open_file
+
+# constants
+INDEX_VERSION = 1
+DIGEST_SIZE = 16 # bytes (so 32 hex characters)
+INDEX_HEADER = '#true_append_index\tv%d\tblake2b-%d' % (INDEX_VERSION, DIGEST_SIZE)
+DEFAULT_INDEX_SUFFIX = '.seqidx'
+STDIO = {'stderr':stderr, 'stdin':stdin, 'stdout':stdout}
+
+# compute the fixed-width content digest of a sequence
+# Argument: `seq` = sequence (`str` or `PackedSeq`)
+# Return: hex digest of `seq` (`str` of length 2*`DIGEST_SIZE`)
+def seq_digest(seq):
+    return blake2b(str(seq).encode(), digest_size=DIGEST_SIZE).hexdigest()
+
+# build a digest index from sequences
+# Argument: `seqs` = `dict` where keys are sequence IDs and values are sequences (or iterable of (ID, sequence) tuples)
+# Return: `dict` where keys are sequence IDs and values are (digest, length) tuples
+def build_index(seqs):
+    if isinstance(seqs, dict):
+        seqs = seqs.items()
+    index = dict()
+    for ID, seq in seqs:
+        if ID in index:
+            raise ValueError("Duplicate sequence ID: %s" % ID)
+        index[ID] = (seq_digest(seq), len(seq))
+    return index
+
+# load a digest index written by `write_index`
+# Argument: `fn` = filename of the index
+# Return: `dict` where keys are sequence IDs and values are (digest, length) tuples
+def load_index(fn):
+    infile = open_file(fn); index = dict()
+    header = infile.readline().rstrip('\n')
+    if header != INDEX_HEADER:
+        raise ValueError("Invalid or incompatible sequence index (expected header '%s'): %s" % (INDEX_HEADER, fn))
+    for line in infile:
+        if len(line.strip()) == 0:
+            continue
+        try:
+            ID, digest, length = line.rstrip('\n').rsplit('\t', 2)
+        except ValueError:
+            raise ValueError("Malformed sequence index: %s" % fn)
+        if ID in index:
+            raise ValueError("Duplicate sequence ID (%s): %s" % (ID, fn))
+        index[ID] = (digest, int(length))
+    infile.close()
+    return index
+
+# write a digest index
+# Argument: `fn` = filename of the output index
+# Argument: `index` = `dict` where keys are sequence IDs and values are (digest, length) tuples
+def write_index(fn, index):
+    outfile = open_file(fn, 'w')
+    outfile.write(INDEX_HEADER + '\n')
+    for ID, (digest, length) in index.items():
+        outfile.write('%s\t%s\t%d\n' % (ID, digest, length))
+    if fn in STDIO:
+        outfile.flush()
+    else:
+        outfile.close()
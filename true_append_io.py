@@ -0,0 +1,240 @@
+'''
+Compressed file I/O shared by the True Append tools
+
+Gzip output is compressed in-process by a pool of threads (zlib releases the GIL): the stream is cut into fixed-size
+blocks, each written as its own gzip member (concatenated members are a valid gzip file for gzip/pigz/zcat), so it is
+also possible to append to a gzip file. Each member records its compressed size in a gzip extra field (the BGZF `BC`
+field for .bgz/.bgzf outputs, which are then readable by htslib/bgzip, or a 4-byte `TA` field for .gz outputs),
+so such files are decompressed block-parallel when read back. Other gzip files are decompressed in a background thread.
+Either way, reading runs ahead of the consumer (bounded by a number of in-flight blocks).
+'''
+
+# imports
+from concurrent.futures import ThreadPoolExecutor
+from io import BufferedReader, BufferedWriter, RawIOBase, TextIOWrapper
+from os import cpu_count, environ
+from queue import Queue
+from struct import pack, unpack_from
+from sys import stderr, stdin, stdout
+from threading import Thread
+import zlib
+
+# constants
+DEFAULT_THREADS = int(environ.get('TRUE_APPEND_IO_THREADS', min(8, cpu_count() or 1)))
+DEFAULT_LEVEL = 6
+GZIP_BLOCK_SIZE = 1048576 # uncompressed bytes per gzip member
+BGZF_BLOCK_SIZE = 65280 # uncompressed bytes per BGZF block (as bgzip, so compressed blocks fit in 64 KiB)
+READ_SIZE = 1048576 # compressed bytes per read when decompressing unindexed gzip streams
+BUFFER_SIZE = 1048576 # buffered reader/writer size
+BGZF_SUFFIXES = ('.bgz', '.bgzf')
+GZIP_SUFFIXES = ('.gz',) + BGZF_SUFFIXES
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+GZIP_MAGIC = b'\x1f\x8b'
+FEXTRA = 4
+HEADER_SIZE = 12 # fixed gzip header fields (through XLEN) of a member with an extra field
+STDIO = {'stderr':stderr, 'stdin':stdin, 'stdout':stdout}
+
+# return `True` if a filename denotes a gzip (or BGZF) file
+def is_gzip_fn(fn):
+    return fn.lower().endswith(GZIP_SUFFIXES)
+
+# return `True` if a file object is backed by an OS-level file descriptor (e.g. not a compressed or in-memory stream)
+def has_fileno(f):
+    try:
+        f.fileno(); return True
+    except (AttributeError, OSError, ValueError):
+        return False
+
+# compress one block into a complete gzip member (run in worker threads)
+# Argument: `bgzf` = `True` to write a BGZF block (BC extra field), otherwise a gzip member with a TA extra field
+def compress_member(data, level=DEFAULT_LEVEL, bgzf=False):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    trailer = pack('<II', zlib.crc32(data), len(data) & 0xffffffff)
+    if bgzf:
+        size = HEADER_SIZE + 6 + len(deflated) + 8
+        if size > 65536:
+            raise ValueError("BGZF block too large: %d bytes" % size)
+        header = GZIP_MAGIC + pack('<BBIBBHBBHH', 8, FEXTRA, 0, 0, 255, 6, 66, 67, 2, size - 1)
+    else:
+        size = HEADER_SIZE + 8 + len(deflated) + 8
+        header = GZIP_MAGIC + pack('<BBIBBHBBHI', 8, FEXTRA, 0, 0, 255, 8, 84, 65, 4, size)
+    return header + deflated + trailer
+
+# parse the size of a gzip member from its header (if it was written with a BC or TA extra field)
+# Argument: `header` = at least the first `HEADER_SIZE` bytes of the member, plus its extra field
+# Return: total size of the member in bytes (or `None` if it has no size field)
+def member_size(header):
+    if len(header) < HEADER_SIZE or header[:2] != GZIP_MAGIC or header[2] != 8 or not (header[3] & FEXTRA):
+        return None
+    xlen = unpack_from('<H', header, 10)[0]; pos = HEADER_SIZE; end = HEADER_SIZE + xlen
+    if len(header) < end:
+        return None
+    while pos + 4 <= end:
+        si1, si2, slen = unpack_from('<BBH', header, pos)
+        if (si1, si2, slen) == (66, 67, 2):
+            return unpack_from('<H', header, pos+4)[0] + 1
+        if (si1, si2, slen) == (84, 65, 4):
+            return unpack_from('<I', header, pos+4)[0]
+        pos += 4 + slen
+    return None
+
+# decompress one complete gzip member (run in worker threads)
+def decompress_member(member):
+    decompressor = zlib.decompressobj(31); data = decompressor.decompress(member)
+    if not decompressor.eof or len(decompressor.unused_data) != 0:
+        raise ValueError("Malformed gzip member")
+    return data
+
+# gzip writer that compresses blocks in a thread pool (written in order)
+class ParallelGzipWriter(RawIOBase):
+    # Argument: `raw` = binary file object to write the compressed stream to
+    # Argument: `bgzf` = `True` to write BGZF blocks (and the BGZF end-of-file block)
+    def __init__(self, raw, level=DEFAULT_LEVEL, threads=DEFAULT_THREADS, bgzf=False, close_raw=True):
+        self.raw = raw; self.level = level; self.bgzf = bgzf; self.close_raw = close_raw
+        self.block_size = BGZF_BLOCK_SIZE if bgzf else GZIP_BLOCK_SIZE
+        self.executor = ThreadPoolExecutor(max_workers=max(1, threads)); self.max_pending = 2 * max(1, threads)
+        self.buffer = bytearray(); self.pending = list()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buffer += b
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[:self.block_size])); del self.buffer[:self.block_size]
+        return len(b)
+
+    # compress a block in the background (and write finished blocks, in order, to bound the number of pending blocks)
+    def submit(self, block):
+        self.pending.append(self.executor.submit(compress_member, block, self.level, self.bgzf))
+        while len(self.pending) > self.max_pending or (len(self.pending) != 0 and self.pending[0].done()):
+            self.raw.write(self.pending.pop(0).result())
+
+    # compress the buffered data and write all pending blocks
+    def flush(self):
+        if self.closed:
+            return
+        if len(self.buffer) != 0:
+            self.submit(bytes(self.buffer)); self.buffer = bytearray()
+        while len(self.pending) != 0:
+            self.raw.write(self.pending.pop(0).result())
+        if not self.raw.closed:
+            self.raw.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+            if self.bgzf:
+                self.raw.write(BGZF_EOF)
+            self.executor.shutdown()
+            if self.close_raw:
+                self.raw.close()
+            else:
+                self.raw.flush()
+        finally:
+            super().close()
+
+# gzip reader that decompresses ahead of the consumer in background threads
+# Members with a size field (see `compress_member`) are decompressed in parallel; other members are streamed through a single decompressor
+class ParallelGzipReader(RawIOBase):
+    def __init__(self, raw, threads=DEFAULT_THREADS, close_raw=True):
+        self.raw = raw; self.close_raw = close_raw; self.chunk = b''; self.pos = 0; self.done = False
+        self.executor = ThreadPoolExecutor(max_workers=max(1, threads)); self.max_pending = 2 * max(1, threads)
+        self.queue = Queue(self.max_pending); self.stopped = False
+        self.thread = Thread(target=self.produce, daemon=True); self.thread.start()
+
+    def readable(self):
+        return True
+
+    # read compressed members (in a background thread), and queue futures of their decompressed data (`None` at the end)
+    def produce(self):
+        try:
+            data = b''
+            while not self.stopped:
+                if len(data) < 65536 + HEADER_SIZE:
+                    data += self.raw.read(READ_SIZE)
+                if len(data) == 0:
+                    break
+                size = member_size(data)
+                if size is None: # no size field: stream the rest of the file
+                    self.stream(data); break
+                while len(data) < size:
+                    more = self.raw.read(max(READ_SIZE, size - len(data)))
+                    if len(more) == 0:
+                        raise ValueError("Truncated gzip file")
+                    data += more
+                self.queue.put(self.executor.submit(decompress_member, data[:size])); data = data[size:]
+        except BaseException as e:
+            self.queue.put(e)
+        self.queue.put(None)
+
+    # stream the remaining gzip members through a decompressor (in the background thread)
+    def stream(self, data):
+        decompressor = zlib.decompressobj(31); in_member = False
+        while not self.stopped:
+            if len(data) == 0:
+                data = self.raw.read(READ_SIZE)
+                if len(data) == 0:
+                    if in_member:
+                        raise ValueError("Truncated gzip file")
+                    break
+            if not in_member:
+                data = data.lstrip(b'\x00') # (zero padding after the last member)
+                if len(data) == 0:
+                    continue
+            out = decompressor.decompress(data); data = b''; in_member = True
+            if len(out) != 0:
+                self.queue.put(out)
+            if decompressor.eof: # next member (if any)
+                data = decompressor.unused_data; decompressor = zlib.decompressobj(31); in_member = False
+
+    def readinto(self, b):
+        while self.pos == len(self.chunk):
+            if self.done:
+                return 0
+            item = self.queue.get()
+            if item is None:
+                self.done = True; return 0
+            if isinstance(item, BaseException):
+                self.done = True; raise item
+            self.chunk = item if isinstance(item, bytes) else item.result(); self.pos = 0
+        n = min(len(b), len(self.chunk) - self.pos)
+        b[:n] = self.chunk[self.pos:self.pos+n]; self.pos += n
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        self.stopped = True
+        while self.thread.is_alive(): # unblock the producer
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.thread.join(0.01)
+        self.executor.shutdown(cancel_futures=True)
+        if self.close_raw:
+            self.raw.close()
+        super().close()
+
+# open a (possibly gzip/BGZF-compressed) file
+# Argument: `fn` = filename ('stdin', 'stdout', and 'stderr' denote the standard streams)
+# Argument: `mode` = 'r', 'w', or 'a' (optionally with 'b' for a binary stream)
+# Argument: `text` = `True` for a text stream (ignored if `mode` contains 'b')
+# Argument: `threads` = number of compression/decompression threads (gzip/BGZF files only)
+# Argument: `level` = compression level (gzip/BGZF output only)
+# Return: file object
+def open_file(fn, mode='r', text=True, threads=DEFAULT_THREADS, level=DEFAULT_LEVEL):
+    binary = 'b' in mode or not text; mode = mode.replace('b', '').replace('t', '')
+    if fn in STDIO:
+        return STDIO[fn].buffer if binary else STDIO[fn]
+    if not is_gzip_fn(fn):
+        return open(fn, mode + ('b' if binary else ''))
+    if mode == 'r':
+        stream = BufferedReader(ParallelGzipReader(open(fn, 'rb'), threads=threads), BUFFER_SIZE)
+    elif mode in {'w', 'a'}:
+        stream = BufferedWriter(ParallelGzipWriter(open(fn, mode + 'b'), level=level, threads=threads, bgzf=fn.lower().endswith(BGZF_SUFFIXES)), BUFFER_SIZE)
+    else:
+        raise ValueError("Invalid mode: %s" % mode)
+    return stream if binary else TextIOWrapper(stream, encoding='utf-8')
@@ -0,0 +1,224 @@
+#! /usr/bin/env python3
+'''
+Structured per-phase performance metrics shared by the True Append tools
+
+With `--metrics <file>`, each tool appends one JSON object per line to the file (so several tools can share one file):
+  {"type": "phase", ...}       one per phase (e.g. parse_user, parse_old, delta, external, copy, merge, write_index): wall
+                               time, CPU time (of the tool and of its finished subprocesses), RSS at the start and end of
+                               the phase and the increase of the peak RSS during it, bytes read and written (through
+                               read/write calls, from /proc/self/io where available), and record counts
+  {"type": "subprocess", ...}  one per external tool run (e.g. cawlign, bealign, DataQC): command, exit code, and runtime
+  {"type": "run", ...}         one per tool run (totals)
+CPU time, RSS, and I/O are process-wide, so phases that run concurrently (e.g. pipeline stages) share them, and
+`process_max_rss_kb` is the peak RSS of the whole run so far (not of the phase).
+`--profile_phase <name>` additionally runs cProfile (stats dumped to `--profile_output`, e.g. for `python -m pstats`)
+or tracemalloc (top allocation sites written as text) on every occurrence of one phase.
+
+This script summarizes a metrics file (total wall time per tool and phase):
+
+  true_append_metrics.py metrics.jsonl
+'''
+
+# imports
+from contextlib import contextmanager
+from cProfile import Profile
+from datetime import datetime
+from json import dumps, loads
+from os import getpid, sysconf
+from os.path import isfile
+from resource import getrusage, RUSAGE_CHILDREN, RUSAGE_SELF
+from sys import stderr, stdout
+from threading import local, Lock
+from time import perf_counter
+import argparse
+import tracemalloc
+
+# constants
+PROFILERS = {'cprofile', 'tracemalloc'}
+DEFAULT_PROFILER = 'cprofile'
+TRACEMALLOC_TOP = 50 # allocation sites written per tracemalloc snapshot
+PROC_IO_FN = '/proc/self/io'
+PROC_STATM_FN = '/proc/self/statm'
+STDIO = {'stderr':stderr, 'stdout':stdout}
+
+# return the current time as a string
+def get_time():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+# add the metrics/profiling arguments to a tool's argument parser
+# Argument: `sep` = word separator of the tool's long option names ('_' or '-')
+def add_metrics_args(parser, sep='_'):
+    parser.add_argument('--metrics', required=False, type=str, default=None, help="Output: Per-phase performance metrics (JSON lines, appended)")
+    parser.add_argument('--profile%sphase' % sep, required=False, type=str, default=None, help="Profile every occurrence of this phase (see --metrics output for phase names)")
+    parser.add_argument('--profile%smode' % sep, required=False, type=str, default=DEFAULT_PROFILER, help="Profiler (%s)" % ', '.join(sorted(PROFILERS)))
+    parser.add_argument('--profile%soutput' % sep, required=False, type=str, default=None, help="Output: Profile (default: <tool>.<phase>.prof or .tracemalloc.txt)")
+
+# read this process's I/O counters
+# Return: (bytes read, bytes written) through read/write calls (or `None` if unavailable)
+def read_io():
+    try:
+        with open(PROC_IO_FN) as io_file:
+            counters = dict(line.split(':', 1) for line in io_file)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+# read this process's current resident set size
+# Return: RSS in KB (or `None` if unavailable)
+def read_rss():
+    try:
+        with open(PROC_STATM_FN) as statm_file:
+            return int(statm_file.read().split()[1]) * sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, IndexError, ValueError):
+        return None
+
+# take a snapshot of this process's resource usage
+def usage_snapshot():
+    return perf_counter(), getrusage(RUSAGE_SELF), getrusage(RUSAGE_CHILDREN), read_io(), read_rss()
+
+# compute the resource usage between two snapshots
+# Return: `dict` of usage fields (for a metrics record)
+def usage_delta(start, end):
+    (start_time, start_self, start_children, start_io, start_rss), (end_time, end_self, end_children, end_io, end_rss) = start, end
+    out = {
+        'wall_time': end_time - start_time,
+        'user_time': end_self.ru_utime - start_self.ru_utime, 'sys_time': end_self.ru_stime - start_self.ru_stime,
+        'children_user_time': end_children.ru_utime - start_children.ru_utime, 'children_sys_time': end_children.ru_stime - start_children.ru_stime,
+        'rss_start_kb': start_rss, 'rss_end_kb': end_rss, 'max_rss_increase_kb': end_self.ru_maxrss - start_self.ru_maxrss,
+        'process_max_rss_kb': end_self.ru_maxrss, 'children_max_rss_kb': end_children.ru_maxrss,
+        'read_bytes': None, 'write_bytes': None,
+    }
+    if start_io is not None and end_io is not None:
+        out['read_bytes'] = end_io[0] - start_io[0]; out['write_bytes'] = end_io[1] - start_io[1]
+    return out
+
+# per-phase metrics recorder (does nothing unless a metrics file or a profiled phase is given)
+class Metrics:
+    # Argument: `tool` = name of the calling tool (e.g. 'cawlign')
+    # Argument: `fn` = filename of the metrics file (JSON lines, appended), or `None`
+    # Argument: `profile_phase` = name of the phase to profile, or `None`
+    # Argument: `profile_mode` = profiler ('cprofile' or 'tracemalloc')
+    # Argument: `profile_fn` = filename of the profile output (default: <tool>.<phase>.prof or .tracemalloc.txt)
+    def __init__(self, tool, fn=None, profile_phase=None, profile_mode=DEFAULT_PROFILER, profile_fn=None):
+        if profile_mode not in PROFILERS:
+            raise ValueError("Invalid profiler: %s (options: %s)" % (profile_mode, ', '.join(sorted(PROFILERS))))
+        self.tool = tool; self.fn = fn; self.profile_phase = profile_phase; self.profile_mode = profile_mode
+        if profile_fn is None and profile_phase is not None:
+            profile_fn = '%s.%s.%s' % (tool, profile_phase, 'prof' if profile_mode == 'cprofile' else 'tracemalloc.txt')
+        self.profile_fn = profile_fn; self.profiler = None; self.lock = Lock(); self.current = local()
+        self.out_file = None
+        if fn is not None:
+            self.out_file = STDIO[fn] if fn in STDIO else open(fn, 'a')
+        self.start = usage_snapshot()
+        if profile_phase is not None and profile_mode == 'tracemalloc':
+            open(self.profile_fn, 'w').close()
+
+    # write a metrics record
+    def emit(self, record):
+        if self.out_file is None:
+            return
+        line = dumps(dict({'time': get_time(), 'tool': self.tool, 'pid': getpid()}, **record))
+        with self.lock:
+            self.out_file.write(line + '\n'); self.out_file.flush()
+
+    # measure a phase
+    # Usage: `with metrics.phase('parse_user') as counts: ...; counts['records'] = n`
+    # Return: `dict` of record counts (filled in by the caller, and written with the phase record)
+    @contextmanager
+    def phase(self, name):
+        counts = dict()
+        if self.out_file is None and name != self.profile_phase:
+            yield counts; return
+        parent = getattr(self.current, 'phase', None); self.current.phase = name
+        profiling = name == self.profile_phase
+        if profiling:
+            self.start_profile()
+        start = usage_snapshot(); error = None
+        try:
+            yield counts
+        except BaseException as e:
+            error = '%s: %s' % (type(e).__name__, e); raise
+        finally:
+            end = usage_snapshot(); self.current.phase = parent
+            record = dict({'type': 'phase', 'phase': name}, **usage_delta(start, end)); record['counts'] = counts
+            if profiling:
+                record['profile'] = self.stop_profile(name)
+            if error is not None:
+                record['error'] = error
+            self.emit(record)
+
+    # start profiling the current occurrence of the profiled phase
+    def start_profile(self):
+        if self.profile_mode == 'cprofile':
+            if self.profiler is None:
+                self.profiler = Profile()
+            self.profiler.enable() # (accumulates over all occurrences)
+        else:
+            tracemalloc.start()
+
+    # stop profiling the current occurrence of the profiled phase
+    # Return: `dict` of profile fields (for the phase record)
+    def stop_profile(self, name):
+        if self.profile_mode == 'cprofile':
+            self.profiler.disable()
+            return {'mode': self.profile_mode, 'output': self.profile_fn}
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, __file__)]); current, peak = tracemalloc.get_traced_memory(); tracemalloc.stop()
+        with open(self.profile_fn, 'a') as profile_file:
+            profile_file.write("# [%s] %s %s (traced peak: %d KB)\n" % (get_time(), self.tool, name, peak // 1024))
+            for stat in snapshot.statistics('lineno')[:TRACEMALLOC_TOP]:
+                profile_file.write('%s\n' % stat)
+        return {'mode': self.profile_mode, 'output': self.profile_fn, 'traced_peak_kb': peak // 1024}
+
+    # record the run of an external tool
+    # Argument: `command` = command (`list` of `str`)
+    # Argument: `exit_code` = exit code of the subprocess
+    # Argument: `runtime` = wall time of the subprocess (seconds)
+    def subprocess(self, command, exit_code, runtime):
+        self.emit({'type': 'subprocess', 'phase': getattr(self.current, 'phase', None), 'command': command, 'exit_code': exit_code, 'runtime': runtime})
+
+    # write the run totals (and the cProfile stats) and close the metrics file
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.dump_stats(self.profile_fn)
+        self.emit(dict({'type': 'run'}, **usage_delta(self.start, usage_snapshot())))
+        if self.out_file is not None and self.fn not in STDIO:
+            self.out_file.close()
+        self.out_file = None
+
+# create the metrics recorder of a tool from its parsed arguments (see `add_metrics_args`)
+def metrics_from_args(args, tool):
+    return Metrics(tool, fn=args.metrics, profile_phase=args.profile_phase, profile_mode=args.profile_mode, profile_fn=args.profile_output)
+
+# load the records of a metrics file
+# Return: `list` of records (`dict`)
+def load_metrics(fn):
+    with open(fn) as metrics_file:
+        return [loads(line) for line in metrics_file if len(line.strip()) != 0]
+
+# parse user args
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('metrics_file', type=str, help="Input: Metrics (JSON lines)")
+    args = parser.parse_args()
+    if not isfile(args.metrics_file):
+        raise ValueError("File not found: %s" % args.metrics_file)
+    return args
+
+# main program: summarize a metrics file
+def main():
+    args = parse_args(); totals = dict(); order = list()
+    for record in load_metrics(args.metrics_file):
+        if record['type'] == 'subprocess':
+            key = (record['tool'], 'subprocess:%s' % record['command'][0]); wall_time = record['runtime']
+        else:
+            key = (record['tool'], record.get('phase', '(total)')); wall_time = record['wall_time']
+        if key not in totals:
+            totals[key] = [0, 0.]; order.append(key)
+        totals[key][0] += 1; totals[key][1] += wall_time
+    stdout.write('tool\tphase\tcount\twall_time\n')
+    for key in order:
+        stdout.write('%s\t%s\t%d\t%.3f\n' % (key[0], key[1], totals[key][0], totals[key][1]))
+
+# run main program
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+'''
+Per-record byte-offset index shared by the True Append tools
+
+A True Append run can write a sidecar index (one line per record: ID, start byte, end byte) next to a plain-text output.
+The next run can then copy the kept records as coalesced byte ranges (with `os.copy_file_range` where the kernel supports it,
+or large block reads otherwise) instead of parsing the old output record by record.
+The size and modification time of the indexed file are stored in the header, so an index that no longer matches its
+file (even if it was rewritten at the same size) is ignored.
+'''
+
+# imports
+from os import stat
+from os.path import getsize, isfile
+try:
+    from os import copy_file_range as os_copy_file_range
+except ImportError: # not Linux (or Python < 3.8)
+    os_copy_file_range = None
+
+# constants
+OFFSET_INDEX_VERSION = 2
+OFFSET_INDEX_HEADER = '#true_append_offsets\tv%d' % OFFSET_INDEX_VERSION # followed by the size and mtime (ns) of the indexed file
+DEFAULT_OFFSET_INDEX_SUFFIX = '.offidx'
+COPY_BLOCK_SIZE = 16777216 # 16 MiB
+
+# filename of the offset index of a file
+def offset_index_fn(fn):
+    return '%s%s' % (fn, DEFAULT_OFFSET_INDEX_SUFFIX)
+
+# size and modification time of a file (stored in its offset index, so a stale index is detected)
+def file_stamp(fn):
+    st = stat(fn)
+    return '%d\t%d' % (st.st_size, st.st_mtime_ns)
+
+# load the offset index of a file
+# Argument: `fn` = filename of the indexed file
+# Return: `list` of (ID, start, end) tuples in file order, or `None` if there is no index (or it doesn't match `fn`)
+def load_offset_index(fn):
+    index_fn = offset_index_fn(fn)
+    if not isfile(fn) or not isfile(index_fn):
+        return None
+    entries = list()
+    with open(index_fn) as index_file:
+        header = index_file.readline().rstrip('\n')
+        if not header.startswith(OFFSET_INDEX_HEADER.split('\t')[0]):
+            raise ValueError("Invalid offset index header: %s" % index_fn)
+        if header != '%s\t%s' % (OFFSET_INDEX_HEADER, file_stamp(fn)): # older version, or the file changed since
+            return None
+        for line in index_file:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) != 3:
+                raise ValueError("Malformed offset index: %s" % index_fn)
+            entries.append((parts[0], int(parts[1]), int(parts[2])))
+    return entries
+
+# write the offset index of a file
+# Argument: `fn` = filename of the indexed file (must be complete)
+# Argument: `entries` = iterable of (ID, start, end) tuples in file order
+def write_offset_index(fn, entries):
+    with open(offset_index_fn(fn), 'w') as index_file:
+        index_file.write('%s\t%s\n' % (OFFSET_INDEX_HEADER, file_stamp(fn)))
+        for ID, start, end in entries:
+            index_file.write('%s\t%d\t%d\n' % (ID, start, end))
+
+# coalesce the byte ranges of kept records into contiguous runs
+# Argument: `entries` = iterable of (ID, start, end) tuples in file order
+# Argument: `to_keep` = `set` containing IDs to keep
+# Return: `list` of [start, end, kept entries] runs
+def coalesce_ranges(entries, to_keep):
+    runs = list()
+    for entry in entries:
+        if entry[0] not in to_keep:
+            continue
+        if len(runs) != 0 and runs[-1][1] == entry[1]:
+            runs[-1][1] = entry[2]; runs[-1][2].append(entry)
+        else:
+            runs.append([entry[1], entry[2], [entry]])
+    return runs
+
+# copy a byte range of one file to a position of another
+# Argument: `src_file` = binary file object to copy from
+# Argument: `dst_file` = binary file object to copy to (must not be opened in append mode)
+# Argument: `start` = first byte to copy from `src_file`
+# Argument: `end` = byte after the last to copy from `src_file`
+# Argument: `dst_pos` = position in `dst_file` to copy to
+def copy_range(src_file, dst_file, start, end, dst_pos):
+    offset = start
+    try:
+        if os_copy_file_range is None:
+            raise OSError("copy_file_range is not available")
+        while offset < end:
+            num_copied = os_copy_file_range(src_file.fileno(), dst_file.fileno(), end-offset, offset, dst_pos + offset - start)
+            if num_copied == 0:
+                raise ValueError("Unexpected end of file: %s" % src_file.name)
+            offset += num_copied
+    except OSError: # e.g. unsupported filesystem, so fall back to block reads
+        src_file.seek(offset); dst_file.seek(dst_pos + offset - start)
+        while offset < end:
+            block = src_file.read(min(COPY_BLOCK_SIZE, end-offset))
+            if len(block) == 0:
+                raise ValueError("Unexpected end of file: %s" % src_file.name)
+            dst_file.write(block); offset += len(block)
+        dst_file.flush()
+
+# append the kept records of an indexed file to the end of another file
+# Argument: `src_fn` = filename of the indexed file
+# Argument: `entries` = offset index of `src_fn`
+# Argument: `to_keep` = `set` containing IDs to keep
+# Argument: `dst_fn` = filename of the file to append to (created if it doesn't exist)
+# Return: `list` of (ID, start, end) tuples of the copied records in `dst_fn`
+def append_kept_records(src_fn, entries, to_keep, dst_fn):
+    open(dst_fn, 'ab').close() # make sure it exists
+    dst_entries = list()
+    with open(src_fn, 'rb') as src_file, open(dst_fn, 'r+b') as dst_file:
+        dst_pos = getsize(dst_fn)
+        for start, end, run_entries in coalesce_ranges(entries, to_keep):
+            copy_range(src_file, dst_file, start, end, dst_pos)
+            for ID, entry_start, entry_end in run_entries:
+                dst_entries.append((ID, dst_pos + entry_start - start, dst_pos + entry_end - start))
+            dst_pos += end - start
+    return dst_entries
@@ -0,0 +1,63 @@
+'''
+Compact (4 bits per base) in-memory sequences shared by the True Append tools
+
+A `PackedSeq` stores an uppercase nucleotide sequence (IUPAC codes and '-' gaps) as 2 bases per byte, where each base is
+its IUPAC bitmask over A (1), C (2), G (4), T (8) (as in `NUCLEOTIDE_BITS` of tn93_true_append.py; a gap is 0).
+Sequences with any other character (e.g. lowercase, U, '.', '?') are kept as raw bytes, so packing is always lossless.
+Equality and hashing compare the stored bytes, and the sequence is only unpacked by `str()` (e.g. when it is written,
+including through '%s' formatting).
+'''
+
+# imports
+import numpy as np
+
+# constants
+PACKED_ALPHABET = '-ACMGRSVTWYHKDBN' # character of each 4-bit code (its IUPAC bitmask)
+INVALID_CODE = 255
+PACK_TABLE = np.full(256, INVALID_CODE, dtype=np.uint8)
+for code, c in enumerate(PACKED_ALPHABET):
+    PACK_TABLE[ord(c)] = code
+UNPACK_TABLE = np.array([[ord(PACKED_ALPHABET[b >> 4]), ord(PACKED_ALPHABET[b & 15])] for b in range(256)], dtype=np.uint8)
+
+# nucleotide sequence packed into 4 bits per base (or raw bytes if it can't be packed)
+class PackedSeq:
+    __slots__ = ('data', 'length', 'packed')
+
+    # Argument: `seq` = sequence (`str` or `bytes`)
+    def __init__(self, seq):
+        raw = seq.encode() if isinstance(seq, str) else bytes(seq)
+        codes = PACK_TABLE[np.frombuffer(raw, dtype=np.uint8)]
+        self.length = len(raw); self.packed = not (codes == INVALID_CODE).any()
+        if not self.packed:
+            self.data = raw; return
+        if len(codes) % 2 == 1:
+            codes = np.append(codes, np.uint8(0))
+        self.data = ((codes[0::2] << 4) | codes[1::2]).tobytes()
+
+    # return the 4-bit code (IUPAC bitmask) of each base
+    # Return: `numpy.ndarray` of `uint8` (only for packed sequences)
+    def codes(self):
+        if not self.packed:
+            raise ValueError("Sequence is not packed")
+        pairs = np.frombuffer(self.data, dtype=np.uint8)
+        codes = np.empty(2 * len(pairs), dtype=np.uint8); codes[0::2] = pairs >> 4; codes[1::2] = pairs & 15
+        return codes[:self.length]
+
+    def __str__(self):
+        if not self.packed:
+            return self.data.decode()
+        return UNPACK_TABLE[np.frombuffer(self.data, dtype=np.uint8)].tobytes()[:self.length].decode()
+
+    def __repr__(self):
+        return 'PackedSeq(%r)' % str(self)
+
+    def __len__(self):
+        return self.length
+
+    def __eq__(self, other):
+        if not isinstance(other, PackedSeq):
+            return NotImplemented
+        return self.length == other.length and self.packed == other.packed and self.data == other.data
+
+    def __hash__(self):
+        return hash(self.data)
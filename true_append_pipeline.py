@@ -0,0 +1,300 @@
+#! /usr/bin/env python3
+'''
+End-to-end True Append pipeline: compute the dataset delta once, then run DataQC, alignment (cawlign, and optionally bealign),
+and TN93 as a DAG of stages. Independent stages run concurrently, and the TN93 stage computes distances for each aligned
+record as soon as cawlign emits it (instead of waiting for the full alignment file). DataQC is an independent branch
+(it doesn't feed cawlign): its records are keyed by document_uid, whereas the alignment and distances are keyed by the
+--id_col sequences of the user table, to match the old outputs of the standalone tools.
+'''
+
+# imports
+from cawlign_true_append import run_cawlign, DEFAULT_CAWLIGN_ARGS, DEFAULT_CAWLIGN_PATH
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from os.path import isfile
+from queue import Empty, Queue
+from sys import argv, stderr
+from threading import Event, Thread
+from time import time
+from true_append_fasta import iter_fasta
+from true_append_index import build_index, load_index, write_index, DEFAULT_INDEX_SUFFIX
+from true_append_metrics import add_metrics_args, metrics_from_args, Metrics
+from true_append_packed import PackedSeq
+from tn93_edge_store import is_edge_store
+from tn93_true_append import copy_unchanged_dists, determine_deltas, encode_seqs, parse_table, tn93_block, AMBIGUITY_MODES, DEFAULT_AMBIGUITY, DEFAULT_BATCH_SIZE, DEFAULT_FRACTION, DEFAULT_ID_COL, DEFAULT_MIN_OVERLAP, DEFAULT_SEQ_COL, DEFAULT_THRESHOLD, TN93_HEADER
+import argparse
+import numpy as np
+
+# constants
+TRUE_APPEND_PIPELINE_VERSION = '0.0.1'
+END_OF_STREAM = None # queue sentinel
+
+# return the current time as a string
+def get_time():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+# print to log (prefixed by current time)
+def print_log(s='', end='\n'):
+    print("[%s] %s" % (get_time(), s), file=stderr, end=end); stderr.flush()
+
+# parse user args
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-it', '--input_table', required=True, type=str, help="Input: User table (CSV)")
+    parser.add_argument('-iT', '--input_old_table', required=False, type=str, default=None, help="Input: Old table (CSV)")
+    parser.add_argument('-iI', '--input_old_index', required=False, type=str, default=None, help="Input: Old table sequence digest index (instead of --input_old_table)")
+    parser.add_argument('-oa', '--old_aligned_file', required=True, type=str, help="Input: Old aligned sequences (FASTA)")
+    parser.add_argument('-iD', '--input_old_dists', required=True, type=str, help="Input: Old pairwise distances (TN93 CSV or edge store)")
+    parser.add_argument('-o', '--output_prefix', required=True, type=str, help="Output: Prefix of output files (.aln.fasta, .tn93.csv, %s, and optionally .bam, .dataqc.fasta, and .dataqc%s)" % (DEFAULT_INDEX_SUFFIX, DEFAULT_INDEX_SUFFIX))
+    parser.add_argument('--id_col', required=False, type=str, default=DEFAULT_ID_COL, help="Sequence ID column in the tables")
+    parser.add_argument('--seq_col', required=False, type=str, default=DEFAULT_SEQ_COL, help="Sequence column in the tables")
+    parser.add_argument('--cawlign_args', required=False, type=str, default=DEFAULT_CAWLIGN_ARGS, help="Optional cawlign arguments")
+    parser.add_argument('--cawlign_path', required=False, type=str, default=DEFAULT_CAWLIGN_PATH, help="Path to the cawlign executable")
+    parser.add_argument('-w', '--workers', required=False, type=int, default=1, help="Number of concurrent cawlign processes")
+    parser.add_argument('-t', '--threshold', required=False, type=float, default=DEFAULT_THRESHOLD, help="TN93 distance threshold")
+    parser.add_argument('-l', '--min_overlap', required=False, type=int, default=DEFAULT_MIN_OVERLAP, help="TN93 minimum overlap")
+    parser.add_argument('-a', '--ambiguity', required=False, type=str, default=DEFAULT_AMBIGUITY, help="TN93 ambiguity handling (%s)" % ', '.join(sorted(AMBIGUITY_MODES)))
+    parser.add_argument('-g', '--fraction', required=False, type=float, default=DEFAULT_FRACTION, help="TN93 maximum fraction of ambiguous positions that can be resolved")
+    parser.add_argument('--batch_size', required=False, type=int, default=DEFAULT_BATCH_SIZE, help="Number of sequences compared per vectorized TN93 batch")
+    parser.add_argument('-p', '--threads', required=False, type=int, default=1, help="Number of TN93 threads (each arrived batch is compared against several reference blocks at once; the streaming TN93 stage has no sketch prefilter, so --prefilter/-iS of tn93_true_append.py aren't available)")
+    parser.add_argument('-py', '--dataqc_py', required=False, type=str, default=None, help="PATH to DataQC.py script (enables the DataQC stage)")
+    parser.add_argument('-of', '--old_dataqc_fasta', required=False, type=str, default=None, help="Input: Old DataQC sequences (FASTA) (DataQC stage)")
+    parser.add_argument('-iQ', '--input_old_dataqc_index', required=False, type=str, default=None, help="Input: Old table DataQC sequence digest index (DataQC stage, required with --input_old_index)")
+    parser.add_argument('-or', '--old_full_report', required=False, type=str, default=None, help="Input: Old DataQC Full Report (CSV) (DataQC stage)")
+    parser.add_argument('-d', '--dram', required=False, type=str, default=None, help="DRAM CSV file (DataQC stage)")
+    parser.add_argument('-C', '--comet', required=False, type=str, default=None, help="PATH to the COMET executable (DataQC stage)")
+    parser.add_argument('--tn93_path', required=False, type=str, default=None, help="PATH to the TN93 executable (DataQC stage)")
+    parser.add_argument('-ob', '--old_bam_file', required=False, type=str, default=None, help="Input: Old aligned sequences (BAM) (enables the bealign stage)")
+    parser.add_argument('--bealign_args', required=False, type=str, default='', help="Optional bealign arguments (bealign stage)")
+    parser.add_argument('--bealign_path', required=False, type=str, default='bealign', help="Path to the bealign executable (bealign stage)")
+    parser.add_argument('-j', '--jobs', required=False, type=int, default=1, help="Number of parallel bealign processes (bealign stage)")
+    add_metrics_args(parser)
+    args = parser.parse_args()
+    if (args.input_old_table is None) == (args.input_old_index is None):
+        raise ValueError("Must specify exactly one of --input_old_table or --input_old_index")
+    if args.ambiguity not in AMBIGUITY_MODES:
+        raise ValueError("Invalid ambiguity mode (%s). Options: %s" % (args.ambiguity, ', '.join(sorted(AMBIGUITY_MODES))))
+    if args.workers < 1 or args.batch_size < 1 or args.jobs < 1:
+        raise ValueError("Number of workers, jobs, and batch size must be positive")
+    if args.dataqc_py is not None and (args.old_dataqc_fasta is None or args.old_full_report is None):
+        raise ValueError("DataQC stage requires --old_dataqc_fasta and --old_full_report")
+    if args.dataqc_py is not None and args.input_old_index is not None and args.input_old_dataqc_index is None:
+        raise ValueError("DataQC stage with --input_old_index requires --input_old_dataqc_index")
+    for fn in [args.input_table, args.input_old_table, args.input_old_index, args.old_aligned_file, args.input_old_dists, args.old_dataqc_fasta, args.input_old_dataqc_index, args.old_full_report, args.old_bam_file]:
+        if fn is not None and not isfile(fn) and not is_edge_store(fn) and not fn.startswith('/dev/fd'):
+            raise ValueError("File not found: %s" % fn)
+    for fn in output_fns(args).values():
+        if isfile(fn):
+            raise ValueError("File exists: %s" % fn)
+    return args
+
+# output filenames of a pipeline run
+def output_fns(args):
+    out = {'aln':'%s.aln.fasta' % args.output_prefix, 'tn93':'%s.tn93.csv' % args.output_prefix, 'index':'%s%s' % (args.output_prefix, DEFAULT_INDEX_SUFFIX)}
+    if args.dataqc_py is not None:
+        out['dataqc'] = '%s.dataqc.fasta' % args.output_prefix; out['dataqc_index'] = '%s.dataqc%s' % (args.output_prefix, DEFAULT_INDEX_SUFFIX)
+    if args.old_bam_file is not None:
+        out['bam'] = '%s.bam' % args.output_prefix
+    return out
+
+# file-like stage output that writes aligned FASTA records to a file and also emits them, as (ID, sequence) tuples, into a queue
+class AlignmentStream:
+    def __init__(self, out_file, out_queue):
+        self.out_file = out_file; self.out_queue = out_queue
+
+    # write whole FASTA records
+    def write(self, s):
+        self.out_file.write(s)
+        for record in s.split('\n>'):
+            lines = record.lstrip('>').split('\n')
+            if len(lines[0].strip()) != 0:
+                self.out_queue.put((lines[0].strip(), ''.join(l.strip() for l in lines[1:])))
+
+    def flush(self):
+        self.out_file.flush()
+
+# encode sequences with a fixed alignment length (padded with gaps)
+def encode_padded(seqs, L):
+    encoded = encode_seqs(seqs)
+    if encoded.shape[1] < L:
+        encoded = np.pad(encoded, ((0,0), (0, L - encoded.shape[1])))
+    return encoded
+
+# compute TN93 distances for aligned records as they arrive in a queue
+# Each batch of arrived records is compared against the kept sequences, the previously arrived records, and itself.
+# Argument: `keep_IDs` = `list` of kept sequence IDs
+# Argument: `keep_seqs` = `list` of kept aligned sequences (same order as `keep_IDs`)
+# Argument: `in_queue` = `Queue` of (ID, aligned sequence) tuples, ended by `END_OF_STREAM`
+# Argument: `out_file` = output TN93 CSV file stream
+# Argument: `threads` = number of threads comparing the reference blocks of a batch (the matrix products release the GIL)
+# Return: number of distances written
+def stream_new_distances(keep_IDs, keep_seqs, in_queue, out_file, threshold=DEFAULT_THRESHOLD, min_overlap=DEFAULT_MIN_OVERLAP, mode=DEFAULT_AMBIGUITY, fraction=DEFAULT_FRACTION, batch_size=DEFAULT_BATCH_SIZE, threads=1):
+    params = {'mode':mode, 'fraction':fraction, 'min_overlap':min_overlap}
+    executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+    L = max((len(s) for s in keep_seqs), default=0)
+    keep_encoded = encode_padded(keep_seqs, L)
+    prev_batches = list() # (IDs, encoded) of previously arrived records
+    query_size = max(1, batch_size // 4); done = False; num_dists = 0
+    while not done:
+        batch = [in_queue.get()] # block until at least one record arrives
+        while len(batch) < query_size and batch[-1] is not END_OF_STREAM:
+            try:
+                batch.append(in_queue.get_nowait())
+            except Empty:
+                break
+        if batch[-1] is END_OF_STREAM:
+            batch.pop(); done = True
+        if len(batch) == 0:
+            continue
+        IDs = [ID for ID, seq in batch]
+        L_batch = max(len(seq) for ID, seq in batch)
+        if L_batch > L: # longer than everything so far, so pad the references
+            L = L_batch; keep_encoded = encode_padded(keep_seqs, L)
+            prev_batches = [(prev_IDs, np.pad(prev, ((0,0), (0, L - prev.shape[1])))) for prev_IDs, prev in prev_batches]
+        encoded = encode_padded([seq for ID, seq in batch], L)
+        refs = [(keep_IDs[r_start:r_start+batch_size], keep_encoded[r_start:r_start+batch_size]) for r_start in range(0, len(keep_IDs), batch_size)] + prev_batches
+        if executor is None:
+            ref_dists = (tn93_block(encoded, ref_encoded, **params) for ref_IDs, ref_encoded in refs)
+        else:
+            ref_dists = executor.map(lambda ref: tn93_block(encoded, ref[1], **params), refs)
+        for (ref_IDs, ref_encoded), dists in zip(refs, ref_dists):
+            for qi, ri in zip(*np.nonzero(dists <= threshold)):
+                out_file.write('%s,%s,%g\n' % (IDs[qi], ref_IDs[ri], dists[qi,ri])); num_dists += 1
+        dists = tn93_block(encoded, encoded, **params)
+        for qi, ri in zip(*np.nonzero(dists <= threshold)):
+            if ri < qi: # each pair within the batch only once
+                out_file.write('%s,%s,%g\n' % (IDs[qi], IDs[ri], dists[qi,ri])); num_dists += 1
+        prev_batches.append((IDs, encoded))
+    if executor is not None:
+        executor.shutdown()
+    out_file.flush()
+    return num_dists
+
+# run a DAG of stages, each in its own thread as soon as all of its dependencies have finished
+# Argument: `stages` = `list` of (name, function, dependency names) tuples
+# Argument: `metrics` = `Metrics` to record each stage in (as a phase named after the stage), or `None`
+def run_stages(stages, metrics=None):
+    if metrics is None:
+        metrics = Metrics('pipeline') # (records nothing)
+    finished = {name:Event() for name, func, deps in stages}; errors = list()
+    def run_stage(name, func, deps):
+        try:
+            for dep in deps:
+                finished[dep].wait()
+            if len(errors) != 0:
+                print_log("Skipping stage (upstream failure): %s" % name); return
+            print_log("Starting stage: %s" % name); start = time()
+            with metrics.phase(name):
+                func()
+            print_log("Finished stage: %s (%.3f seconds)" % (name, time() - start))
+        except Exception as e:
+            print_log("Stage failed: %s (%s)" % (name, e)); errors.append((name, e))
+        finally:
+            finished[name].set()
+    threads = [Thread(target=run_stage, args=stage) for stage in stages]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(errors) != 0:
+        raise RuntimeError("Pipeline stage failed: %s" % errors[0][0]) from errors[0][1]
+
+# main program
+def main():
+    print_log("Running True Append Pipeline v%s" % TRUE_APPEND_PIPELINE_VERSION)
+    args = parse_args(); out_fns = output_fns(args)
+    print_log("Command: %s" % ' '.join(argv))
+    metrics = metrics_from_args(args, 'pipeline')
+    with metrics.phase('parse_user') as counts:
+        print_log("Parsing user table: %s" % args.input_table)
+        seqs_new = parse_table(args.input_table, id_col=args.id_col, seq_col=args.seq_col, packed=True)
+        print_log("- Num Sequences: %s" % len(seqs_new))
+        index_new = build_index(seqs_new); counts['sequences'] = len(seqs_new)
+    with metrics.phase('parse_old') as counts:
+        if args.input_old_index is None:
+            print_log("Parsing old table: %s" % args.input_old_table)
+            index_old = build_index(parse_table(args.input_old_table, id_col=args.id_col, seq_col=args.seq_col))
+        else:
+            print_log("Loading old table sequence index: %s" % args.input_old_index)
+            index_old = load_index(args.input_old_index)
+        print_log("- Num Sequences: %s" % len(index_old)); counts['sequences'] = len(index_old)
+    with metrics.phase('delta') as counts:
+        print_log("Determining deltas between user table and old table (shared by all stages)...")
+        to_add, to_replace, to_delete, to_keep = determine_deltas(index_new, index_old)
+        print_log("- Add: %s" % len(to_add))
+        print_log("- Replace: %s" % len(to_replace))
+        print_log("- Delete: %s" % len(to_delete))
+        print_log("- Do nothing: %s" % (len(to_keep)))
+        counts.update({'add': len(to_add), 'replace': len(to_replace), 'delete': len(to_delete), 'keep': len(to_keep)})
+    if args.dataqc_py is not None: # DataQC keys its records on document_uid/predq_clean_seq (not --id_col/--seq_col), so it gets its own delta
+        from dataqc_true_append import parse_table as parse_dataqc_table
+        with metrics.phase('dataqc_delta') as counts:
+            print_log("Determining DataQC deltas (document_uid/predq_clean_seq) between user table and old table...")
+            dataqc_index_new = build_index(parse_dataqc_table(args.input_table))
+            if args.input_old_dataqc_index is None:
+                dataqc_index_old = build_index(parse_dataqc_table(args.input_old_table))
+            else:
+                dataqc_index_old = load_index(args.input_old_dataqc_index)
+            dataqc_to_add, dataqc_to_replace, dataqc_to_delete, dataqc_to_keep = determine_deltas(dataqc_index_new, dataqc_index_old)
+            print_log("- Add: %s" % len(dataqc_to_add))
+            print_log("- Replace: %s" % len(dataqc_to_replace))
+            print_log("- Delete: %s" % len(dataqc_to_delete))
+            print_log("- Do nothing: %s" % (len(dataqc_to_keep)))
+            counts.update({'add': len(dataqc_to_add), 'replace': len(dataqc_to_replace), 'delete': len(dataqc_to_delete), 'keep': len(dataqc_to_keep)})
+
+    # stages (sharing state through `state`; cawlign streams aligned records to the TN93 stage through `aln_queue`)
+    state = dict(); aln_queue = Queue()
+    def load_old_alignments():
+        state['keep_IDs'] = list(); state['keep_seqs'] = list()
+        for ID, seq in iter_fasta(args.old_aligned_file):
+            if ID in to_keep:
+                state['keep_IDs'].append(ID); state['keep_seqs'].append(PackedSeq(seq))
+        print_log("- Num Unchanged Alignments: %d" % len(state['keep_IDs']))
+    def align_cawlign():
+        state['aln_file'] = open(out_fns['aln'], 'w')
+        try:
+            run_cawlign(seqs_new, to_add, to_replace, AlignmentStream(state['aln_file'], aln_queue), cawlign_path=args.cawlign_path, cawlign_args=args.cawlign_args, workers=args.workers, metrics=metrics)
+        finally:
+            aln_queue.put(END_OF_STREAM)
+    def copy_alignments():
+        aln_file = state['aln_file']
+        for ID, seq in zip(state['keep_IDs'], state['keep_seqs']):
+            aln_file.write('>%s\n%s\n' % (ID, seq))
+        aln_file.close()
+    def copy_dists():
+        state['tn93_file'] = open(out_fns['tn93'], 'w'); state['tn93_file'].write(TN93_HEADER + '\n')
+        print_log("- Num Unchanged Distances: %d" % copy_unchanged_dists(args.input_old_dists, to_delete | to_replace, state['tn93_file']))
+    def compute_dists():
+        num_new = stream_new_distances(state['keep_IDs'], state['keep_seqs'], aln_queue, state['tn93_file'], threshold=args.threshold, min_overlap=args.min_overlap, mode=args.ambiguity, fraction=args.fraction, batch_size=args.batch_size, threads=args.threads)
+        state['tn93_file'].close()
+        print_log("- Num New Distances: %d" % num_new)
+    def append_dataqc_stage():
+        from dataqc_true_append import append_dataqc
+        append_dataqc(args.input_table, dataqc_to_add, dataqc_to_replace, dataqc_to_keep, out_fns['dataqc'], args.old_dataqc_fasta, args.old_full_report, args.dataqc_py, dram_path=args.dram, comet_path=args.comet, tn93_path=args.tn93_path, metrics=metrics)
+    def align_bealign():
+        from bealign_true_append import merge_bams, run_bealign # requires pysam
+        new_updated_bam_fns = run_bealign(seqs_new, '%s.new_updated.fasta' % args.output_prefix, to_add, to_replace, '%s.new_updated.bam' % args.output_prefix, bealign_path=args.bealign_path, bealign_args=args.bealign_args, jobs=args.jobs, metrics=metrics)
+        merge_bams(args.old_bam_file, new_updated_bam_fns, out_fns['bam'], to_keep)
+    def write_seq_index():
+        write_index(out_fns['index'], index_new)
+        if args.dataqc_py is not None:
+            write_index(out_fns['dataqc_index'], dataqc_index_new)
+    stages = [
+        ('load_old_alignments', load_old_alignments, []),
+        ('cawlign', align_cawlign, []),
+        ('copy_alignments', copy_alignments, ['cawlign', 'load_old_alignments']),
+        ('copy_dists', copy_dists, []),
+        ('tn93', compute_dists, ['load_old_alignments', 'copy_dists']), # consumes cawlign's stream while it runs
+    ]
+    if args.dataqc_py is not None:
+        stages.append(('dataqc', append_dataqc_stage, []))
+    if args.old_bam_file is not None:
+        stages.append(('bealign', align_bealign, []))
+    stages.append(('write_index', write_seq_index, [name for name, func, deps in stages]))
+    run_stages(stages, metrics=metrics); metrics.close()
+    for k, fn in out_fns.items():
+        print_log("Output (%s): %s" % (k, fn))
+
+# run main program
+if __name__ == "__main__":
+    main()
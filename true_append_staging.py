@@ -0,0 +1,55 @@
+'''
+Staging parts shared by the True Append tools
+
+While an external tool (cawlign, DataQC) processes the new and updated records, the unchanged records are copied in a
+background thread into a staging part (a temporary file next to the output). Once the tool has finished, the part is
+appended to its output (with `os.copy_file_range` where the kernel supports it, see `copy_range`), so the runtime of
+the tool and the copy overlap instead of adding up.
+'''
+
+# imports
+from os.path import abspath, dirname, getsize
+from tempfile import NamedTemporaryFile
+from threading import Thread
+from true_append_offsets import copy_range
+
+# constants
+DEFAULT_PART_SUFFIX = '.part'
+
+# function running in a background thread, whose return value (or exception) is collected by `wait`
+class BackgroundTask(Thread):
+    def __init__(self, func, *args, **kwargs):
+        super().__init__(daemon=True)
+        self.func = func; self.func_args = args; self.func_kwargs = kwargs; self.result = None; self.error = None
+
+    def run(self):
+        try:
+            self.result = self.func(*self.func_args, **self.func_kwargs)
+        except BaseException as e:
+            self.error = e
+
+    # wait for the function to finish
+    # Return: return value of the function (its exception is raised here instead if it failed)
+    def wait(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+# create an empty staging part for an output file
+# Argument: `fn` = filename of the output file (the part is created in the same directory, so it can be appended in the kernel), or `None` to use the temporary directory
+# Return: filename of the staging part
+def new_part(fn=None):
+    with NamedTemporaryFile(dir=None if fn is None else dirname(abspath(fn)), prefix='.', suffix=DEFAULT_PART_SUFFIX, delete=False) as part_file:
+        return part_file.name
+
+# append a whole staging part to the end of a file
+# Argument: `part_fn` = filename of the staging part
+# Argument: `dst_fn` = filename of the file to append to (created if it doesn't exist)
+# Argument: `entries` = offset index of `part_fn` (iterable of (ID, start, end) tuples)
+# Return: `list` of (ID, start, end) tuples of `entries` in `dst_fn`
+def append_part(part_fn, dst_fn, entries=()):
+    open(dst_fn, 'ab').close() # make sure it exists
+    with open(part_fn, 'rb') as part_file, open(dst_fn, 'r+b') as dst_file:
+        dst_pos = getsize(dst_fn); copy_range(part_file, dst_file, 0, getsize(part_fn), dst_pos)
+    return [(ID, dst_pos + start, dst_pos + end) for ID, start, end in entries]
@@ -0,0 +1,150 @@
+#! /usr/bin/env python3
+'''
+Run state store shared by the True Append tools (a single local SQLite/WAL file)
+
+Instead of reconstructing the previous run from flat files, a tool run with `--state_db` reads the old per-ID content digests
+from the store, processes only the delta, and writes back only the delta rows: its output records (e.g. aligned sequences,
+DataQC FASTA records and full report rows), and (for TN93) sub-threshold distances.
+Each tool has its own namespace, so several tools can share one store. Full flat files are exported on demand:
+
+  true_append_state.py -db state.sqlite -t cawlign -o aligned.fasta
+  true_append_state.py -db state.sqlite -t tn93 -o dists.csv
+'''
+
+# imports
+from os.path import isfile
+from sys import stderr, stdin, stdout
+from true_append_io import open_file
+from zlib import compress, decompress
+import argparse
+import sqlite3
+
+# constants
+STATE_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS sequences (tool TEXT NOT NULL, id TEXT NOT NULL, digest TEXT NOT NULL, length INTEGER NOT NULL, PRIMARY KEY (tool, id))",
+    "CREATE TABLE IF NOT EXISTS records (tool TEXT NOT NULL, kind TEXT NOT NULL, id TEXT NOT NULL, value BLOB NOT NULL, PRIMARY KEY (tool, kind, id))",
+    "CREATE TABLE IF NOT EXISTS distances (tool TEXT NOT NULL, id1 TEXT NOT NULL, id2 TEXT NOT NULL, distance REAL NOT NULL, PRIMARY KEY (tool, id1, id2))",
+    "CREATE INDEX IF NOT EXISTS distances_id2 ON distances (tool, id2)",
+    "CREATE TABLE IF NOT EXISTS meta (tool TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (tool, key))",
+]
+STDIO = {'stderr':stderr, 'stdin':stdin, 'stdout':stdout}
+
+# run state store
+class StateStore:
+    # open (or create) the store in `fn`; `tool` is the namespace of the calling tool (e.g. 'cawlign')
+    def __init__(self, fn, tool):
+        self.fn = fn; self.tool = tool
+        self.db = sqlite3.connect(fn)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        for statement in STATE_SCHEMA:
+            self.db.execute(statement)
+
+    # load the digest index of the sequences processed by the previous run
+    # Return: `dict` where keys are sequence IDs and values are (digest, length) tuples (see `true_append_index`)
+    def load_index(self):
+        return {ID: (digest, length) for ID, digest, length in self.db.execute("SELECT id, digest, length FROM sequences WHERE tool = ?", (self.tool,))}
+
+    # update the digest index with the delta of this run
+    # Argument: `index_new` = digest index of the user sequences
+    # Argument: `to_update` = `set` containing IDs whose index entries need to be added or replaced
+    # Argument: `to_delete` = `set` containing IDs whose index entries need to be deleted
+    def update_index(self, index_new, to_update, to_delete):
+        self.db.executemany("DELETE FROM sequences WHERE tool = ? AND id = ?", ((self.tool, ID) for ID in to_delete))
+        self.db.executemany("INSERT OR REPLACE INTO sequences (tool, id, digest, length) VALUES (?, ?, ?, ?)", ((self.tool, ID, index_new[ID][0], index_new[ID][1]) for ID in to_update))
+
+    # delete the output records of the given IDs
+    def delete_records(self, kind, IDs):
+        self.db.executemany("DELETE FROM records WHERE tool = ? AND kind = ? AND id = ?", ((self.tool, kind, ID) for ID in IDs))
+
+    # add (or replace) output records
+    # Argument: `kind` = record kind (e.g. 'fasta')
+    # Argument: `records` = iterable of (ID, record text) tuples (the text is exported as-is)
+    def put_records(self, kind, records):
+        self.db.executemany("INSERT OR REPLACE INTO records (tool, kind, id, value) VALUES (?, ?, ?, ?)", ((self.tool, kind, ID, compress(value.encode(), 1)) for ID, value in records))
+
+    # iterate over the output records of a kind
+    # Return: generator of (ID, record text) tuples
+    def iter_records(self, kind):
+        for ID, value in self.db.execute("SELECT id, value FROM records WHERE tool = ? AND kind = ? ORDER BY rowid", (self.tool, kind)):
+            yield ID, decompress(value).decode()
+
+    # return the record kinds stored for this tool
+    def record_kinds(self):
+        return [row[0] for row in self.db.execute("SELECT DISTINCT kind FROM records WHERE tool = ?", (self.tool,))]
+
+    # delete all distances involving the given IDs
+    def delete_distances(self, IDs):
+        self.db.executemany("DELETE FROM distances WHERE tool = ? AND id1 = ?", ((self.tool, ID) for ID in IDs))
+        self.db.executemany("DELETE FROM distances WHERE tool = ? AND id2 = ?", ((self.tool, ID) for ID in IDs))
+
+    # add (or replace) distances
+    # Argument: `dists` = iterable of (ID1, ID2, distance) tuples
+    def put_distances(self, dists):
+        self.db.executemany("INSERT OR REPLACE INTO distances (tool, id1, id2, distance) VALUES (?, ?, ?, ?)", ((self.tool, u, v, d) for u, v, d in dists))
+
+    # iterate over all distances
+    # Return: generator of (ID1, ID2, distance) tuples
+    def iter_distances(self):
+        yield from self.db.execute("SELECT id1, id2, distance FROM distances WHERE tool = ? ORDER BY rowid", (self.tool,))
+
+    # return a metadata value of this tool (or `None` if it isn't set)
+    def get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE tool = ? AND key = ?", (self.tool, key)).fetchone()
+        return None if row is None else row[0]
+
+    # set a metadata value of this tool
+    def put_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (tool, key, value) VALUES (?, ?, ?)", (self.tool, key, value))
+
+    # commit and close
+    def close(self):
+        self.db.commit(); self.db.close()
+
+# export the full flat-file output of a tool
+# Argument: `store` = `StateStore` of the tool
+# Argument: `kind` = record kind to export (or `None` to export distances)
+# Argument: `out_file` = output file stream
+# Return: number of exported records (or distances)
+def export_state(store, kind, out_file):
+    header = store.get_meta('header' if kind is None else 'header\t%s' % kind); num_exported = 0
+    if header is not None:
+        out_file.write(header)
+    if kind is None:
+        for u, v, d in store.iter_distances():
+            out_file.write('%s,%s,%g\n' % (u, v, d)); num_exported += 1
+    else:
+        for ID, value in store.iter_records(kind):
+            out_file.write(value); num_exported += 1
+    return num_exported
+
+# parse user args
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-db', '--state_db', required=True, type=str, help="Input: State store (SQLite)")
+    parser.add_argument('-t', '--tool', required=True, type=str, help="Tool namespace (e.g. cawlign, bealign, dataqc, tn93)")
+    parser.add_argument('-k', '--kind', required=False, type=str, default=None, help="Record kind to export (default: the tool's only record kind, or distances if it has none)")
+    parser.add_argument('-o', '--output', required=False, type=str, default='stdout', help="Output: Exported flat file")
+    args = parser.parse_args()
+    if not isfile(args.state_db):
+        raise ValueError("File not found: %s" % args.state_db)
+    if isfile(args.output):
+        raise ValueError("File exists: %s" % args.output)
+    return args
+
+# main program
+def main():
+    args = parse_args()
+    store = StateStore(args.state_db, args.tool); kind = args.kind
+    if kind is None:
+        kinds = store.record_kinds()
+        if len(kinds) > 1:
+            raise ValueError("Tool %s has multiple record kinds (specify one with --kind): %s" % (args.tool, ', '.join(sorted(kinds))))
+        kind = None if len(kinds) == 0 else kinds[0]
+    with open_file(args.output, 'w') as out_file:
+        num_exported = export_state(store, kind, out_file)
+    store.close()
+    print("Exported %d %s" % (num_exported, 'distances' if kind is None else '%s records' % kind), file=stderr)
+
+# run main program
+if __name__ == "__main__":
+    main()